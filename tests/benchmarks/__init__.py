@@ -0,0 +1,6 @@
+"""
+Benchmarks of TwinDB agent data and control paths
+
+The benchmarks run the agent code against stand-in executables and a local
+dispatcher, so they don't need a live MySQL server or TwinDB storage.
+"""
@@ -0,0 +1,264 @@
+"""
+API round-trip benchmark
+
+Sends requests through TwinDBAPI.call() and TwinDBHTTPClient.get_response() to a local
+FakeDispatcher and breaks down latency of every call into serialization, GPG setup,
+GPG encryption, HTTP, GPG decryption and JSON decoding.
+
+Usage:
+    python -m tests.benchmarks.api --calls 50
+    python -m tests.benchmarks.api --types get_config,log --log-level DEBUG
+    python -m tests.benchmarks.api --compact
+"""
+from __future__ import print_function
+import json
+import logging
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import twindb_agent.api
+import twindb_agent.config
+import twindb_agent.gpg
+import twindb_agent.httpclient
+
+from tests.benchmarks import fakes
+from tests.benchmarks.dispatcher import FakeDispatcher, GPGKeyring
+
+DEFAULT_TYPES = ["get_job", "get_config", "notify", "log", "report_sss"]
+# Stages are measured by wrapping these functions. HTTP is what's left of the call time
+STAGES = ["serialize", "gpg_setup", "encrypt", "decrypt", "decode"]
+
+
+class DiscardHandler(logging.Handler):
+    """
+    Formats log records like a real handler would, but doesn't write them anywhere
+    """
+    def emit(self, record):
+        self.format(record)
+
+
+class StageTimer(object):
+    """
+    Accumulates time spent in wrapped functions
+    """
+    def __init__(self):
+        self.totals = dict((stage, 0.0) for stage in STAGES)
+        self._saved = []
+
+    def wrap(self, obj, attr, stage):
+        func = getattr(obj, attr)
+        totals = self.totals
+
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                totals[stage] += time.time() - started
+        self._saved.append((obj, attr, obj.__dict__[attr]))
+        setattr(obj, attr, wrapper)
+
+    def install(self):
+        self.wrap(json, "dumps", "serialize")
+        self.wrap(json.JSONDecoder, "decode", "decode")
+        self.wrap(twindb_agent.gpg.TwinDBGPG, "__init__", "gpg_setup")
+        self.wrap(twindb_agent.gpg.TwinDBGPG, "encrypt", "encrypt")
+        self.wrap(twindb_agent.gpg.TwinDBGPG, "decrypt", "decrypt")
+
+    def uninstall(self):
+        for obj, attr, value in reversed(self._saved):
+            setattr(obj, attr, value)
+        self._saved = []
+
+    def reset(self):
+        for stage in self.totals:
+            self.totals[stage] = 0.0
+
+
+def percentile(values, p):
+    """
+    Returns p-th percentile of a list of numbers using nearest rank
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(round(p / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+class ApiBenchmark(object):
+    def __init__(self, calls=20, types=None, key_length=2048, log_level=logging.INFO, compact=False):
+        """
+        :param compact: if True the agent and the dispatcher use compact wire format, legacy format otherwise
+        """
+        self.calls = calls
+        self.compact = compact
+        self.types = types or DEFAULT_TYPES
+        self.key_length = key_length
+        self.log_level = log_level
+        self.dispatcher = None
+        self.agent_keyring = None
+        self.workdir = None
+        self._saved_config = None
+        self._saved_breaker = None
+        self._saved_compact = None
+        self._handler = DiscardHandler()
+
+    def setup(self):
+        self.workdir = tempfile.mkdtemp(prefix="twindb-bench.")
+        self.dispatcher = FakeDispatcher(key_length=self.key_length, compact=self.compact)
+        self.dispatcher.start()
+
+        config = twindb_agent.config.AgentConfig(gpg_homedir=os.path.join(self.workdir, "gnupg"),
+                                                 api_host=self.dispatcher.address,
+                                                 api_pub_key=self.dispatcher.pub_key)
+        config.api_wire_format = "compact" if self.compact else "legacy"
+        self.agent_keyring = GPGKeyring(homedir=config.gpg_homedir)
+        agent_email = "%s@twindb.com" % config.server_id
+        self.agent_keyring.gen_key(agent_email, key_length=self.key_length)
+        self.dispatcher.add_agent(self.agent_keyring.export(agent_email))
+
+        self._saved_config = twindb_agent.config.AgentConfig._instance
+        twindb_agent.config.AgentConfig._instance = config
+        self._saved_breaker = twindb_agent.httpclient._breaker
+        twindb_agent.httpclient._breaker = twindb_agent.httpclient.CircuitBreaker()
+        self._saved_compact = twindb_agent.httpclient._compact
+        twindb_agent.httpclient._compact = None
+
+        self._handler.setFormatter(logging.Formatter("%(asctime)s: %(levelname)s: %(message)s"))
+        for name in ["twindb_remote", "twindb_local"]:
+            logger = logging.getLogger(name)
+            logger.addHandler(self._handler)
+            logger.setLevel(self.log_level)
+            logger.propagate = False
+
+    def teardown(self):
+        for name in ["twindb_remote", "twindb_local"]:
+            logger = logging.getLogger(name)
+            logger.removeHandler(self._handler)
+            logger.propagate = True
+        twindb_agent.config.AgentConfig._instance = self._saved_config
+        twindb_agent.httpclient._breaker = self._saved_breaker
+        twindb_agent.httpclient._compact = self._saved_compact
+        if self.dispatcher:
+            self.dispatcher.stop()
+            self.dispatcher = None
+        if self.agent_keyring:
+            self.agent_keyring.destroy()
+            self.agent_keyring = None
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            self.workdir = None
+
+    @staticmethod
+    def make_request(request_type):
+        config = twindb_agent.config.AgentConfig.get_config()
+        params = {
+            "get_job": {},
+            "get_config": {"server_id": config.server_id},
+            "notify": {"event": "start_job", "job_id": 1, "pid": os.getpid()},
+            "log": {"job_id": 1, "msg": "INFO: MainProcess: backup: take_backup_xtrabackup():42: " + "x" * 160},
+            "report_sss": dict(fakes.FakeMySQL.get_slave_status(), server_id=config.server_id)
+        }.get(request_type, {})
+        return {"type": request_type, "params": params}
+
+    @staticmethod
+    def send(request):
+        """
+        Sends request the same way the agent does. Log records don't go through TwinDBAPI
+        """
+        if request["type"] == "log":
+            return twindb_agent.httpclient.TwinDBHTTPClient().get_response(request) is not None
+        api = twindb_agent.api.TwinDBAPI()
+        api.call(request)
+        return api.success
+
+    def run_type(self, request_type, timer):
+        latencies = []
+        stages = dict((stage, 0.0) for stage in STAGES)
+        failures = 0
+        self.dispatcher.reset()
+        for i in range(self.calls):
+            request = self.make_request(request_type)
+            timer.reset()
+            started = time.time()
+            if not self.send(request):
+                failures += 1
+            latencies.append(time.time() - started)
+            for stage in STAGES:
+                stages[stage] += timer.totals[stage]
+        total = sum(latencies)
+        breakdown = dict((stage, stages[stage] / self.calls * 1000) for stage in STAGES)
+        breakdown["http"] = max(0.0, total / self.calls * 1000 - sum(breakdown.values()))
+        records = [r for r in self.dispatcher.requests if r.type == request_type]
+        return {
+            "calls": self.calls,
+            "failures": failures,
+            "calls_per_sec": self.calls / total if total else 0.0,
+            "mean_ms": total / self.calls * 1000,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "request_bytes": sum(r.request_size for r in records) / max(1, len(records)),
+            "response_bytes": sum(r.response_size for r in records) / max(1, len(records)),
+            "breakdown_ms": breakdown
+        }
+
+    def run(self):
+        """
+        Benchmarks every request type
+        :return: dictionary request type -> statistics
+        """
+        self.setup()
+        timer = StageTimer()
+        timer.install()
+        try:
+            return dict((request_type, self.run_type(request_type, timer)) for request_type in self.types)
+        finally:
+            timer.uninstall()
+            self.teardown()
+
+
+def format_report(results):
+    columns = STAGES + ["http"]
+    fmt = "%-14s %8s %8s %8s %8s %8s %8s " + " ".join(["%9s"] * len(columns))
+    lines = [fmt % tuple(["type", "calls/s", "mean ms", "p50 ms", "p95 ms", "req B", "resp B"] + columns)]
+    for request_type in sorted(results):
+        r = results[request_type]
+        row = [request_type, "%.2f" % r["calls_per_sec"], "%.1f" % r["mean_ms"],
+               "%.1f" % r["p50_ms"], "%.1f" % r["p95_ms"], r["request_bytes"], r["response_bytes"]]
+        row += ["%.1f" % r["breakdown_ms"][c] for c in columns]
+        lines.append(fmt % tuple(row))
+        if r["failures"]:
+            lines.append("    %d of %d calls failed" % (r["failures"], r["calls"]))
+    return "\n".join(lines)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--calls", help="Calls per request type [default: %default]", type="int", default=20)
+    parser.add_option("--types", help="Comma separated request types [default: %default]",
+                      default=",".join(DEFAULT_TYPES))
+    parser.add_option("--key-length", help="RSA key length of agent and dispatcher keys [default: %default]",
+                      type="int", default=2048)
+    parser.add_option("--log-level", help="Level of agent loggers [default: %default]", default="INFO")
+    parser.add_option("--compact", help="Use compact wire format", action="store_true", default=False)
+    parser.add_option("--json", help="Print results in JSON", action="store_true", default=False)
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    benchmark = ApiBenchmark(calls=options.calls, types=options.types.split(","), key_length=options.key_length,
+                             log_level=getattr(logging, options.log_level.upper()), compact=options.compact)
+    results = benchmark.run()
+    if options.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+    else:
+        print(format_report(results))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
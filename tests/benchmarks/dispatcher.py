@@ -0,0 +1,411 @@
+"""
+Local stand-in for TwinDB dispatcher
+
+FakeDispatcher is an HTTP server with its own GPG key. It speaks the same protocol
+as dispatcher.twindb.com and implements the request types the agent sends.
+Every request is recorded, so benchmarks can analyze arrival times and service times.
+
+Usage:
+    python -m tests.benchmarks.dispatcher --port 8080 --plaintext
+
+    dispatcher = FakeDispatcher()
+    dispatcher.start()
+    agent_config.api_host = dispatcher.address
+    agent_config.api_pub_key = dispatcher.keyring.export(dispatcher.email)
+    ...
+    dispatcher.stop()
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import optparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+from base64 import b64decode, b64encode
+
+from twindb_agent import wire
+
+from tests.benchmarks import fakes
+
+GPG_KEY_SCRIPT = """
+%%no-protection
+Key-Type: RSA
+Key-Length: %(key_length)d
+Subkey-Type: RSA
+Subkey-Length: %(key_length)d
+Name-Real: %(name)s
+Name-Email: %(email)s
+Expire-Date: 0
+%%commit
+"""
+
+
+class GPGKeyring(object):
+    """
+    GPG home directory with helpers to generate keys and to encrypt/decrypt messages
+    """
+    def __init__(self, homedir=None):
+        if homedir:
+            self.homedir = homedir
+            if not os.path.exists(homedir):
+                os.mkdir(homedir, 0700)
+        else:
+            self.homedir = tempfile.mkdtemp(prefix="twindb-gpg.")
+
+    def _gpg(self, args, stdin=None):
+        cmd = ["gpg", "--homedir", self.homedir, "--batch", "--trust-model", "always"] + args
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        cout, cerr = p.communicate(stdin)
+        return p.returncode, cout, cerr
+
+    def gen_key(self, email, name="TwinDB benchmark", key_length=2048):
+        script = GPG_KEY_SCRIPT % {"key_length": key_length, "name": name, "email": email}
+        ret, cout, cerr = self._gpg(["--gen-key"], script)
+        if ret != 0:
+            raise DispatcherError("Failed to generate GPG key for %s: %s" % (email, cerr))
+
+    def export(self, email):
+        ret, cout, cerr = self._gpg(["--armor", "--export", email])
+        if ret != 0 or not cout:
+            raise DispatcherError("Failed to export GPG key of %s: %s" % (email, cerr))
+        return cout
+
+    def import_key(self, key):
+        ret, cout, cerr = self._gpg(["--import"], key)
+        if ret != 0:
+            raise DispatcherError("Failed to import GPG key: %s" % cerr)
+
+    def encrypt(self, msg, recipient, sign_as=None, armor=True):
+        args = ["-r", recipient]
+        if armor:
+            args.append("--armor")
+        if sign_as:
+            args += ["--sign", "--local-user", sign_as]
+        ret, cout, cerr = self._gpg(args + ["--encrypt"], msg)
+        if ret != 0:
+            raise DispatcherError("Failed to encrypt message for %s: %s" % (recipient, cerr))
+        return cout
+
+    def decrypt(self, msg):
+        """
+        Decrypts a message
+        :return: tuple (plain text, email of the signer or None if the message isn't signed)
+        """
+        ret, cout, cerr = self._gpg(["--status-fd", "2", "--decrypt"], msg)
+        if ret != 0:
+            raise DispatcherError("Failed to decrypt message: %s" % cerr)
+        signer = None
+        match = re.search(r"^\[GNUPG:\] GOODSIG \S+ .*<([^>]+)>", cerr, re.MULTILINE)
+        if match:
+            signer = match.group(1)
+        return cout, signer
+
+    def destroy(self):
+        devnull = open(os.devnull, "w")
+        try:
+            subprocess.call(["gpgconf", "--homedir", self.homedir, "--kill", "gpg-agent"],
+                            stdout=devnull, stderr=devnull)
+        except OSError:
+            # GnuPG 1.x doesn't have gpgconf and gpg-agent
+            pass
+        devnull.close()
+        shutil.rmtree(self.homedir, ignore_errors=True)
+
+
+class RequestRecord(object):
+    __slots__ = ["type", "server_id", "arrived", "service_time", "request_size", "response_size"]
+
+    def __init__(self, request_type, server_id, arrived, service_time, request_size, response_size):
+        self.type = request_type
+        self.server_id = server_id
+        self.arrived = arrived
+        self.service_time = service_time
+        self.request_size = request_size
+        self.response_size = response_size
+
+
+class DispatcherRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"
+
+    def do_POST(self):
+        dispatcher = self.server.dispatcher
+        arrived = time.time()
+        body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        compact_request = self.headers.getheader("Content-Type") == wire.CONTENT_TYPE
+        if compact_request and not dispatcher.compact:
+            self.send_error(415, "Compact messages aren't supported")
+            return
+        try:
+            if compact_request:
+                plain, signer = dispatcher.decrypt(body)
+                request = wire.decode(plain, self.headers.getheader(wire.ENCODING_HEADER, "json"))
+            else:
+                form = urlparse.parse_qs(body)
+                plain, signer = dispatcher.decrypt(b64decode(form["data"][0]))
+                request = json.loads(plain)
+            server_id = signer.split("@")[0] if signer else None
+            success, data, error = dispatcher.handle(server_id, request)
+            envelope = {"data": data, "error": error, "debug": None}
+            content_type = "application/json"
+            encoding = None
+            if signer and dispatcher.compact and self.headers.getheader(wire.WIRE_HEADER):
+                accepted = (self.headers.getheader(wire.ACCEPT_ENCODING_HEADER) or "json").split(",")
+                encoding = wire.default_encoding() if wire.default_encoding() in accepted else accepted[0]
+                payload, encoding = wire.encode(dict(envelope, success=success), encoding)
+                response_body = dispatcher.encrypt(payload, signer, armor=False)
+                content_type = wire.CONTENT_TYPE
+            else:
+                response = {"success": success, "response": None}
+                if signer:
+                    response["response"] = b64encode(dispatcher.encrypt(json.dumps(envelope), signer))
+                response_body = json.dumps(response)
+        except (KeyError, ValueError, DispatcherError, wire.WireFormatException) as err:
+            dispatcher.logger.error("Failed to process request: %s" % err)
+            self.send_error(400, str(err))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        if encoding:
+            self.send_header(wire.ENCODING_HEADER, encoding)
+        self.send_header("Content-Length", str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+        dispatcher.record(RequestRecord(request.get("type"), server_id, arrived, time.time() - arrived,
+                                        len(body), len(response_body)))
+
+    def log_message(self, fmt, *args):
+        self.server.dispatcher.logger.debug(fmt % args)
+
+
+class DispatcherHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeDispatcher(object):
+    """
+    HTTP server that emulates TwinDB dispatcher
+    """
+    def __init__(self, host="127.0.0.1", port=0, key_length=2048, server_config=None, plaintext=False,
+                 compact=False):
+        """
+        :param plaintext: if True the dispatcher doesn't use GPG. A request is expected to be
+            the signer's email on the first line followed by the request itself.
+            That's what tests.benchmarks.fleet.SimulatedGPG sends.
+        :param compact: if True the dispatcher supports compact wire format, see twindb_agent.wire
+        """
+        self.logger = logging.getLogger("twindb_dispatcher")
+        self.compact = compact
+        self.email = "api@twindb.com"
+        self.keyring = None
+        if not plaintext:
+            self.keyring = GPGKeyring()
+            self.keyring.gen_key(self.email, name="TwinDB dispatcher", key_length=key_length)
+        self.server_config = server_config or dict(fakes.SERVER_CONFIG)
+        self.requests = []
+        self.jobs = {}
+        self.backups = {}
+        # server_id -> start_scheduled of the next job, returned by get_job when there is no job yet
+        self.announcements = {}
+        self._lock = threading.Lock()
+        self._job_added = threading.Condition(self._lock)
+        self._job_id = 0
+        self._httpd = DispatcherHTTPServer((host, port), DispatcherRequestHandler)
+        self._httpd.dispatcher = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return "%s:%d" % self._httpd.server_address
+
+    @property
+    def pub_key(self):
+        return self.keyring.export(self.email)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-dispatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self.keyring:
+            self.keyring.destroy()
+
+    def add_agent(self, pub_key):
+        """
+        Registers agent public key so the dispatcher can verify requests and encrypt responses
+        """
+        self.keyring.import_key(pub_key)
+
+    def decrypt(self, msg):
+        """
+        :return: tuple (plain text request, email of the agent that sent it)
+        """
+        if self.keyring:
+            return self.keyring.decrypt(msg)
+        signer, plain = msg.split("\n", 1)
+        return plain, signer
+
+    def encrypt(self, msg, recipient, armor=True):
+        if self.keyring:
+            return self.keyring.encrypt(msg, recipient, armor=armor)
+        return msg
+
+    def record(self, record):
+        with self._lock:
+            self.requests.append(record)
+
+    def reset(self):
+        with self._lock:
+            self.requests = []
+
+    def add_job(self, server_id, job_type, params, start_scheduled=None):
+        """
+        Queues a job order for an agent
+        :return: job_id
+        """
+        with self._lock:
+            self._job_id += 1
+            job_order = {
+                "job_id": self._job_id,
+                "type": job_type,
+                "start_scheduled": start_scheduled or int(time.time()),
+                # The dispatcher sends params as a JSON string
+                "params": json.dumps(params)
+            }
+            self.jobs.setdefault(server_id, []).append(job_order)
+            self._job_added.notify_all()
+            return self._job_id
+
+    def announce(self, server_id, start_scheduled):
+        """
+        Tells the agent when its next job is scheduled
+        """
+        with self._lock:
+            self.announcements[server_id] = start_scheduled
+
+    def handle(self, server_id, request):
+        """
+        Processes decrypted request
+        :return: tuple (success, data, error)
+        """
+        request_type = request.get("type")
+        params = request.get("params") or {}
+        handler = getattr(self, "handle_%s" % request_type, None)
+        if not handler:
+            return False, None, "Unknown request type %s" % request_type
+        return handler(server_id, params)
+
+    def handle_get_job(self, server_id, params):
+        """
+        If params has "wait" the request is held until a job arrives or wait seconds pass
+        """
+        deadline = time.time() + float(params.get("wait", 0))
+        with self._lock:
+            while True:
+                queue = self.jobs.get(server_id)
+                if queue:
+                    return True, queue.pop(0), None
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                self._job_added.wait(timeout)
+            if self.announcements.get(server_id, 0) > time.time():
+                return True, {"next_start_scheduled": self.announcements[server_id]}, None
+        return True, None, None
+
+    def handle_get_config(self, server_id, params):
+        return True, dict(self.server_config), None
+
+    def handle_is_registered(self, server_id, params):
+        return True, {"registered": True}, None
+
+    def handle_register(self, server_id, params):
+        return True, None, None
+
+    def handle_confirm_registration(self, server_id, params):
+        return True, None, None
+
+    def handle_unregister(self, server_id, params):
+        return True, None, None
+
+    def handle_schedule_backup(self, server_id, params):
+        self.add_job(server_id, "backup", {"ancestor": 0, "backup_type": "full", "ip": "127.0.0.1",
+                                           "lsn": 0, "type": "full", "volume_id": 1})
+        return True, None, None
+
+    def handle_notify(self, server_id, params):
+        return True, None, None
+
+    def handle_log(self, server_id, params):
+        return True, None, None
+
+    def handle_report_sss(self, server_id, params):
+        return True, None, None
+
+    def handle_report_agent_privileges(self, server_id, params):
+        return True, None, None
+
+    def handle_report_metrics(self, server_id, params):
+        return True, None, None
+
+    def handle_update_backup_data(self, server_id, params):
+        with self._lock:
+            backups = self.backups.setdefault(server_id, [])
+            backups.append(dict(params, backup_copy_id=len(backups) + 1, full=not params.get("ancestor")))
+        return True, None, None
+
+    def handle_get_backups_chain(self, server_id, params):
+        chain = []
+        with self._lock:
+            for backup in self.backups.get(server_id, []):
+                if backup["full"]:
+                    chain = []
+                chain.append({"backup_copy_id": backup["backup_copy_id"], "name": backup["name"],
+                              "ip": "127.0.0.1", "full": backup["full"]})
+                if backup["backup_copy_id"] == params.get("backup_copy_id"):
+                    break
+        return True, chain, None
+
+    def handle_send_key(self, server_id, params):
+        return True, None, None
+
+
+class DispatcherError(Exception):
+    pass
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--host", help="Address to listen on [default: %default]", default="0.0.0.0")
+    parser.add_option("--port", help="Port to listen on [default: %default]", type="int", default=8080)
+    parser.add_option("--plaintext", help="Don't use GPG. Required by the fleet simulator",
+                      action="store_true", default=False)
+    parser.add_option("--compact", help="Support compact wire format", action="store_true", default=False)
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    dispatcher = FakeDispatcher(host=options.host, port=options.port, plaintext=options.plaintext,
+                                compact=options.compact)
+    dispatcher.logger.info("Listening on %s" % dispatcher.address)
+    try:
+        dispatcher._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+In-process stand-ins for MySQL and the dispatcher API used by the benchmarks
+"""
+import random
+
+SERVER_CONFIG = {
+    "mysql_user": "twindb_agent",
+    "mysql_password": "bench",
+    "user_id": 1
+}
+
+
+class FakeCursor(object):
+    def __init__(self, dictionary=False):
+        self.dictionary = dictionary
+        self.rows = []
+
+    def execute(self, query, params=None):
+        query = query.upper()
+        if "@@DATADIR" in query:
+            self.rows = [("/var/lib/mysql/",)]
+        elif "CURRENT_USER" in query:
+            self.rows = [{"curr_user": "%s@localhost" % SERVER_CONFIG["mysql_user"]}]
+        elif "PRIVILEGE" in query:
+            privileges = ["RELOAD", "SUPER", "LOCK TABLES", "REPLICATION CLIENT", "CREATE TABLESPACE"]
+            if self.dictionary:
+                self.rows = [{u"privilege_type": p, u"is_grantable": "NO"} for p in privileges]
+            else:
+                self.rows = [(p,) for p in privileges]
+        else:
+            self.rows = []
+
+    def fetchone(self):
+        if self.rows:
+            return self.rows.pop(0)
+        return None
+
+    def __iter__(self):
+        rows, self.rows = self.rows, []
+        return iter(rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    user = SERVER_CONFIG["mysql_user"]
+
+    def cursor(self, dictionary=False):
+        return FakeCursor(dictionary=dictionary)
+
+    def close(self):
+        pass
+
+
+class FakeMySQL(object):
+    """
+    Replaces twindb_agent.twindb_mysql.MySQL. Slave status is simulated
+    """
+    def __init__(self, mysql_user=None, mysql_password=None, logger_name="twindb_remote"):
+        self.mysql_user = mysql_user
+        self.mysql_password = mysql_password
+
+    def get_mysql_connection(self):
+        return FakeConnection()
+
+    @staticmethod
+    def get_unix_socket():
+        return "/var/lib/mysql/mysql.sock"
+
+    @staticmethod
+    def get_slave_status():
+        return {
+            "mysql_server_id": random.randint(1, 2 ** 31),
+            "mysql_master_server_id": 1,
+            "mysql_master_host": "master.example.com",
+            "mysql_seconds_behind_master": random.randint(0, 5),
+            "mysql_slave_io_running": "Yes",
+            "mysql_slave_sql_running": "Yes"
+        }
+
+    @staticmethod
+    def get_privileges(conn):
+        privileges = ["RELOAD", "SUPER", "LOCK TABLES", "REPLICATION CLIENT", "CREATE TABLESPACE"]
+        return {
+            "user": "%s@localhost" % SERVER_CONFIG["mysql_user"],
+            "privileges": dict((p, "NO") for p in privileges),
+            "mysql_privileges": []
+        }
+
+    @staticmethod
+    def has_mysql_access(grant_capability=True):
+        return True, []
+
+
+class FakeAPI(object):
+    """
+    Replaces twindb_agent.api.TwinDBAPI. Every call succeeds and is recorded in FakeAPI.calls
+    """
+    calls = []
+
+    def __init__(self, logger_name="twindb_remote"):
+        self.success = None
+        self.delivered = False
+        self.spooled = False
+        self.data = None
+        self.error = None
+        self.debug = None
+
+    def call(self, data, spool=False):
+        FakeAPI.calls.append(data)
+        self.success = True
+        self.delivered = True
+        if data["type"] == "get_config":
+            self.data = dict(SERVER_CONFIG)
+        else:
+            self.data = {}
+        return self.data
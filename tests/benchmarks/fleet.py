@@ -0,0 +1,335 @@
+"""
+Fleet simulator for dispatcher load testing
+
+Runs many lightweight SimulatedAgent instances in one process. Every agent has
+its own server_id and simulated MySQL status, and runs the regular Agent.run_cycle() and
+Agent.report() in a thread, sleeping Agent.poll_interval() between cycles like the agent's event loop does.
+Requests go through the regular handlers and TwinDBHTTPClient, only GPG is replaced
+by SimulatedGPG, so the dispatcher must run in plaintext mode.
+
+The simulator reports request rate, latency percentiles and burstiness of the load.
+
+Usage:
+    python -m tests.benchmarks.fleet --agents 500 --period 10 --duration 60
+    python -m tests.benchmarks.dispatcher --port 8080 --plaintext    # on another host
+    python -m tests.benchmarks.fleet --dispatcher 10.0.0.5:8080 --agents 2000
+    python -m tests.benchmarks.fleet --agents 500 --jitter 0 --long-poll 30
+"""
+from __future__ import print_function
+import json
+import logging
+import math
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from base64 import b64decode, b64encode
+
+import twindb_agent.agent
+import twindb_agent.config
+import twindb_agent.gpg
+import twindb_agent.handlers
+import twindb_agent.httpclient
+import twindb_agent.scheduler
+import twindb_agent.spool
+import twindb_agent.twindb_mysql
+
+from tests.benchmarks import fakes
+from tests.benchmarks.api import percentile
+from tests.benchmarks.dispatcher import FakeDispatcher
+
+_local = threading.local()
+
+
+def _thread_config(*args, **kwargs):
+    """
+    Replaces AgentConfig.get_config() so every simulated agent sees its own config
+    """
+    return _local.config
+
+
+class SimulatedGPG(object):
+    """
+    Replaces TwinDBGPG. Messages are not encrypted, the sender's email
+    is prepended to a request instead of a signature
+    """
+    def __init__(self, logger_name="twindb_local"):
+        self.config = twindb_agent.config.AgentConfig.get_config()
+
+    def encrypt(self, msg, armor=True, compress=True):
+        msg = "%s@twindb.com\n%s" % (self.config.server_id, msg)
+        return b64encode(msg) if armor else msg
+
+    @staticmethod
+    def decrypt(msg_64, armored=True):
+        if not msg_64:
+            return None
+        return b64decode(msg_64) if armored else msg_64
+
+
+class SimulatedAgent(twindb_agent.agent.Agent):
+    """
+    Agent that runs reports in its own thread and simulates jobs with start and stop notifications
+    """
+    def __init__(self, config):
+        self.config = config
+        self.logger = logging.getLogger("twindb_remote")
+        self.gpg = None
+        self.registered = False
+        self.job_proc = None
+        self.job = None
+        self.paused_job = None
+        self.background_jobs = {}
+        self.reconciled = True
+        self.scheduler = twindb_agent.scheduler.JobScheduler()
+        self.poll = self.get_poll_scheduler(config)
+        # The spool reads the thread's config, so it's created in the agent thread
+        self.spool = None
+
+    @staticmethod
+    def spawn(target, name):
+        target()
+
+    def run_job(self, job_order):
+        job_id = int(job_order["job_id"])
+        twindb_agent.handlers.log_job_notify(params={"event": "start_job", "job_id": job_id, "pid": os.getpid()})
+        twindb_agent.handlers.log_job_notify(params={"event": "stop_job", "job_id": job_id, "ret_code": 0})
+
+
+class RequestLog(object):
+    """
+    Records type, start time and latency of every request the fleet sends
+    """
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+        self._saved = None
+
+    def install(self):
+        get_response = twindb_agent.httpclient.TwinDBHTTPClient.get_response
+        request_log = self
+
+        def wrapper(client, request):
+            started = time.time()
+            response = get_response(client, request)
+            request_log.add(request["type"], started, time.time() - started, response is not None)
+            return response
+        self._saved = get_response
+        twindb_agent.httpclient.TwinDBHTTPClient.get_response = wrapper
+
+    def uninstall(self):
+        twindb_agent.httpclient.TwinDBHTTPClient.get_response = self._saved
+
+    def add(self, request_type, started, latency, success):
+        with self._lock:
+            self.records.append((request_type, started, latency, success))
+
+
+def analyze(records, started, duration):
+    """
+    Computes rate, burstiness and latency statistics
+    :param records: list of (request type, start time, latency, success) tuples
+    :return: dictionary with statistics
+    """
+    buckets = [0] * max(1, int(math.ceil(duration)))
+    latencies = []
+    by_type = {}
+    failures = 0
+    for request_type, t, latency, success in records:
+        second = int(t - started)
+        if 0 <= second < len(buckets):
+            buckets[second] += 1
+        latencies.append(latency)
+        by_type.setdefault(request_type, []).append(latency)
+        if not success:
+            failures += 1
+    mean = float(sum(buckets)) / len(buckets)
+    stddev = math.sqrt(sum((b - mean) ** 2 for b in buckets) / len(buckets))
+    return {
+        "requests": len(records),
+        "failures": failures,
+        "rate": len(records) / duration if duration else 0.0,
+        "peak_rate": max(buckets),
+        "burstiness": max(buckets) / mean if mean else 0.0,
+        "rate_cv": stddev / mean if mean else 0.0,
+        "per_second": buckets,
+        "latency_ms": dict(("p%d" % p, percentile(latencies, p) * 1000) for p in [50, 90, 99]),
+        "max_latency_ms": max(latencies) * 1000 if latencies else 0.0,
+        "types": dict((t, {"requests": len(l), "p99_ms": percentile(l, 99) * 1000}) for t, l in by_type.items())
+    }
+
+
+class FleetSimulator(object):
+    def __init__(self, agents=100, check_period=60, duration=120, start_spread=0.0, dispatcher=None,
+                 jitter=None, long_poll=0):
+        """
+        :param agents: number of simulated agents
+        :param check_period: check_period of every agent
+        :param jitter: check_period_jitter of every agent. The agent default is used if None
+        :param long_poll: long_poll of every agent
+        :param duration: how long to run the simulation in seconds
+        :param start_spread: agents start at random moments within start_spread seconds.
+            Zero means all agents start together, like after a config management run
+        :param dispatcher: host:port of a plaintext dispatcher. A local FakeDispatcher is started if None
+        """
+        self.agents = agents
+        self.check_period = check_period
+        self.duration = duration
+        self.start_spread = start_spread
+        self.dispatcher_address = dispatcher
+        self.jitter = jitter
+        self.long_poll = long_poll
+        self.dispatcher = None
+        self.workdir = None
+        self.errors = 0
+        self._saved = []
+        self._lock = threading.Lock()
+
+    def _patch(self, obj, attr, value):
+        self._saved.append((obj, attr, obj.__dict__[attr]))
+        setattr(obj, attr, value)
+
+    def setup(self):
+        self.workdir = tempfile.mkdtemp(prefix="twindb-fleet.")
+        os.mkdir(os.path.join(self.workdir, "gnupg"), 0700)
+        if not self.dispatcher_address:
+            self.dispatcher = FakeDispatcher(plaintext=True)
+            self.dispatcher.start()
+            self.dispatcher_address = self.dispatcher.address
+        self._patch(twindb_agent.config.AgentConfig, "get_config", staticmethod(_thread_config))
+        self._patch(twindb_agent.gpg, "TwinDBGPG", SimulatedGPG)
+        self._patch(twindb_agent.twindb_mysql, "MySQL", fakes.FakeMySQL)
+        # Every real agent has its own circuit breaker. The simulated fleet shares one
+        self._patch(twindb_agent.httpclient, "_breaker", twindb_agent.httpclient.CircuitBreaker())
+        for name in ["twindb_remote", "twindb_local", "twindb_console"]:
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+    def teardown(self):
+        for obj, attr, value in reversed(self._saved):
+            setattr(obj, attr, value)
+        self._saved = []
+        if self.dispatcher:
+            self.dispatcher.stop()
+            self.dispatcher = None
+            self.dispatcher_address = None
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            self.workdir = None
+
+    def make_agent(self):
+        config = twindb_agent.config.AgentConfig(api_host=self.dispatcher_address,
+                                                 check_period=self.check_period,
+                                                 gpg_homedir=os.path.join(self.workdir, "gnupg"))
+        config.long_poll = self.long_poll
+        if self.jitter is not None:
+            config.check_period_jitter = self.jitter
+        config.server_id = str(uuid.uuid4())
+        config.spool_dir = os.path.join(self.workdir, "spool", config.server_id)
+        config.job_journal_dir = os.path.join(self.workdir, "jobs", config.server_id)
+        config.config_cache_file = os.path.join(self.workdir, "config", "%s.json" % config.server_id)
+        config.registration_cache_file = os.path.join(self.workdir, "registration", "%s.json" % config.server_id)
+        return SimulatedAgent(config)
+
+    def _run_agent(self, agent, deadline, start_delay):
+        _local.config = agent.config
+        agent.spool = twindb_agent.spool.Spool()
+        time.sleep(start_delay)
+        while time.time() < deadline:
+            try:
+                agent.replay_spool()
+                agent.run_cycle()
+                job_order = agent.scheduler.pop_due()
+                if job_order:
+                    agent.run_job(job_order)
+                agent.report()
+            except Exception as err:
+                with self._lock:
+                    self.errors += 1
+                logging.getLogger("twindb_fleet").error("Agent %s failed: %r" % (agent.config.server_id, err))
+            time.sleep(max(0.0, min(agent.poll_interval(), deadline - time.time())))
+
+    def run(self):
+        """
+        Runs the fleet for self.duration seconds
+        :return: dictionary with load statistics
+        """
+        self.setup()
+        request_log = RequestLog()
+        request_log.install()
+        threading.stack_size(512 * 1024)
+        try:
+            agents = [self.make_agent() for i in range(self.agents)]
+            started = time.time()
+            deadline = started + self.duration
+            threads = []
+            for agent in agents:
+                t = threading.Thread(target=self._run_agent,
+                                     args=(agent, deadline, random.uniform(0, self.start_spread)),
+                                     name="agent-%s" % agent.config.server_id)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+            result = analyze(request_log.records, started, self.duration)
+            result["agents"] = self.agents
+            result["errors"] = self.errors
+            return result
+        finally:
+            threading.stack_size(0)
+            request_log.uninstall()
+            self.teardown()
+
+
+def format_report(result):
+    lines = [
+        "Agents: %d, requests: %d, failures: %d, agent errors: %d"
+        % (result["agents"], result["requests"], result["failures"], result["errors"]),
+        "Rate: %.2f req/s, peak %d req/s, burstiness (peak/mean) %.2f, CV %.2f"
+        % (result["rate"], result["peak_rate"], result["burstiness"], result["rate_cv"]),
+        "Latency: p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms"
+        % (result["latency_ms"]["p50"], result["latency_ms"]["p90"], result["latency_ms"]["p99"],
+           result["max_latency_ms"]),
+        ""
+    ]
+    for request_type in sorted(result["types"]):
+        t = result["types"][request_type]
+        lines.append("    %-26s %8d requests, p99 %.1f ms" % (request_type, t["requests"], t["p99_ms"]))
+    return "\n".join(lines)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--agents", help="Number of agents [default: %default]", type="int", default=100)
+    parser.add_option("--period", help="check_period of agents [default: %default]", type="int", default=60)
+    parser.add_option("--duration", help="Simulation time in seconds [default: %default]", type="int",
+                      default=180)
+    parser.add_option("--start-spread", help="Agents start within this many seconds [default: %default]",
+                      type="float", default=0.0)
+    parser.add_option("--dispatcher", help="host:port of a plaintext dispatcher. "
+                                           "By default a local one is started")
+    parser.add_option("--jitter", help="check_period_jitter of agents. By default the agent default is used",
+                      type="float")
+    parser.add_option("--long-poll", help="long_poll of agents [default: %default]", type="int", default=0)
+    parser.add_option("--json", help="Print results in JSON", action="store_true", default=False)
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    simulator = FleetSimulator(agents=options.agents, check_period=options.period, duration=options.duration,
+                               start_spread=options.start_spread, dispatcher=options.dispatcher,
+                               jitter=options.jitter, long_poll=options.long_poll)
+    result = simulator.run()
+    if options.json:
+        print(json.dumps(result, indent=4, sort_keys=True))
+    else:
+        print(format_report(result))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,284 @@
+"""
+Backup pipeline benchmark
+
+Drives take_backup_xtrabackup() and Restore.extract_archive() against stand-in
+innobackupex, xbstream, gpg and ssh executables from tests/benchmarks/bin.
+Reports MB/s, CPU and RSS of every pipeline stage and compares them with a stored baseline.
+
+Usage:
+    python -m tests.benchmarks.pipeline --volume 256 --rate gpg=100
+    python -m tests.benchmarks.pipeline --save-baseline
+"""
+from __future__ import print_function
+import glob
+import json
+import logging
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import twindb_agent.api
+import twindb_agent.config
+import twindb_agent.handlers
+import twindb_agent.job_type.backup
+import twindb_agent.job_type.restore
+import twindb_agent.twindb_mysql
+
+from tests.benchmarks import fakes
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_TOLERANCE = 0.15
+MB = 1024.0 * 1024.0
+
+
+class PipelineBenchmark(object):
+    def __init__(self, volume=64 * 1024 * 1024, rates=None):
+        """
+        :param volume: number of bytes innobackupex stand-in generates
+        :param rates: dictionary stage name -> throughput limit in MB/s
+        """
+        self.volume = volume
+        self.rates = rates or {}
+        self.workdir = None
+        self._saved_attrs = []
+        self._saved_env = {}
+
+    def _patch(self, obj, attr, value):
+        self._saved_attrs.append((obj, attr, getattr(obj, attr)))
+        setattr(obj, attr, value)
+
+    def _setenv(self, name, value):
+        self._saved_env[name] = os.environ.get(name)
+        os.environ[name] = value
+
+    def setup(self):
+        self.workdir = tempfile.mkdtemp(prefix="twindb-bench.")
+        for d in ["storage", "restore", "stats", "gnupg"]:
+            os.mkdir(os.path.join(self.workdir, d))
+
+        config = twindb_agent.config.AgentConfig(gpg_homedir=os.path.join(self.workdir, "gnupg"),
+                                                 ssh_private_key_file=os.path.join(self.workdir, "twindb.key"))
+        self._patch(twindb_agent.config.AgentConfig, "_instance", config)
+        self._patch(twindb_agent.handlers, "get_config", lambda: dict(fakes.SERVER_CONFIG))
+        self._patch(twindb_agent.job_type.backup, "get_config", lambda: dict(fakes.SERVER_CONFIG))
+        self._patch(twindb_agent.twindb_mysql, "MySQL", fakes.FakeMySQL)
+        self._patch(twindb_agent.api, "TwinDBAPI", fakes.FakeAPI)
+
+        self._setenv("PATH", BIN_DIR + os.pathsep + os.environ.get("PATH", ""))
+        self._setenv("TWINDB_BENCH_VOLUME", str(self.volume))
+        self._setenv("TWINDB_BENCH_STORAGE", os.path.join(self.workdir, "storage"))
+        for stage, rate in self.rates.items():
+            self._setenv("TWINDB_BENCH_RATE_%s" % stage.upper(), str(rate))
+
+    def teardown(self):
+        for obj, attr, value in reversed(self._saved_attrs):
+            setattr(obj, attr, value)
+        self._saved_attrs = []
+        for name, value in self._saved_env.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+        self._saved_env = {}
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            self.workdir = None
+
+    def _measure(self, name, func):
+        """
+        Runs func and collects statistics of the agent process and every stand-in it started
+        :return: tuple (what func returned, dictionary with statistics)
+        """
+        stats_dir = os.path.join(self.workdir, "stats", name)
+        os.mkdir(stats_dir)
+        self._setenv("TWINDB_BENCH_STATS_DIR", stats_dir)
+
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.time()
+        ret = func()
+        wall = time.time() - started
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+        stages = {}
+        for stats_file in glob.glob(os.path.join(stats_dir, "*.json")):
+            with open(stats_file) as f:
+                s = json.load(f)
+            moved = max(s["bytes_in"], s["bytes_out"])
+            if not moved:
+                # Auxiliary calls like "ssh du -b" don't move data
+                continue
+            stages[s["stage"]] = {
+                "bytes": moved,
+                "wall": s["wall"],
+                "mb_per_sec": moved / MB / s["wall"] if s["wall"] else 0.0,
+                "cpu": s["utime"] + s["stime"],
+                "cpu_per_gb": (s["utime"] + s["stime"]) / (moved / MB / 1024),
+                "maxrss_kb": s["maxrss_kb"]
+            }
+        result = {
+            "wall": wall,
+            "mb_per_sec": self.volume / MB / wall if wall else 0.0,
+            "agent_cpu": (usage_after.ru_utime - usage_before.ru_utime +
+                          usage_after.ru_stime - usage_before.ru_stime),
+            "agent_maxrss_kb": usage_after.ru_maxrss,
+            "stages": stages
+        }
+        return ret, result
+
+    def run_backup(self):
+        job_order = {
+            "job_id": 1,
+            "type": "backup",
+            "params": {
+                "ancestor": 0,
+                "backup_type": "full",
+                "ip": "127.0.0.1",
+                "lsn": 0,
+                "type": "full",
+                "volume_id": 1
+            }
+        }
+        ret, result = self._measure("backup",
+                                    lambda: twindb_agent.job_type.backup.take_backup_xtrabackup(job_order,
+                                                                                                "twindb_remote"))
+        if ret != 0:
+            raise BenchmarkError("take_backup_xtrabackup() returned %r" % ret)
+        return result
+
+    def run_restore(self):
+        backups = os.listdir(os.path.join(self.workdir, "storage"))
+        if len(backups) != 1:
+            raise BenchmarkError("Expected one backup copy in the storage, found %r" % backups)
+        restore = twindb_agent.job_type.restore.Restore({"job_id": 2, "params": {}})
+        arc = {"backup_copy_id": 1, "name": backups[0], "ip": "127.0.0.1"}
+        ret, result = self._measure("restore",
+                                    lambda: restore.extract_archive(arc, os.path.join(self.workdir, "restore")))
+        if not ret:
+            raise BenchmarkError("Restore.extract_archive() failed")
+        return result
+
+    def run(self):
+        """
+        Takes a backup and restores it
+        :return: dictionary with statistics of backup and restore runs
+        """
+        self.setup()
+        try:
+            return {
+                "volume": self.volume,
+                "rates": self.rates,
+                "backup": self.run_backup(),
+                "restore": self.run_restore()
+            }
+        finally:
+            self.teardown()
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares benchmark results with a baseline
+    :return: list of strings that describe regressions. Empty list if there are none
+    """
+    regressions = []
+
+    def check(what, value, base, higher_is_better):
+        if not base:
+            return
+        if higher_is_better and value < base * (1 - tolerance):
+            regressions.append("%s dropped from %.2f to %.2f" % (what, base, value))
+        if not higher_is_better and value > base * (1 + tolerance):
+            regressions.append("%s grew from %.2f to %.2f" % (what, base, value))
+
+    for run in ["backup", "restore"]:
+        if run not in baseline:
+            continue
+        check("%s MB/s" % run, results[run]["mb_per_sec"], baseline[run]["mb_per_sec"], True)
+        check("%s agent CPU" % run, results[run]["agent_cpu"], baseline[run]["agent_cpu"], False)
+        for stage, s in results[run]["stages"].items():
+            base = baseline[run]["stages"].get(stage)
+            if not base:
+                continue
+            check("%s/%s MB/s" % (run, stage), s["mb_per_sec"], base["mb_per_sec"], True)
+            check("%s/%s CPU s/GB" % (run, stage), s["cpu_per_gb"], base["cpu_per_gb"], False)
+            check("%s/%s RSS kB" % (run, stage), s["maxrss_kb"], base["maxrss_kb"], False)
+    return regressions
+
+
+def format_report(results):
+    lines = ["Volume: %.0f MB" % (results["volume"] / MB)]
+    fmt = "    %-14s %10s %10s %10s %12s"
+    for run in ["backup", "restore"]:
+        r = results[run]
+        lines.append("")
+        lines.append("%s: %.2f s, %.2f MB/s, agent CPU %.2f s, agent RSS %d kB"
+                     % (run, r["wall"], r["mb_per_sec"], r["agent_cpu"], r["agent_maxrss_kb"]))
+        lines.append(fmt % ("stage", "MB/s", "CPU s", "CPU s/GB", "RSS kB"))
+        for stage in sorted(r["stages"]):
+            s = r["stages"][stage]
+            lines.append(fmt % (stage, "%.2f" % s["mb_per_sec"], "%.2f" % s["cpu"],
+                                "%.2f" % s["cpu_per_gb"], s["maxrss_kb"]))
+    return "\n".join(lines)
+
+
+def parse_rates(rates):
+    """
+    Parses list of stage=MB/s pairs
+    """
+    result = {}
+    for item in rates:
+        stage, rate = item.split("=", 1)
+        result[stage] = float(rate)
+    return result
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--volume", help="Backup size in megabytes [default: %default]", type="int", default=64)
+    parser.add_option("--rate", help="Throughput limit of a stage in MB/s, e.g. gpg=100. Can be repeated",
+                      action="append", default=[], metavar="STAGE=RATE")
+    parser.add_option("--baseline", help="Baseline file [default: %default]", default=DEFAULT_BASELINE)
+    parser.add_option("--tolerance", help="Allowed deviation from the baseline [default: %default]",
+                      type="float", default=DEFAULT_TOLERANCE)
+    parser.add_option("--save-baseline", help="Save results as the new baseline", action="store_true",
+                      default=False)
+    parser.add_option("--json", help="Print results in JSON", action="store_true", default=False)
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    benchmark = PipelineBenchmark(volume=options.volume * 1024 * 1024, rates=parse_rates(options.rate))
+    results = benchmark.run()
+    if options.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+    else:
+        print(format_report(results))
+
+    if options.save_baseline:
+        with open(options.baseline, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+        print("Saved baseline in %s" % options.baseline)
+        return 0
+
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print("\nRegressions against %s:" % options.baseline)
+            for r in regressions:
+                print("  " + r)
+            return 1
+        print("\nNo regressions against %s" % options.baseline)
+    return 0
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""
+Stand-in implementations of innobackupex, xbstream, gpg and ssh
+
+The executables in tests/benchmarks/bin call main() with their own name.
+They move data at a configurable rate and write resource usage of the stage
+to TWINDB_BENCH_STATS_DIR when they exit.
+
+Environment variables:
+    TWINDB_BENCH_VOLUME         - bytes generated by innobackupex (default 64MB)
+    TWINDB_BENCH_RATE_<STAGE>   - throughput limit of a stage in MB/s, 0 is unlimited
+    TWINDB_BENCH_STATS_DIR      - directory to save stage statistics in
+    TWINDB_BENCH_STORAGE        - directory that plays a role of TwinDB storage
+
+This module must run on Python 2 and 3 because it is started by whatever
+"python" is first in PATH.
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+BLOCK_SIZE = 1024 * 1024
+DEFAULT_VOLUME = 64 * 1024 * 1024
+LSN = "1626007"
+
+
+def _stdin():
+    return getattr(sys.stdin, "buffer", sys.stdin)
+
+
+def _stdout():
+    return getattr(sys.stdout, "buffer", sys.stdout)
+
+
+class Throttle(object):
+    """
+    Sleeps enough to keep throughput of a stage under the given rate
+    """
+    def __init__(self, rate_mb):
+        self.rate = float(rate_mb) * 1024 * 1024
+        self.start = time.time()
+        self.bytes = 0
+
+    def consume(self, size):
+        self.bytes += size
+        if self.rate <= 0:
+            return
+        ahead = self.bytes / self.rate - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class Stage(object):
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.throttle = Throttle(os.environ.get("TWINDB_BENCH_RATE_%s" % name.upper(), 0))
+
+    def copy(self, src, dst):
+        """
+        Copies src file object to dst at the stage rate
+        """
+        while True:
+            block = src.read(BLOCK_SIZE)
+            if not block:
+                break
+            self.bytes_in += len(block)
+            if dst:
+                dst.write(block)
+                self.bytes_out += len(block)
+            self.throttle.consume(len(block))
+        if dst:
+            dst.flush()
+
+    def generate(self, dst, volume):
+        """
+        Writes volume bytes to dst at the stage rate
+        """
+        block = os.urandom(BLOCK_SIZE)
+        left = volume
+        while left > 0:
+            chunk = block[:min(left, BLOCK_SIZE)]
+            dst.write(chunk)
+            self.bytes_out += len(chunk)
+            left -= len(chunk)
+            self.throttle.consume(len(chunk))
+        dst.flush()
+
+    def save_stats(self, **extra):
+        stats_dir = os.environ.get("TWINDB_BENCH_STATS_DIR")
+        if not stats_dir:
+            return
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        stats = {
+            "stage": self.name,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "wall": time.time() - self.started,
+            "utime": usage.ru_utime,
+            "stime": usage.ru_stime,
+            "maxrss_kb": usage.ru_maxrss
+        }
+        stats.update(extra)
+        with open(os.path.join(stats_dir, "%s.%d.json" % (self.name, os.getpid())), "w") as f:
+            json.dump(stats, f)
+
+
+def innobackupex(stage, args):
+    if "--apply-log" in args:
+        return 0
+    stage.generate(_stdout(), int(os.environ.get("TWINDB_BENCH_VOLUME", DEFAULT_VOLUME)))
+    sys.stderr.write("xtrabackup: The latest check point (for incremental): '%s'\n" % LSN)
+    sys.stderr.write("innobackupex: completed OK!\n")
+    return 0
+
+
+def xbstream(stage, args):
+    if "-x" not in args:
+        return 2
+    stage.copy(_stdin(), None)
+    return 0
+
+
+def gpg(stage, args):
+    if "--encrypt" in args or "--decrypt" in args or "-d" in args:
+        stage.copy(_stdin(), _stdout())
+    return 0
+
+
+def ssh(stage, args):
+    storage = os.environ.get("TWINDB_BENCH_STORAGE", ".")
+    remote_cmd = args[-1].split()
+    if remote_cmd[:3] == ["/bin/cat", "-", ">"]:
+        with open(os.path.join(storage, os.path.basename(remote_cmd[3])), "wb") as f:
+            stage.copy(_stdin(), f)
+        return 0
+    if remote_cmd[0] == "/bin/cat":
+        with open(os.path.join(storage, os.path.basename(remote_cmd[1])), "rb") as f:
+            stage.copy(f, _stdout())
+        return 0
+    return subprocess.call(args[-1], shell=True, cwd=storage)
+
+
+def main(name):
+    stage = Stage(name)
+    ret = globals()[name](stage, sys.argv[1:])
+    stage.save_stats(args=sys.argv[1:])
+    return ret
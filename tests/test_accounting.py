@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_accounting
+----------------------------------
+
+Tests for `twindb_agent.accounting` module.
+"""
+
+import os
+import subprocess
+import unittest
+
+from twindb_agent import accounting
+
+
+class TestJobAccount(unittest.TestCase):
+
+    def test_pipeline(self):
+        account = accounting.JobAccount("backup")
+        devnull = open(os.devnull, "w")
+        p1 = subprocess.Popen(["head", "-c", "1000000", "/dev/zero"], stdout=subprocess.PIPE)
+        p2 = subprocess.Popen(["cat"], stdin=p1.stdout, stdout=devnull)
+        p1.stdout.close()
+        self.assertEqual(account.wait(p1, "head"), 0)
+        self.assertEqual(account.wait(p2, "cat", network="sent"), 0)
+        devnull.close()
+        self.assertEqual([s["stage"] for s in account.stages], ["head", "cat"])
+        if accounting.read_proc_io() is not None:
+            self.assertTrue(account.stages[1]["rchar"] >= 1000000)
+            self.assertTrue(account.summary()["network_bytes_sent"] >= 1000000)
+            # I/O of reaped stages is included into the job's I/O
+            self.assertTrue(account.summary()["wchar"] >= 2000000)
+        self.assertTrue(account.stages[1]["max_rss"] > 0)
+
+    def test_exit_code(self):
+        account = accounting.JobAccount()
+        proc = subprocess.Popen(["sh", "-c", "exit 3"])
+        self.assertEqual(account.wait(proc, "sh"), 3)
+        self.assertEqual(proc.returncode, 3)
+        proc = subprocess.Popen(["sh", "-c", "kill -9 $$"])
+        self.assertEqual(account.wait(proc, "sh"), -9)
+
+    def test_summary(self):
+        summary = accounting.JobAccount().summary()
+        for key in ["wall_time", "cpu_user", "cpu_sys", "max_rss", "network_bytes_sent", "stages"]:
+            self.assertIn(key, summary)
+
+if __name__ == '__main__':
+    unittest.main()
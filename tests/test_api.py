@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_api
+----------------------------------
+
+Tests for `twindb_agent.api` module.
+"""
+
+import json
+import logging
+import unittest
+from base64 import b64encode
+
+import twindb_agent.api
+import twindb_agent.config
+import twindb_agent.gpg
+import twindb_agent.utils
+
+from tests.benchmarks.fleet import SimulatedGPG
+
+
+class StubHTTPClient(object):
+    def __init__(self, response_body):
+        self.response_body = response_body
+        self.response_encoding = None
+
+    def get_response(self, request):
+        return self.response_body
+
+
+def no_str(obj):
+    raise AssertionError("Debug message is formatted at INFO level")
+
+
+class TestTwinDBAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = [(twindb_agent.config.AgentConfig, "_instance", twindb_agent.config.AgentConfig._instance),
+                      (twindb_agent.gpg, "TwinDBGPG", twindb_agent.gpg.TwinDBGPG)]
+        twindb_agent.config.AgentConfig._instance = twindb_agent.config.AgentConfig()
+        twindb_agent.gpg.TwinDBGPG = SimulatedGPG
+        self.logger = logging.getLogger("twindb_remote")
+        self.saved_level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        for obj, attr, value in self.saved:
+            setattr(obj, attr, value)
+        self.logger.setLevel(self.saved_level)
+
+    def call(self, response_body):
+        api = twindb_agent.api.TwinDBAPI()
+        api.http = StubHTTPClient(response_body)
+        return api, api.call({"type": "get_config", "params": {}})
+
+    def test_legacy_response(self):
+        envelope = json.dumps({"data": {"mysql_user": "root"}, "error": None, "debug": "ok"})
+        api, data = self.call(json.dumps({"success": True, "response": b64encode(envelope)}))
+        self.assertTrue(api.success)
+        self.assertEqual(data, {"mysql_user": "root"})
+        self.assertEqual(api.envelope.debug, "ok")
+
+    def test_no_response(self):
+        api, data = self.call(json.dumps({"success": False, "response": None}))
+        self.assertFalse(api.success)
+        self.assertEqual(data, None)
+
+    def test_broken_response(self):
+        api, data = self.call("<html>Internal error</html>")
+        self.assertFalse(api.success)
+        self.assertTrue(api.delivered)
+
+    def test_lazy_debug(self):
+        saved = twindb_agent.utils.LazyJSON.__str__
+        twindb_agent.utils.LazyJSON.__str__ = no_str
+        try:
+            envelope = json.dumps({"data": {}, "error": None, "debug": None})
+            api, data = self.call(json.dumps({"success": True, "response": b64encode(envelope)}))
+            self.assertTrue(api.success)
+        finally:
+            twindb_agent.utils.LazyJSON.__str__ = saved
+
+    def test_lazy_json(self):
+        self.assertEqual(str(twindb_agent.utils.LazyJSON('{"b": 1, "a": 2}')), '{\n    "a": 2, \n    "b": 1\n}')
+        self.assertEqual(str(twindb_agent.utils.LazyJSON("not json")), "not json")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_benchmarks
+----------------------------------
+
+Tests for the benchmark harnesses.
+"""
+
+import copy
+import unittest
+
+from tests.benchmarks import api
+from tests.benchmarks import fleet
+from tests.benchmarks import pipeline
+
+
+class TestPipelineBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.benchmark = pipeline.PipelineBenchmark(volume=4 * 1024 * 1024)
+
+    def test_run(self):
+        results = self.benchmark.run()
+        self.assertEqual(sorted(results["backup"]["stages"]), ["gpg", "innobackupex", "ssh"])
+        self.assertEqual(sorted(results["restore"]["stages"]), ["gpg", "ssh", "xbstream"])
+        for stage in results["backup"]["stages"].values():
+            self.assertEqual(stage["bytes"], 4 * 1024 * 1024)
+        self.assertEqual(pipeline.compare(results, results), [])
+
+    def test_compare_flags_regression(self):
+        results = self.benchmark.run()
+        baseline = copy.deepcopy(results)
+        baseline["backup"]["stages"]["gpg"]["mb_per_sec"] = results["backup"]["stages"]["gpg"]["mb_per_sec"] * 2
+        regressions = pipeline.compare(results, baseline)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("backup/gpg MB/s"))
+
+    def test_parse_rates(self):
+        self.assertEqual(pipeline.parse_rates(["gpg=100", "ssh=12.5"]), {"gpg": 100.0, "ssh": 12.5})
+
+
+class TestApiBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        benchmark = api.ApiBenchmark(calls=2, types=["get_config", "log"], key_length=1024)
+        results = benchmark.run()
+        self.assertEqual(sorted(results), ["get_config", "log"])
+        for r in results.values():
+            self.assertEqual(r["failures"], 0)
+            self.assertTrue(r["calls_per_sec"] > 0)
+
+    def test_compact(self):
+        benchmark = api.ApiBenchmark(calls=2, types=["get_config", "notify"], key_length=1024, compact=True)
+        results = benchmark.run()
+        for r in results.values():
+            self.assertEqual(r["failures"], 0)
+            self.assertTrue(r["request_bytes"] > 0)
+
+    def test_percentile(self):
+        self.assertEqual(api.percentile([3, 1, 2], 50), 2)
+        self.assertEqual(api.percentile([], 95), 0.0)
+
+
+class TestFleetSimulator(unittest.TestCase):
+
+    def test_run(self):
+        simulator = fleet.FleetSimulator(agents=3, check_period=1, duration=2)
+        result = simulator.run()
+        self.assertEqual(result["errors"], 0)
+        self.assertEqual(result["failures"], 0)
+        self.assertTrue(result["types"]["get_job"]["requests"] >= 3)
+
+    def test_long_poll(self):
+        simulator = fleet.FleetSimulator(agents=3, check_period=1, duration=2, long_poll=1)
+        result = simulator.run()
+        self.assertEqual(result["errors"], 0)
+        self.assertTrue(result["types"]["get_job"]["p99_ms"] >= 900)
+
+    def test_analyze(self):
+        records = [("get_job", 100.1, 0.01, True),
+                   ("get_job", 100.2, 0.02, True),
+                   ("get_config", 101.5, 0.03, False)]
+        result = fleet.analyze(records, 100.0, 4)
+        self.assertEqual(result["per_second"], [2, 1, 0, 0])
+        self.assertEqual(result["peak_rate"], 2)
+        self.assertEqual(result["burstiness"], 2.0 / 0.75)
+        self.assertEqual(result["failures"], 1)
+        self.assertEqual(result["types"]["get_job"]["requests"], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_binlog_stream
+----------------------------------
+
+Tests for `twindb_agent.job_type.binlog_stream` module.
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import twindb_agent.config
+from twindb_agent.job_type.binlog_stream import BinlogStream
+
+
+class TestBinlogStream(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_config = twindb_agent.config.AgentConfig._instance
+        config = twindb_agent.config.AgentConfig()
+        config.binlog_dir = tempfile.mkdtemp()
+        config.binlog_chunk_size = 100
+        config.binlog_chunk_interval = 60
+        twindb_agent.config.AgentConfig._instance = config
+        self.stream = BinlogStream({"job_id": 5, "params": {"ip": "127.0.0.1", "volume_id": 1}})
+        self.uploads = []
+        self.stream.upload_chunk = lambda binlog_file, start, end: "%s.%d" % (binlog_file, start)
+        self.stream.record_chunk = lambda name, binlog_file, start, end: self.uploads.append((name, end)) or True
+
+    def tearDown(self):
+        shutil.rmtree(self.stream.binlog_dir)
+        twindb_agent.config.AgentConfig._instance = self.saved_config
+
+    def write(self, name, size):
+        with open(os.path.join(self.stream.binlog_dir, name), "ab") as f:
+            f.write("x" * size)
+
+    def test_chunks(self):
+        checkpoint = {"file": "mysql-bin.000001", "position": 0}
+        self.assertEqual(self.stream.next_chunk(checkpoint), None)
+        self.write("mysql-bin.000001", 50)
+        # The chunk isn't full and isn't due yet
+        now = self.stream.last_upload
+        self.assertEqual(self.stream.next_chunk(checkpoint, now=now), None)
+        self.assertEqual(self.stream.next_chunk(checkpoint, now=now + 60), ("mysql-bin.000001", 0, 50, False))
+        self.write("mysql-bin.000001", 200)
+        self.assertEqual(self.stream.next_chunk(checkpoint, now=now), ("mysql-bin.000001", 0, 100, False))
+
+        self.write("mysql-bin.000002", 10)
+        checkpoint = self.stream.ship(checkpoint)
+        self.assertEqual(self.uploads, [("mysql-bin.000001.0", 100), ("mysql-bin.000001.100", 200),
+                                        ("mysql-bin.000001.200", 250)])
+        self.assertEqual(checkpoint, {"file": "mysql-bin.000002", "position": 0})
+        self.assertEqual(self.stream.local_binlogs(), ["mysql-bin.000002"])
+
+        checkpoint = self.stream.ship(checkpoint, flush=True)
+        self.assertEqual(self.uploads[-1], ("mysql-bin.000002.0", 10))
+        self.assertEqual(self.stream.load_checkpoint(), {"file": "mysql-bin.000002", "position": 10})
+
+    def test_credentials(self):
+        self.stream.server_config = {"mysql_user": "twindb", "mysql_password": 'pa"ss\\word'}
+        defaults_file = self.stream.write_defaults_file()
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(defaults_file).st_mode), 0600)
+            with open(defaults_file) as f:
+                self.assertEqual(f.read(), '[client]\nuser="twindb"\npassword="pa\\"ss\\\\word"\n')
+        finally:
+            os.remove(defaults_file)
+        cmd = self.stream.mysqlbinlog_cmd({"file": "mysql-bin.000001", "position": 0}, defaults_file, "/tmp/mysql.sock")
+        self.assertEqual(cmd[1], "--defaults-extra-file=%s" % defaults_file)
+        self.assertFalse([arg for arg in cmd if arg.startswith("--password") or "word" in arg])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_cache
+----------------------------------
+
+Tests for `twindb_agent.cache` module and the server config cache in `twindb_agent.handlers`.
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+import twindb_agent.api
+import twindb_agent.config
+import twindb_agent.handlers
+from twindb_agent.cache import SharedCache, keyring_fingerprint
+
+
+TwinDBAPI = twindb_agent.api.TwinDBAPI
+
+
+class StubAPI(object):
+    calls = []
+    responses = []
+
+    def __init__(self, logger_name="twindb_remote"):
+        self.success = True
+
+    def call(self, data, spool=False):
+        StubAPI.calls.append(data)
+        return StubAPI.responses.pop(0)
+
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_store(self):
+        cache = SharedCache(os.path.join(self.tmp_dir, "cache", "config.json"), ttl=60)
+        self.assertEqual(cache.get(), None)
+        cache.store({"mysql_password": "secret"}, version="1")
+        self.assertEqual(cache.get(), {"mysql_password": "secret"})
+        self.assertEqual(cache.load()["version"], "1")
+        self.assertEqual(stat.S_IMODE(os.stat(cache.path).st_mode), 0600)
+        self.assertEqual(os.listdir(os.path.dirname(cache.path)), ["config.json"])
+        self.assertFalse(cache.is_fresh(cache.load(), now=time.time() + 60))
+        cache.invalidate()
+        cache.invalidate()
+        self.assertEqual(cache.get(), None)
+
+    def test_concurrent_store(self):
+        cache = SharedCache(os.path.join(self.tmp_dir, "config.json"), ttl=60)
+        errors = []
+        cache.logger.error = errors.append
+        value = {"mysql_password": "x" * 100000}
+
+        def store():
+            for i in range(20):
+                cache.store(value)
+                if cache.get() != value:
+                    errors.append("Partial read")
+
+        threads = [threading.Thread(target=store) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.tmp_dir), ["config.json"])
+
+
+class TestConfigCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved = [(twindb_agent.config.AgentConfig, "_instance", twindb_agent.config.AgentConfig._instance),
+                      (twindb_agent.api, "TwinDBAPI", twindb_agent.api.TwinDBAPI)]
+        config = twindb_agent.config.AgentConfig()
+        config.config_cache_file = os.path.join(self.tmp_dir, "config.json")
+        twindb_agent.config.AgentConfig._instance = config
+        twindb_agent.api.TwinDBAPI = StubAPI
+        StubAPI.calls = []
+
+    def tearDown(self):
+        for obj, attr, value in self.saved:
+            setattr(obj, attr, value)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_config(self):
+        StubAPI.responses = [{"mysql_user": "twindb", "config_version": "v1"},
+                             {"not_modified": True},
+                             {"job_id": 1, "config_changed": True},
+                             {"mysql_user": "backup", "config_version": "v2"}]
+        self.assertEqual(twindb_agent.handlers.get_config()["mysql_user"], "twindb")
+        self.assertEqual(twindb_agent.handlers.get_config()["mysql_user"], "twindb")
+        self.assertEqual(len(StubAPI.calls), 1)
+
+        # Expired config is revalidated by its version
+        twindb_agent.config.AgentConfig.get_config().config_cache_ttl = 0.01
+        time.sleep(0.02)
+        self.assertEqual(twindb_agent.handlers.get_config()["mysql_user"], "twindb")
+        self.assertEqual(StubAPI.calls[1]["params"]["config_version"], "v1")
+
+        # The job order says the config is changed
+        twindb_agent.config.AgentConfig.get_config().config_cache_ttl = 60
+        twindb_agent.handlers.get_job()
+        self.assertEqual(twindb_agent.handlers.get_config()["mysql_user"], "backup")
+        self.assertNotIn("config_version", StubAPI.calls[3]["params"])
+        self.assertEqual(twindb_agent.handlers.get_config_cache().load()["version"], "v2")
+
+    def test_is_registered(self):
+        config = twindb_agent.config.AgentConfig.get_config()
+        config.gpg_homedir = os.path.join(self.tmp_dir, "gnupg")
+        config.registration_cache_file = os.path.join(self.tmp_dir, "registration.json")
+        os.mkdir(config.gpg_homedir, 0700)
+        StubAPI.responses = [{"registered": False}, {"registered": True}, {"registered": True}, {"registered": True}]
+        self.assertFalse(twindb_agent.handlers.is_registered())
+        self.assertTrue(twindb_agent.handlers.is_registered())
+        self.assertTrue(twindb_agent.handlers.is_registered())
+        self.assertEqual(len(StubAPI.calls), 2)
+
+        # New keys
+        fingerprint = keyring_fingerprint(config.gpg_homedir, config.server_id)
+        with open(os.path.join(config.gpg_homedir, "pubring.gpg"), "w") as f:
+            f.write("key")
+        self.assertNotEqual(keyring_fingerprint(config.gpg_homedir, config.server_id), fingerprint)
+        self.assertTrue(twindb_agent.handlers.is_registered())
+        self.assertEqual(len(StubAPI.calls), 3)
+
+        # The dispatcher rejects the agent
+        api = TwinDBAPI()
+        api.auth_failed = True
+        api.check_auth()
+        self.assertTrue(twindb_agent.handlers.is_registered())
+        self.assertEqual(len(StubAPI.calls), 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_httpclient
+----------------------------------
+
+Tests for `twindb_agent.httpclient` module.
+"""
+
+import unittest
+
+import twindb_agent.config
+import twindb_agent.httpclient
+from twindb_agent.httpclient import CircuitBreaker, RetryPolicy, TwinDBHTTPClientRetryableException
+
+
+class FlakyClient(twindb_agent.httpclient.TwinDBHTTPClient):
+    """
+    Fails first `failures` attempts
+    """
+    def __init__(self, failures):
+        super(FlakyClient, self).__init__()
+        self.failures = failures
+        self.attempts = 0
+        self.requests = []
+
+    def send(self, request):
+        self.attempts += 1
+        self.requests.append(dict(request))
+        if self.attempts <= self.failures:
+            raise TwinDBHTTPClientRetryableException("Connection refused")
+        return '{"success": true}'
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open_close(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        self.assertTrue(breaker.allow(now=0))
+        self.assertFalse(breaker.failure(0.1, "error", now=0))
+        self.assertTrue(breaker.failure(0.1, "error", now=1))
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow(now=30))
+        # One trial request after reset_timeout
+        self.assertTrue(breaker.allow(now=61))
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow(now=61))
+        breaker.success(0.1)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        state = breaker.get_state()
+        self.assertEqual(state["short_circuited"], 2)
+        self.assertEqual(state["calls"], 3)
+
+    def test_half_open_failure(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=60)
+        breaker.failure(0.1, "error", now=0)
+        self.assertTrue(breaker.allow(now=60))
+        self.assertTrue(breaker.failure(0.1, "error", now=60))
+        self.assertFalse(breaker.allow(now=100))
+        self.assertTrue(breaker.allow(now=120))
+
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_config = twindb_agent.config.AgentConfig._instance
+        twindb_agent.config.AgentConfig._instance = twindb_agent.config.AgentConfig()
+        self.saved_breaker = twindb_agent.httpclient._breaker
+        twindb_agent.httpclient._breaker = CircuitBreaker(threshold=3)
+        self.saved_sleep = twindb_agent.httpclient.time.sleep
+        twindb_agent.httpclient.time.sleep = lambda seconds: None
+
+    def tearDown(self):
+        twindb_agent.config.AgentConfig._instance = self.saved_config
+        twindb_agent.httpclient._breaker = self.saved_breaker
+        twindb_agent.httpclient.time.sleep = self.saved_sleep
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff=1.0, backoff_max=5.0)
+        self.assertTrue(0 <= policy.delay(1) <= 1.0)
+        self.assertTrue(0 <= policy.delay(10) <= 5.0)
+
+    def test_retry(self):
+        client = FlakyClient(failures=2)
+        self.assertEqual(client.get_response({"type": "notify", "params": {}}), '{"success": true}')
+        self.assertEqual(client.attempts, 3)
+
+    def test_idempotency_key(self):
+        client = FlakyClient(failures=2)
+        request = {"type": "update_backup_data", "params": {}}
+        client.get_response(request)
+        keys = set(r["idempotency_key"] for r in client.requests)
+        # Retries and a spooled copy of the request are sent with the same key
+        self.assertEqual(keys, set([request["idempotency_key"]]))
+        client.get_response(request)
+        self.assertEqual(client.requests[-1]["idempotency_key"], request["idempotency_key"])
+        client.get_response({"type": "get_job", "params": {}})
+        self.assertNotIn("idempotency_key", client.requests[-1])
+
+    def test_no_retry(self):
+        client = FlakyClient(failures=1)
+        self.assertEqual(client.get_response({"type": "get_job", "params": {}}), None)
+        self.assertEqual(client.attempts, 1)
+
+    def test_retry_attempts_config(self):
+        twindb_agent.config.AgentConfig.get_config().api_retry_attempts = {"get_job": 2}
+        client = FlakyClient(failures=1)
+        self.assertEqual(client.get_response({"type": "get_job", "params": {}}), '{"success": true}')
+
+    def test_short_circuit(self):
+        client = FlakyClient(failures=10)
+        self.assertEqual(client.get_response({"type": "notify", "params": {}}), None)
+        # The breaker opened after 3 failures, remaining attempts weren't made
+        self.assertEqual(client.attempts, 3)
+        self.assertEqual(client.get_response({"type": "notify", "params": {}}), None)
+        self.assertEqual(client.attempts, 3)
+
+if __name__ == '__main__':
+    unittest.main()
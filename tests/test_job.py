@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_job
+----------------------------------
+
+Tests for `twindb_agent.job` module and job abort in `twindb_agent.agent`.
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+import twindb_agent.agent
+import twindb_agent.config
+import twindb_agent.handlers
+import twindb_agent.job
+import twindb_agent.job_type.backup
+import twindb_agent.journal
+
+
+def stuck_job(pid_file):
+    os.setpgid(0, 0)
+    # A pipeline process that ignores SIGTERM
+    proc = subprocess.Popen(["sh", "-c", "trap '' TERM; sleep 60"])
+    with open(pid_file, "w") as f:
+        f.write(str(proc.pid))
+    time.sleep(60)
+
+
+def make_job(job_type, params, start_scheduled=None):
+    job = twindb_agent.job.Job.__new__(twindb_agent.job.Job)
+    job.job_order = {"job_id": "7", "type": job_type, "params": params, "start_scheduled": start_scheduled}
+    job.agent_config = twindb_agent.config.AgentConfig.get_config()
+    return job
+
+
+class TestJob(unittest.TestCase):
+
+    def test_deadline(self):
+        now = time.time()
+        deadline = make_job("send_key", {}).get_deadline()
+        self.assertTrue(now + 600 <= deadline <= time.time() + 600)
+        start = int(now) + 3600
+        self.assertEqual(make_job("backup", {"deadline": 60}, start).get_deadline(), start + 60)
+        self.assertEqual(make_job("unknown", {}).get_deadline(), None)
+
+
+class TestAbort(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.notifications = []
+        self.saved = [(twindb_agent.handlers, "log_job_notify", twindb_agent.handlers.log_job_notify)]
+        twindb_agent.handlers.log_job_notify = lambda params: self.notifications.append(params)
+        self.agent = twindb_agent.agent.Agent.__new__(twindb_agent.agent.Agent)
+        self.agent.config = twindb_agent.config.AgentConfig()
+        self.agent.config.job_kill_timeout = 1
+        self.agent.logger = logging.getLogger("twindb_local")
+        self.agent.journal = twindb_agent.journal.JobJournal(journal_dir=os.path.join(self.tmp_dir, "jobs"))
+
+    def tearDown(self):
+        for obj, attr, value in self.saved:
+            setattr(obj, attr, value)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_terminate_job(self):
+        pid_file = os.path.join(self.tmp_dir, "pid")
+        job_tmp = os.path.join(self.tmp_dir, "job_tmp")
+        os.mkdir(job_tmp)
+        proc = multiprocessing.Process(target=stuck_job, args=(pid_file,))
+        proc.start()
+        while not os.path.exists(pid_file) or not open(pid_file).read():
+            time.sleep(0.01)
+        child_pid = int(open(pid_file).read())
+        self.agent.journal.update("7", "started", pid=proc.pid, tmp_paths=[job_tmp])
+
+        self.agent.terminate_job(proc, make_job("send_key", {}), twindb_agent.job.JOB_CANCELLED)
+
+        self.assertFalse(proc.is_alive())
+        self.assertEqual(twindb_agent.journal.process_name(child_pid), None)
+        self.assertFalse(os.path.exists(job_tmp))
+        self.assertEqual(self.agent.journal.get("7"), None)
+        self.assertEqual(self.notifications, [{"event": "stop_job", "job_id": 7, "ret_code": -3}])
+
+    def test_failed_cleanup(self):
+        job = make_job("backup", {"ip": "127.0.0.1"})
+        self.saved.append((twindb_agent.job_type.backup, "get_config", twindb_agent.job_type.backup.get_config))
+        for get_config in [lambda: None, lambda: 1 / 0]:
+            twindb_agent.job_type.backup.get_config = get_config
+            proc = multiprocessing.Process(target=time.sleep, args=(60,))
+            proc.start()
+            self.agent.journal.update("7", "streaming", pid=proc.pid, backup_name="server_id_abc.xbstream.gpg")
+            self.agent.terminate_job(proc, job, twindb_agent.job.JOB_DEADLINE_EXCEEDED)
+            self.assertEqual(self.agent.journal.get("7"), None)
+        self.assertEqual(self.notifications, [{"event": "stop_job", "job_id": 7,
+                                               "ret_code": twindb_agent.job.JOB_DEADLINE_EXCEEDED}] * 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_journal
+----------------------------------
+
+Tests for `twindb_agent.journal` module.
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import twindb_agent.agent
+import twindb_agent.api
+import twindb_agent.handlers
+import twindb_agent.scheduler
+from twindb_agent import journal
+
+
+class StubAPI(object):
+    calls = []
+
+    def __init__(self):
+        self.success = True
+        self.spooled = False
+
+    def call(self, data, spool=False):
+        StubAPI.calls.append(data)
+        return None
+
+
+class TestJobJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.journal_dir = tempfile.mkdtemp()
+        self.journal = journal.JobJournal(journal_dir=os.path.join(self.journal_dir, "jobs"))
+
+    def tearDown(self):
+        shutil.rmtree(self.journal_dir)
+
+    def test_transitions(self):
+        self.assertEqual(self.journal.entries(), [])
+        self.journal.update(10, "received", job_order={"job_id": 10})
+        self.journal.update(2, "started", pid=123)
+        self.journal.update(10, "started", pid=456)
+        self.assertEqual([e["job_id"] for e in self.journal.entries()], [2, 10])
+        entry = self.journal.get(10)
+        self.assertEqual(entry["state"], "started")
+        self.assertEqual(entry["job_order"], {"job_id": 10})
+        self.assertEqual(entry["pid"], 456)
+        self.journal.remove(10)
+        self.journal.remove(10)
+        self.assertEqual(self.journal.get(10), None)
+        self.assertEqual(os.listdir(self.journal.journal_dir), ["2.json"])
+
+    def test_cleanup(self):
+        proc = subprocess.Popen(["sleep", "30"])
+        tmp_dir = tempfile.mkdtemp(dir=self.journal_dir)
+        entry = self.journal.update(1, "streaming", processes=[(proc, "sleep")], tmp_paths=[tmp_dir, None])
+        self.assertEqual(entry["processes"], [{"pid": proc.pid, "name": "sleep",
+                                               "started": journal.process_start_time(proc.pid)}])
+        self.journal.cleanup(entry)
+        self.assertEqual(proc.wait(), -15)
+        self.assertFalse(os.path.exists(tmp_dir))
+
+    def test_stale_process(self):
+        proc = subprocess.Popen(["sleep", "30"])
+        entry = self.journal.update(1, "streaming", processes=[(proc, "sleep")])
+        entry["processes"][0]["started"] = "another-boot:1"
+        self.journal.cleanup(entry)
+        self.assertEqual(proc.poll(), None)
+        proc.kill()
+        proc.wait()
+
+
+class TestReconcile(unittest.TestCase):
+
+    def setUp(self):
+        self.journal_dir = tempfile.mkdtemp()
+        self.notifications = []
+        self.saved = [(twindb_agent.handlers, "log_job_notify", twindb_agent.handlers.log_job_notify),
+                      (twindb_agent.api, "TwinDBAPI", twindb_agent.api.TwinDBAPI)]
+        twindb_agent.handlers.log_job_notify = lambda params: self.notifications.append(params)
+        twindb_agent.api.TwinDBAPI = StubAPI
+        StubAPI.calls = []
+        self.agent = twindb_agent.agent.Agent.__new__(twindb_agent.agent.Agent)
+        self.agent.logger = logging.getLogger("twindb_local")
+        self.agent.journal = journal.JobJournal(journal_dir=self.journal_dir)
+        self.agent.reconciled = False
+        self.agent.unreconciled_jobs = None
+        self.agent.scheduler = twindb_agent.scheduler.JobScheduler()
+
+    def tearDown(self):
+        for obj, attr, value in self.saved:
+            setattr(obj, attr, value)
+        shutil.rmtree(self.journal_dir)
+
+    def test_reconcile(self):
+        j = self.agent.journal
+        j.update(1, "received", job_order={"job_id": "1", "type": "backup"})
+        j.update(2, "streaming", pid=2 ** 22 + 1)
+        j.update(3, "uploaded", record_request={"type": "update_backup_data"})
+        # Job process that is still running isn't touched
+        j.update(4, "streaming", pid=os.getpid())
+        self.agent.reconcile_jobs()
+        self.assertFalse(self.agent.reconciled)
+        self.assertEqual(self.agent.scheduler.pop_due(), {"job_id": "1", "type": "backup"})
+        self.assertEqual(StubAPI.calls, [{"type": "update_backup_data"}])
+        self.assertEqual([(n["job_id"], n["ret_code"], n["interrupted_state"]) for n in self.notifications],
+                         [(2, -1, "streaming"), (3, 0, "recorded")])
+        self.assertEqual([e["job_id"] for e in j.entries()], [1, 4])
+
+        # Job 4 is checked again in the next cycle. Its pid now belongs to another process
+        self.assertTrue(journal.is_alive(os.getpid(), j.get(4)["pid_started"]))
+        j.update(4, pid_started="another-boot:1")
+        self.agent.reconcile_jobs()
+        self.assertTrue(self.agent.reconciled)
+        self.assertEqual([(n["job_id"], n["interrupted_state"]) for n in self.notifications[2:]], [(4, "streaming")])
+        # Job 1 isn't resumed twice
+        self.assertEqual(self.agent.scheduler.pop_due(), None)
+        self.assertEqual([e["job_id"] for e in j.entries()], [1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_loop
+----------------------------------
+
+Tests for `twindb_agent.loop` module.
+"""
+
+import threading
+import time
+import unittest
+
+from twindb_agent.loop import EventLoop
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop(workers=2)
+        self.calls = []
+
+    def run_loop(self, timeout):
+        self.loop.call_later(timeout, self.loop.stop)
+        self.loop.run()
+
+    def test_call_later(self):
+        self.loop.call_later(0.2, self.calls.append, "second")
+        self.loop.call_later(0.1, self.calls.append, "first")
+        timer = self.loop.call_later(0.1, self.calls.append, "cancelled")
+        timer.cancel()
+        self.run_loop(0.3)
+        self.assertEqual(self.calls, ["first", "second"])
+
+    def test_call_every(self):
+        periodic = self.loop.call_every(0.05, lambda: self.calls.append(time.time()))
+        self.loop.call_later(0.4, periodic.cancel)
+        self.run_loop(0.5)
+        self.assertTrue(5 <= len(self.calls) <= 9)
+
+    def test_run_in_executor(self):
+        loop_thread = threading.current_thread()
+
+        def blocking(x):
+            time.sleep(0.1)
+            return x * 2
+
+        def done(result, error):
+            self.calls.append((result, error, threading.current_thread() is loop_thread))
+
+        def failing():
+            raise ValueError("MySQL has gone away")
+
+        errors = []
+        self.loop.run_in_executor(blocking, args=(21,), callback=done)
+        self.loop.run_in_executor(failing, callback=lambda result, error: errors.append(error))
+        self.run_loop(0.3)
+        self.assertEqual(self.calls, [(42, None, True)])
+        self.assertTrue(isinstance(errors[0], ValueError))
+
+    def test_callback_error(self):
+        self.loop.call_soon(lambda: 1 / 0)
+        self.loop.call_later(0.1, self.calls.append, "after error")
+        self.run_loop(0.2)
+        self.assertEqual(self.calls, ["after error"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_manifest
+----------------------------------
+
+Tests for `twindb_agent.manifest` module.
+"""
+
+import hashlib
+import json
+import struct
+import unittest
+from StringIO import StringIO
+
+from twindb_agent.manifest import ManifestException, SegmentWriter, load, segments_for
+from twindb_agent.xbstream import table_filter
+
+
+def payload_chunk(path, payload):
+    return "XBSTCK01" + "\0P" + struct.pack("<I", len(path)) + path + \
+        struct.pack("<QQI", len(payload), 0, 0) + payload
+
+
+def encrypt(data):
+    return "<%s>" % data[::-1]
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.chunks = [payload_chunk("ibdata1", "a" * 100), payload_chunk("ibdata1", "b" * 100),
+                       payload_chunk("shop/users.ibd", "c" * 300), payload_chunk("shop/orders.ibd", "d" * 50),
+                       payload_chunk("shop/users.ibd", "e" * 50)]
+        self.stream = "".join(self.chunks)
+
+    def test_write_stream(self):
+        out = StringIO()
+        manifest = SegmentWriter(out, 200, encrypt).write_stream(StringIO(self.stream))
+        segments = manifest["segments"]
+        # Segments are cut at chunk boundaries once they have 200 bytes
+        plain = [self.chunks[0] + self.chunks[1], self.chunks[2], self.chunks[3] + self.chunks[4]]
+        self.assertEqual([s["plain_size"] for s in segments], [len(p) for p in plain])
+        self.assertEqual(out.getvalue(), "".join(encrypt(p) for p in plain))
+        for segment, data in zip(segments, plain):
+            encrypted = out.getvalue()[segment["offset"]:segment["offset"] + segment["size"]]
+            self.assertEqual(encrypted, encrypt(data))
+            self.assertEqual(self.stream[segment["plain_offset"]:segment["plain_offset"] + segment["plain_size"]],
+                             data)
+            self.assertEqual(segment["sha256"], hashlib.sha256(data).hexdigest())
+
+        ibdata = manifest["files"]["ibdata1"]
+        self.assertEqual(ibdata["ranges"], [[0, len(self.chunks[0]) + len(self.chunks[1])]])
+        self.assertEqual(ibdata["sha256"], hashlib.sha256(self.chunks[0] + self.chunks[1]).hexdigest())
+        self.assertEqual(len(manifest["files"]["shop/users.ibd"]["ranges"]), 2)
+
+        manifest = load(json.dumps(manifest))
+        self.assertEqual(segments_for(manifest), manifest["segments"])
+        self.assertEqual(segments_for(manifest, table_filter(["shop.orders"])),
+                         [manifest["segments"][0], manifest["segments"][2]])
+        self.assertRaises(ManifestException, load, json.dumps({"version": 99}))
+        self.assertRaises(ManifestException, load, "{")
+
+    def test_encryption_error(self):
+        def fail(data):
+            raise ManifestException("GPG exited with code 2")
+
+        writer = SegmentWriter(StringIO(), 200, fail)
+        self.assertRaises(ManifestException, writer.write_stream, StringIO(self.stream))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_metrics
+----------------------------------
+
+Tests for `twindb_agent.metrics` module.
+"""
+
+import multiprocessing
+import unittest
+import urllib2
+
+from twindb_agent import metrics
+
+
+def job(conn):
+    registry = metrics.Registry()
+    histogram = registry.register(metrics.Histogram("job_seconds", "Job time", ["type"], buckets=(1, 10)))
+    histogram.observe(5, "backup")
+    conn.send(registry.snapshot())
+    conn.close()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.requests = self.registry.register(metrics.Counter("requests_total", "Requests", ["type", "result"]))
+        self.latency = self.registry.register(metrics.Histogram("request_seconds", "Latency", ["type"],
+                                                                buckets=(0.1, 1)))
+
+    def test_counter(self):
+        self.requests.inc("get_job", "ok")
+        self.requests.inc("get_job", "ok", amount=2)
+        self.requests.inc("log", 'say "hi"')
+        lines = self.requests.render()
+        self.assertIn('requests_total{type="get_job",result="ok"} 3.0', lines)
+        self.assertIn('requests_total{type="log",result="say \\"hi\\""} 1.0', lines)
+
+    def test_histogram(self):
+        for value in [0.05, 0.1, 0.5, 2]:
+            self.latency.observe(value, "get_job")
+        with self.latency.time("log"):
+            pass
+        lines = self.latency.render()
+        self.assertIn('request_seconds_bucket{type="get_job",le="0.1"} 2', lines)
+        self.assertIn('request_seconds_bucket{type="get_job",le="1.0"} 3', lines)
+        self.assertIn('request_seconds_bucket{type="get_job",le="+Inf"} 4', lines)
+        self.assertIn('request_seconds_sum{type="get_job"} 2.65', lines)
+        self.assertIn('request_seconds_count{type="get_job"} 4', lines)
+        self.assertIn('request_seconds_count{type="log"} 1', lines)
+
+    def test_render(self):
+        self.requests.inc("get_job", "ok")
+        text = self.registry.render()
+        self.assertTrue(text.startswith("# HELP requests_total Requests\n# TYPE requests_total counter\n"))
+        self.assertIn("# TYPE request_seconds histogram\n", text)
+
+    def test_merge_from_process(self):
+        registry = metrics.Registry()
+        histogram = registry.register(metrics.Histogram("job_seconds", "Job time", ["type"], buckets=(1, 10)))
+        histogram.observe(50, "backup")
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(target=job, args=(child_conn,))
+        proc.start()
+        registry.merge(parent_conn.recv())
+        proc.join()
+        self.assertEqual(histogram.snapshot(), {("backup",): [[0, 1, 1], 55.0]})
+
+    def test_server(self):
+        metrics.API_REQUESTS.inc("test_server", "ok")
+        server = metrics.start_server("127.0.0.1", 0)
+        try:
+            url = "http://127.0.0.1:%d/metrics" % server.server_address[1]
+            body = urllib2.urlopen(url).read()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('twindb_api_requests_total{type="test_server",result="ok"}', body)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_poll
+----------------------------------
+
+Tests for `twindb_agent.poll` module.
+"""
+
+import random
+import unittest
+
+from twindb_agent.poll import PollScheduler
+
+
+class TestPollScheduler(unittest.TestCase):
+
+    def test_no_jitter(self):
+        poll = PollScheduler(60)
+        self.assertEqual(poll.next_interval(now=0), 60)
+
+    def test_jitter(self):
+        poll = PollScheduler(60, jitter=0.2, rng=random.Random(1))
+        intervals = [poll.next_interval(now=0) for i in range(100)]
+        self.assertTrue(min(intervals) >= 48)
+        self.assertTrue(max(intervals) <= 72)
+        self.assertTrue(len(set(intervals)) > 1)
+
+    def test_idle_backoff(self):
+        poll = PollScheduler(60, idle_max=300)
+        for i in range(poll.idle_cycles):
+            poll.idle_cycle()
+        self.assertEqual(poll.next_interval(now=0), 60)
+        for i in range(20):
+            poll.idle_cycle()
+        self.assertEqual(poll.next_interval(now=0), 300)
+        poll.job_received()
+        self.assertEqual(poll.next_interval(now=0), 60)
+
+    def test_error_backoff(self):
+        poll = PollScheduler(60, error_max=900)
+        poll.error()
+        self.assertEqual(poll.next_interval(now=0), 120)
+        poll.error()
+        self.assertEqual(poll.next_interval(now=0), 240)
+        for i in range(10):
+            poll.error()
+        self.assertEqual(poll.next_interval(now=0), 900)
+        poll.idle_cycle()
+        self.assertEqual(poll.next_interval(now=0), 60)
+
+    def test_announced_job(self):
+        poll = PollScheduler(60, idle_max=300, rng=random.Random(1))
+        for i in range(30):
+            poll.idle_cycle()
+        poll.announce(1000)
+        interval = poll.next_interval(now=900)
+        self.assertTrue(100 <= interval <= 101)
+        # The announced time has come, poll at full speed
+        self.assertEqual(poll.next_interval(now=1000), 60)
+
+    def test_long_poll(self):
+        poll = PollScheduler(60, jitter=0.1, long_poll=30, rng=random.Random(1))
+        self.assertTrue(0 <= poll.next_interval(now=0) <= 6)
+        poll.error()
+        self.assertEqual(poll.base_interval(), 60)
+
+if __name__ == '__main__':
+    unittest.main()
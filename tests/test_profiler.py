@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_profiler
+----------------------------------
+
+Tests for `twindb_agent.profiler` module.
+"""
+
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from twindb_agent import profiler
+
+
+def busy_loop():
+    total = 0
+    for i in range(200000):
+        total += i * i
+    return total
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+
+    def test_hotspots(self):
+        p = profiler.Profiler()
+        p.start()
+        busy_loop()
+        p.stop()
+        hotspots = p.hotspots(top=3)
+        self.assertTrue(len(hotspots) <= 3)
+        self.assertTrue(hotspots[0]["function"].endswith("(busy_loop)"))
+        self.assertEqual(hotspots[0]["calls"], 1)
+        path = os.path.join(self.profile_dir, "job_1.prof")
+        p.save(path)
+        self.assertTrue(os.path.exists(path))
+
+    def test_cycle_profiler(self):
+        cycles = profiler.CycleProfiler(os.path.join(self.profile_dir, "agent"))
+        run_cycle = cycles.wrap("cycle", busy_loop)
+        self.assertEqual(run_cycle.__name__, "busy_loop")
+        for i in range(2):
+            self.assertEqual(run_cycle(), busy_loop())
+        stats = pstats.Stats(os.path.join(self.profile_dir, "agent", "agent.cycle.prof"))
+        calls = [nc for (filename, line, func), (cc, nc, tt, ct, callers) in stats.stats.items()
+                 if func == "busy_loop"]
+        self.assertEqual(calls, [2])
+
+if __name__ == '__main__':
+    unittest.main()
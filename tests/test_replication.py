@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_replication
+----------------------------------
+
+Tests for `twindb_agent.replication` module.
+"""
+
+import unittest
+
+from twindb_agent.replication import LagSampler
+
+
+class FakeCursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.rows = []
+
+    def cursor(self, dictionary=False):
+        return FakeCursor(self.rows)
+
+    def close(self):
+        pass
+
+
+class TestLagSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConnection()
+        self.sampler = LagSampler(interval=1, size=100)
+        self.sampler.conn = self.conn
+
+    def slave_status(self, lag, pos, gtid=None):
+        self.conn.rows = [{"Seconds_Behind_Master": lag, "Relay_Master_Log_File": "mysql-bin.000007",
+                           "Exec_Master_Log_Pos": pos, "Executed_Gtid_Set": gtid}]
+        return self.sampler.sample()
+
+    def test_summary(self):
+        self.assertFalse(self.sampler.sample())
+        for i in range(1, 101):
+            self.assertTrue(self.slave_status(i % 10 * 2, 1000 + i))
+        self.assertTrue(self.slave_status(None, 1200))
+        summary = self.sampler.summary()
+        self.assertEqual(summary["samples"], 101)
+        self.assertEqual(summary["dropped_samples"], 1)
+        self.assertEqual(summary["stopped_samples"], 1)
+        self.assertEqual((summary["min"], summary["max"], summary["p50"], summary["p99"]), (0, 18, 10, 18))
+        self.assertEqual(summary["start_position"], "mysql-bin.000007:1001")
+        self.assertEqual(summary["applied_bytes"], 199)
+        self.assertNotIn("start_gtid", summary)
+
+        self.slave_status(3, 1300, "uuid:1-10")
+        summary = self.sampler.summary()
+        self.assertEqual((summary["samples"], summary["min"], summary["max"]), (1, 3, 3))
+        self.assertEqual(summary["applied_bytes"], 100)
+        self.assertEqual(summary["end_gtid"], "uuid:1-10")
+        self.assertEqual(self.sampler.summary()["samples"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_restore
+----------------------------------
+
+Tests for `twindb_agent.job_type.restore` module.
+"""
+
+import os
+import random
+import shutil
+import stat
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+import twindb_agent.config
+from twindb_agent.job_type.restore import REPLAY_USER, BinlogEvents, ChunkPrefetcher, Restore
+
+# mysqlbinlog prints its options and passes the binary log through.
+# mysql saves its options, fails unless it connects as the replay account,
+# answers GTID_SUBSET() with the content of gtid_subset and saves any other input
+FAKE_MYSQLBINLOG = """#!/bin/sh
+echo "# mysqlbinlog $*"
+cat
+"""
+FAKE_MYSQL = """#!/bin/sh
+dir=$(dirname "$0")
+echo "$*" >> "$dir/mysql.args"
+case "$*" in
+    *--user=%s*) ;;
+    *) exit 1 ;;
+esac
+case "$*" in
+    *GTID_SUBSET*) cat "$dir/gtid_subset" ;;
+    *) cat >> "$dir/mysql.in" ;;
+esac
+""" % REPLAY_USER
+
+
+def chunk(binlog_file, start, end):
+    return {"name": "%s.%d.gpg" % (binlog_file, start), "ip": "127.0.0.1",
+            "binlog_file": binlog_file, "start_position": start, "end_position": end}
+
+
+def event(timestamp, body):
+    return struct.pack("<IBIIIH", timestamp, 2, 1, 19 + len(body), 0, 0) + body
+
+
+def local_time(datetime):
+    return int(time.mktime(time.strptime(datetime, "%Y-%m-%d %H:%M:%S")))
+
+
+class TestChunkPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_order(self):
+        chunks = [chunk("mysql-bin.000001", i * 10, i * 10 + 10) for i in range(20)]
+        lock = threading.Lock()
+        fetched = []
+
+        def fetch(c, path):
+            time.sleep(random.random() / 100)
+            with open(path, "w") as f:
+                f.write(c["name"])
+            with lock:
+                fetched.append(c["start_position"])
+            return True
+
+        prefetcher = ChunkPrefetcher(chunks, fetch, self.tmp_dir, parallelism=4, window=6)
+        names = []
+        for i, (c, path) in enumerate(prefetcher):
+            with open(path) as f:
+                names.append(f.read())
+            # Downloads don't run further than the window ahead
+            with lock:
+                self.assertTrue(len(fetched) <= i + 6)
+        self.assertEqual(names, [c["name"] for c in chunks])
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_failure(self):
+        chunks = [chunk("mysql-bin.000001", 0, 10), chunk("mysql-bin.000001", 10, 20)]
+
+        def fetch(c, path):
+            if c["start_position"]:
+                raise IOError("Connection reset")
+            open(path, "w").close()
+            return True
+
+        result = [path is not None for _, path in ChunkPrefetcher(chunks, fetch, self.tmp_dir)]
+        self.assertEqual(result, [True, False])
+
+
+class TestPointInTime(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.restore = Restore({"job_id": 7, "params": {"restore_dir": self.tmp_dir, "server_id": "abc",
+                                                        "stop_gtid": "uuid:1-100"}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def point_in_time(self, **target):
+        params = {"restore_dir": self.tmp_dir, "server_id": "abc"}
+        params.update(target)
+        return Restore({"job_id": 7, "params": params})
+
+    def fake_tools(self):
+        """
+        Puts fake mysqlbinlog and mysql first in PATH
+        :return: directory with the tools
+        """
+        bin_dir = os.path.join(self.tmp_dir, "bin")
+        os.mkdir(bin_dir)
+        for name, script in [("mysqlbinlog", FAKE_MYSQLBINLOG), ("mysql", FAKE_MYSQL)]:
+            path = os.path.join(bin_dir, name)
+            with open(path, "w") as f:
+                f.write(script)
+            os.chmod(path, stat.S_IRWXU)
+        config = twindb_agent.config.AgentConfig()
+        config.job_journal_dir = os.path.join(self.tmp_dir, "jobs")
+        self.addCleanup(setattr, twindb_agent.config.AgentConfig, "_instance",
+                        twindb_agent.config.AgentConfig._instance)
+        self.addCleanup(os.environ.__setitem__, "PATH", os.environ["PATH"])
+        twindb_agent.config.AgentConfig._instance = config
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+        return bin_dir
+
+    def test_replay_server(self):
+        info = {"file": "mysql-bin.000012", "position": 1234, "gtid": None}
+        by_time = self.point_in_time(stop_datetime="2026-10-19 12:00:00")
+        cmd = by_time.mysqlbinlog_cmd("mysql-bin.000012", info)
+        self.assertIn("--stop-datetime=2026-10-19 12:00:00", cmd)
+        # GTID events of the source would fail on a server without GTIDs
+        self.assertIn("--skip-gtids", cmd)
+        self.assertNotIn("--skip-gtids", self.restore.mysqlbinlog_cmd("mysql-bin.000012", info))
+
+        cmd, socket = by_time.mysqld_cmd(self.tmp_dir, "/tmp/replay")
+        self.assertNotIn("--skip-grant-tables", cmd)
+        self.assertIn("--init-file=/tmp/replay/init.sql", cmd)
+        self.assertIn("--plugin-load=auth_socket=auth_socket.so", cmd)
+        self.assertNotIn("--gtid-mode=ON", cmd)
+        cmd, socket = self.restore.mysqld_cmd(self.tmp_dir, "/tmp/replay")
+        self.assertIn("--gtid-mode=ON", cmd)
+        self.assertIn("--enforce-gtid-consistency=ON", cmd)
+        sql = Restore.replay_init_sql()
+        self.assertTrue(sql.startswith("SET SESSION sql_log_bin = 0;"))
+        # MySQL 5.5 and 5.6 have neither CREATE USER IF NOT EXISTS nor the SHUTDOWN statement
+        self.assertNotIn("IF NOT EXISTS", sql)
+        self.assertIn("VALUES ('localhost', '%s', 'auth_socket'" % REPLAY_USER, sql)
+        self.assertIn("FLUSH PRIVILEGES;", sql)
+
+    def test_binlog_events(self):
+        binlog = "\xfebin" + event(100, "a" * 10) + event(200, "b" * 30) + event(150, "c")
+        events = BinlogEvents(4)
+        # The second header is split between the pieces
+        for start, end in [(0, 40), (40, 45), (45, len(binlog))]:
+            self.assertTrue(events.scan(StringIO(binlog[start:end]), start, end))
+        self.assertEqual(events.timestamp, 200)
+        self.assertEqual(events.next_event, len(binlog))
+        events = BinlogEvents(4)
+        self.assertFalse(events.scan(StringIO(binlog[:4] + struct.pack("<IBIIIH", 100, 2, 1, 5, 0, 0)), 0, 23))
+
+    def test_replay(self):
+        bin_dir = self.fake_tools()
+        stop = local_time("2026-10-19 12:00:00")
+        binlogs = {"mysql-bin.000001": "\xfebin" + event(stop - 300, "CREATE USER 'app'@'%';\n") +
+                   event(stop - 200, "GRANT SELECT ON db.* TO 'app'@'%';\n"),
+                   "mysql-bin.000002": "\xfebin" + event(stop - 100, "INSERT INTO t VALUES (1);\n") +
+                   event(stop + 100, "INSERT INTO t VALUES (2);\n"),
+                   "mysql-bin.000003": "\xfebin" + event(stop + 200, "INSERT INTO t VALUES (3);\n")}
+        # The first chunk ends in the middle of an event header
+        chunks = [chunk("mysql-bin.000001", 0, 30), chunk("mysql-bin.000001", 30, len(binlogs["mysql-bin.000001"])),
+                  chunk("mysql-bin.000002", 0, len(binlogs["mysql-bin.000002"])),
+                  chunk("mysql-bin.000003", 0, len(binlogs["mysql-bin.000003"]))]
+        fetched = []
+
+        def fetch(c, path):
+            with open(path, "w") as f:
+                f.write(binlogs[c["binlog_file"]][c["start_position"]:c["end_position"]])
+            fetched.append(c["binlog_file"])
+            return True
+
+        restore = self.point_in_time(stop_datetime="2026-10-19 12:00:00")
+        restore.fetch_chunk = fetch
+        info = {"file": "mysql-bin.000001", "position": 4, "gtid": None}
+        self.assertTrue(restore.replay(chunks, info, "/tmp/replay/mysql.sock"))
+        self.assertTrue(restore.target_reached("/tmp/replay/mysql.sock"))
+        with open(os.path.join(bin_dir, "mysql.in")) as f:
+            replayed = f.read()
+        # Replay stops at the binary log with the target
+        self.assertEqual(replayed,
+                         "# mysqlbinlog --start-position=4 --stop-datetime=2026-10-19 12:00:00 --skip-gtids -\n" +
+                         binlogs["mysql-bin.000001"] +
+                         "# mysqlbinlog --stop-datetime=2026-10-19 12:00:00 --skip-gtids -\n" +
+                         binlogs["mysql-bin.000002"])
+        with open(os.path.join(bin_dir, "mysql.args")) as f:
+            self.assertEqual(f.read(), "--socket=/tmp/replay/mysql.sock --user=%s --binary-mode\n" % REPLAY_USER)
+
+        # Archived binary logs end before the target
+        restore = self.point_in_time(stop_datetime="2026-10-19 12:00:00")
+        restore.fetch_chunk = fetch
+        self.assertTrue(restore.replay(chunks[:2], info, "/tmp/replay/mysql.sock"))
+        self.assertFalse(restore.target_reached("/tmp/replay/mysql.sock"))
+
+    def test_gtid_target(self):
+        bin_dir = self.fake_tools()
+        with open(os.path.join(bin_dir, "gtid_subset"), "w") as f:
+            f.write("0\n")
+        self.assertFalse(self.restore.target_reached("/tmp/replay/mysql.sock"))
+        with open(os.path.join(bin_dir, "gtid_subset"), "w") as f:
+            f.write("1\n")
+        self.assertTrue(self.restore.target_reached("/tmp/replay/mysql.sock"))
+        with open(os.path.join(bin_dir, "mysql.args")) as f:
+            self.assertIn("--skip-column-names -e SELECT GTID_SUBSET('uuid:1-100', @@GLOBAL.gtid_executed)",
+                          f.read())
+
+    def test_binlog_info(self):
+        self.assertTrue(self.restore.is_point_in_time())
+        self.assertEqual(self.restore.read_binlog_info(self.tmp_dir), None)
+        with open(os.path.join(self.tmp_dir, "xtrabackup_binlog_info"), "w") as f:
+            f.write("mysql-bin.000012\t1234\tuuid:1-50,\nuuid2:1-7\n")
+        info = self.restore.read_binlog_info(self.tmp_dir)
+        self.assertEqual(info, {"file": "mysql-bin.000012", "position": 1234, "gtid": "uuid:1-50,uuid2:1-7"})
+        self.assertEqual(self.restore.mysqlbinlog_cmd("mysql-bin.000012", info),
+                         ["mysqlbinlog", "--start-position=1234", "--include-gtids=uuid:1-100",
+                          "--exclude-gtids=uuid:1-50,uuid2:1-7", "-"])
+        self.assertEqual(self.restore.mysqlbinlog_cmd("mysql-bin.000013", info)[1], "--include-gtids=uuid:1-100")
+
+    def test_check_chunks(self):
+        chunks = [chunk("mysql-bin.000001", 0, 100), chunk("mysql-bin.000001", 100, 150),
+                  chunk("mysql-bin.000002", 0, 20)]
+        self.assertTrue(self.restore.check_chunks(chunks, "mysql-bin.000001"))
+        self.assertFalse(self.restore.check_chunks(chunks, "mysql-bin.000000"))
+        self.assertFalse(self.restore.check_chunks([chunks[0], chunks[2], chunks[1]], "mysql-bin.000001"))
+        self.assertFalse(self.restore.check_chunks(chunks[::2] + [chunk("mysql-bin.000002", 30, 40)],
+                                                   "mysql-bin.000001"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_scheduler
+----------------------------------
+
+Tests for `twindb_agent.scheduler` module.
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+import unittest
+
+import twindb_agent.agent
+import twindb_agent.config
+import twindb_agent.job
+from twindb_agent.scheduler import JobScheduler
+
+
+class StubLoop(object):
+    def __init__(self):
+        self.timers = []
+        self.executed = []
+
+    def call_soon(self, callback, *args):
+        self.timers.append((0, callback))
+
+    def call_later(self, delay, callback, *args):
+        self.timers.append((delay, callback))
+
+    def run_in_executor(self, func, args=(), callback=None):
+        self.executed.append((func, args))
+
+
+def backup_job():
+    os.setpgid(0, 0)
+    time.sleep(60)
+
+
+class StubJob(object):
+    def __init__(self, job_id, job_type):
+        self.job_order = {"job_id": job_id, "type": job_type}
+
+
+class TestJobScheduler(unittest.TestCase):
+
+    def test_order(self):
+        scheduler = JobScheduler()
+        self.assertEqual(scheduler.next_start(), None)
+        self.assertTrue(scheduler.add({"job_id": 1, "start_scheduled": 300}))
+        self.assertTrue(scheduler.add({"job_id": 2, "start_scheduled": "100"}))
+        self.assertTrue(scheduler.add({"job_id": 3, "start_scheduled": 100}))
+        self.assertEqual(scheduler.next_start(), 100)
+        self.assertEqual(scheduler.pop_due(now=99), None)
+        self.assertEqual(scheduler.pop_due(now=100)["job_id"], 2)
+        self.assertEqual(scheduler.pop_due(now=100)["job_id"], 3)
+        self.assertEqual(scheduler.pop_due(now=100), None)
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler.pop_due(now=1000)["job_id"], 1)
+
+    def test_duplicates(self):
+        scheduler = JobScheduler()
+        self.assertTrue(scheduler.add({"job_id": "5", "start_scheduled": 100}))
+        self.assertFalse(scheduler.add({"job_id": 5, "start_scheduled": 100}))
+        self.assertEqual(len(scheduler), 1)
+        scheduler.pop_due(now=100)
+        # A started job can be queued again, e.g. when it's resumed
+        self.assertTrue(scheduler.add({"job_id": "5", "start_scheduled": 100}))
+
+    def test_priority(self):
+        scheduler = JobScheduler(priorities={"restore": 0, "backup": 10})
+        scheduler.add({"job_id": 1, "type": "backup", "start_scheduled": 100})
+        scheduler.add({"job_id": 2, "type": "restore", "start_scheduled": 200})
+        scheduler.add({"job_id": 3, "type": "restore", "start_scheduled": 300})
+        self.assertEqual(scheduler.peek_due(now=100)["job_id"], 1)
+        # The restore that is due outranks the backup that has waited longer
+        self.assertEqual(scheduler.pop_due(now=250)["job_id"], 2)
+        self.assertEqual(scheduler.pop_due(now=250)["job_id"], 1)
+        self.assertEqual(scheduler.next_start(), 300)
+        self.assertEqual(scheduler.pop_due(now=300)["job_id"], 3)
+        self.assertEqual(len(scheduler), 0)
+
+    def test_wakeup(self):
+        agent = twindb_agent.agent.Agent.__new__(twindb_agent.agent.Agent)
+        agent.loop = StubLoop()
+        agent.scheduler = JobScheduler()
+        agent.poll_interval = lambda: 60
+        agent.schedule_wakeup()
+        agent.scheduler.add({"job_id": 1, "start_scheduled": int(time.time()) + 10})
+        agent.schedule_wakeup()
+        self.assertEqual(agent.loop.timers[0], (60, agent.wakeup))
+        self.assertTrue(8 <= agent.loop.timers[1][0] <= 10)
+
+
+class TestPreemption(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = twindb_agent.agent.Agent.__new__(twindb_agent.agent.Agent)
+        self.agent.config = twindb_agent.config.AgentConfig()
+        self.agent.config.job_preemption = "cancel"
+        self.agent.logger = logging.getLogger("twindb_local")
+        self.agent.loop = StubLoop()
+        self.agent.scheduler = JobScheduler(priorities=self.agent.config.job_priorities)
+        self.agent.job_aborted = False
+        self.agent.job_deadline = None
+        self.agent.next_cancel_check = time.time() + 60
+        self.agent.job_metrics, _ = multiprocessing.Pipe(duplex=False)
+        self.agent.job = StubJob("1", "backup")
+        self.agent.job_proc = multiprocessing.Process(target=backup_job)
+        self.agent.job_proc.start()
+        while os.getpgid(self.agent.job_proc.pid) != self.agent.job_proc.pid:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.agent.job_proc.terminate()
+        self.agent.job_proc.join()
+
+    def test_cancel(self):
+        self.agent.supervise_job()
+        self.assertFalse(self.agent.job_aborted)
+        self.agent.scheduler.add({"job_id": "2", "type": "send_key"})
+        self.agent.supervise_job()
+        self.assertTrue(self.agent.job_aborted)
+        self.assertEqual(self.agent.loop.executed[-1][1][2], twindb_agent.job.JOB_PREEMPTED)
+
+    def test_pause(self):
+        # Pausing isn't supported, the urgent job waits
+        self.agent.config.job_preemption = "pause"
+        self.agent.scheduler.add({"job_id": "2", "type": "send_key"})
+        self.agent.supervise_job()
+        self.assertFalse(self.agent.job_aborted)
+
+if __name__ == '__main__':
+    unittest.main()
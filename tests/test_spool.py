@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_spool
+----------------------------------
+
+Tests for `twindb_agent.spool` module.
+"""
+
+import shutil
+import tempfile
+import unittest
+
+import twindb_agent.config
+from twindb_agent.spool import Spool
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.saved_config = twindb_agent.config.AgentConfig._instance
+        twindb_agent.config.AgentConfig._instance = twindb_agent.config.AgentConfig(check_period=60)
+        self.spool = Spool(spool_dir=self.spool_dir)
+        self.sent = []
+
+    def tearDown(self):
+        twindb_agent.config.AgentConfig._instance = self.saved_config
+        shutil.rmtree(self.spool_dir)
+
+    def send(self, request):
+        self.sent.append(request)
+        return True
+
+    @staticmethod
+    def fail(request):
+        return False
+
+    def test_append_replay(self):
+        self.assertFalse(self.spool.pending())
+        self.assertEqual(self.spool.append({"type": "notify", "params": {"event": "start_job"}}), 1)
+        self.assertEqual(self.spool.append({"type": "notify", "params": {"event": "stop_job"}}), 2)
+        self.assertTrue(self.spool.pending())
+        self.assertEqual(self.spool.replay(self.send, now=0), 2)
+        self.assertEqual([r["params"]["event"] for r in self.sent], ["start_job", "stop_job"])
+        self.assertEqual([r["seq"] for r in self.sent], [1, 2])
+        self.assertFalse(self.spool.pending())
+        # Sequence numbers keep growing after replay
+        self.assertEqual(self.spool.append({"type": "log", "params": {}}), 3)
+
+    def test_replay_backoff(self):
+        self.spool.append({"type": "notify", "params": {}})
+        self.assertEqual(self.spool.replay(self.fail, now=1000), 0)
+        self.assertTrue(1030 <= self.spool.next_replay <= 1060)
+        # Too early for the next attempt
+        self.assertEqual(self.spool.replay(self.send, now=1001), 0)
+        self.spool.replay(self.fail, now=1060)
+        self.assertTrue(1120 <= self.spool.next_replay <= 1180)
+        self.assertEqual(self.spool.replay(self.send, now=1180), 1)
+        self.assertEqual(self.spool.next_replay, 0)
+
+    def test_batch(self):
+        self.spool.batch_size = 2
+        for i in range(3):
+            self.spool.append({"type": "log", "params": {"msg": str(i)}})
+        # Replay goes on batch by batch while requests are delivered
+        self.assertEqual(self.spool.replay(self.send, now=0), 3)
+        self.assertEqual([r["params"]["msg"] for r in self.sent], ["0", "1", "2"])
+        self.assertFalse(self.spool.pending())
+        self.sent = []
+        for i in range(5):
+            self.spool.append({"type": "log", "params": {"msg": str(i)}})
+        self.assertEqual(self.spool.replay(lambda r: len(self.sent) < 3 and self.send(r), now=0), 3)
+        self.assertTrue(self.spool.next_replay > 0)
+        self.assertEqual(self.spool.replay_batch(self.send), (2, False))
+
+    def test_max_size(self):
+        self.spool.max_size = 400
+        self.assertTrue(self.spool.append({"type": "update_backup_data", "params": {"name": "x" * 100}}))
+        self.assertTrue(self.spool.append({"type": "log", "params": {"msg": "y" * 100}}))
+        # The log record is dropped to make room
+        self.assertTrue(self.spool.append({"type": "notify", "params": {"event": "z" * 100}}))
+        self.assertTrue(self.spool.size() <= 400)
+        # Nothing else can be dropped
+        self.assertEqual(self.spool.append({"type": "notify", "params": {"event": "z" * 100}}), None)
+        self.spool.replay(self.send, now=0)
+        self.assertEqual([r["type"] for r in self.sent], ["update_backup_data", "notify"])
+
+    def test_interrupted_append(self):
+        self.spool.append({"type": "notify", "params": {}})
+        with open(self.spool.journal, "a") as f:
+            f.write('{"seq": 2, "req')
+        self.spool.append({"type": "log", "params": {}})
+        self.spool.replay(self.send, now=0)
+        self.assertEqual([r["seq"] for r in self.sent], [1, 3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_status
+----------------------------------
+
+Tests for `twindb_agent.status` module.
+"""
+
+import math
+import unittest
+
+from twindb_agent.status import StatusCollector, rates
+
+
+class TestStatusCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.status = {"Questions": 1000, "Threads_running": 3, "Innodb_rows_read": 50}
+        self.collector = StatusCollector(interval=1, variables=["Questions", "Threads_running", "Innodb_rows_read",
+                                                                "Innodb_row_lock_waits"], size=100)
+        self.collector.query = lambda sql: [{"Variable_name": k, "Value": str(v)} for k, v in self.status.items()]
+
+    def test_rates(self):
+        result = rates([10, 5, 7], [30, 2, 3], 2.0, [False, True, False])
+        self.assertEqual(result[:2], [10.0, 2])
+        self.assertTrue(math.isnan(result[2]))
+
+    def test_downsample(self):
+        self.assertTrue(self.collector.sample(now=1000))
+        self.assertEqual(self.collector.latest(), {})
+        for i in range(1, 13):
+            self.status["Questions"] += 10 * i
+            self.status["Threads_running"] = i
+            self.collector.sample(now=1000 + 10 * i)
+        self.assertEqual(self.collector.latest()["Questions"], 12.0)
+
+        batch = self.collector.downsample(60)
+        self.assertEqual(batch["timestamps"], [960, 1020, 1080])
+        self.assertEqual(batch["metrics"]["Questions"], [1.0, 4.5, 10.0])
+        self.assertEqual(batch["metrics"]["Threads_running"], [1.0, 4.5, 10.0])
+        self.assertEqual(batch["metrics"]["Innodb_rows_read"], [0.0, 0.0, 0.0])
+        # The server doesn't have the variable
+        self.assertEqual(batch["metrics"]["Innodb_row_lock_waits"], [None, None, None])
+        self.assertEqual(self.collector.downsample(60)["timestamps"], [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_twindb_mysql
+----------------------------------
+
+Tests for privilege snapshots in `twindb_agent.twindb_mysql` module.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mysql.connector
+
+import twindb_agent.config
+from twindb_agent.twindb_mysql import MySQL
+
+
+class FakeCursor(object):
+    def __init__(self, server):
+        self.server = server
+        self.rows = []
+
+    def execute(self, query, params=None):
+        self.server.queries.append(query)
+        if query.startswith("SHOW GLOBAL STATUS"):
+            self.rows = [{"Variable_name": name, "Value": str(value)} for name, value in self.server.status.items()]
+        elif "CURRENT_USER" in query:
+            self.rows = [{"curr_user": "twindb_agent@localhost"}]
+        elif "user_privileges" in query:
+            self.rows = [{u"privilege_type": p, u"is_grantable": "YES"} for p in self.server.privileges]
+        else:
+            self.rows = [{u"privilege_type": p} for p in ["INSERT", "UPDATE"]]
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(mysql.connector.MySQLConnection):
+    def __init__(self, server):
+        self.server = server
+
+    def cursor(self, dictionary=False):
+        return FakeCursor(self.server)
+
+    def close(self):
+        pass
+
+
+class TestPrivilegeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved_config = twindb_agent.config.AgentConfig._instance
+        config = twindb_agent.config.AgentConfig()
+        config.privilege_cache_file = os.path.join(self.tmp_dir, "privileges.json")
+        twindb_agent.config.AgentConfig._instance = config
+        self.queries = []
+        self.status = {"Com_grant": 1, "Com_revoke": 0, "Uptime": 100}
+        self.privileges = ["RELOAD", "SUPER", "LOCK TABLES", "REPLICATION CLIENT", "CREATE TABLESPACE"]
+        self.mysql = MySQL(mysql_user="twindb_agent", mysql_password="secret")
+        self.mysql.get_mysql_connection = lambda: FakeConnection(self)
+
+    def tearDown(self):
+        twindb_agent.config.AgentConfig._instance = self.saved_config
+        shutil.rmtree(self.tmp_dir)
+
+    def test_snapshot(self):
+        self.assertEqual(self.mysql.has_mysql_access(), (True, []))
+        self.assertEqual(len(self.queries), 4)
+        # Only the grant signal is read while privileges don't change
+        self.status["Uptime"] = 200
+        self.assertEqual(self.mysql.has_mysql_access(grant_capability=False), (True, []))
+        self.assertEqual(len(self.queries), 5)
+
+        self.privileges.remove("SUPER")
+        self.status["Com_revoke"] = 1
+        self.assertEqual(self.mysql.has_mysql_access(), (False, ["SUPER"]))
+        self.assertEqual(len(self.queries), 9)
+
+        # The server restarted
+        self.privileges.append("SUPER")
+        self.status["Uptime"] = 10
+        snapshot = self.mysql.get_privileges(FakeConnection(self))
+        self.assertEqual(snapshot["user"], "twindb_agent@localhost")
+        self.assertEqual(snapshot["privileges"]["SUPER"], "YES")
+        self.assertEqual(snapshot["mysql_privileges"], ["INSERT", "UPDATE"])
+
+    def test_option_file_user(self):
+        # Credentials come from an option file, there is no user name in the config
+        self.mysql.mysql_user = None
+        self.assertEqual(self.mysql.has_mysql_access(), (True, []))
+        self.assertEqual(len(self.queries), 4)
+        self.assertEqual(self.mysql.has_mysql_access(), (True, []))
+        self.assertEqual(len(self.queries), 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_utils
+----------------------------------
+
+Tests for `twindb_agent.utils` module.
+"""
+
+import unittest
+
+from twindb_agent.utils import RingBuffer
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_wrap(self):
+        ring = RingBuffer(3)
+        self.assertEqual(list(ring.values()), [])
+        for value in range(1, 6):
+            ring.append(value)
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(list(ring.values()), [3.0, 4.0, 5.0])
+        ring.clear()
+        ring.append(7)
+        self.assertEqual(list(ring.values()), [7.0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_wire
+----------------------------------
+
+Tests for `twindb_agent.wire` module.
+"""
+
+import unittest
+
+import twindb_agent.api
+import twindb_agent.config
+import twindb_agent.gpg
+import twindb_agent.httpclient
+from twindb_agent import wire
+
+from tests.benchmarks.dispatcher import FakeDispatcher
+from tests.benchmarks.fleet import SimulatedGPG
+
+
+class TestWire(unittest.TestCase):
+
+    def test_json(self):
+        msg = {"type": "get_job", "params": {}}
+        data, encoding = wire.encode(msg, "json+zlib")
+        # Short messages aren't compressed
+        self.assertEqual(encoding, "json")
+        self.assertEqual(wire.decode(data, encoding), msg)
+
+    def test_zlib(self):
+        msg = {"type": "log", "params": {"msg": "x" * 4096}}
+        data, encoding = wire.encode(msg, "json+zlib")
+        self.assertEqual(encoding, "json+zlib")
+        self.assertTrue(len(data) < 1024)
+        self.assertEqual(wire.decode(data, encoding), msg)
+
+    def test_unsupported(self):
+        self.assertRaises(wire.WireFormatException, wire.encode, {}, "xml")
+        self.assertRaises(wire.WireFormatException, wire.decode, "{}", "json+lzma")
+        self.assertRaises(wire.WireFormatException, wire.decode, "garbage", "json+zlib")
+
+
+class TestNegotiation(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = [(twindb_agent.config.AgentConfig, "_instance", twindb_agent.config.AgentConfig._instance),
+                      (twindb_agent.gpg, "TwinDBGPG", twindb_agent.gpg.TwinDBGPG),
+                      (twindb_agent.httpclient, "_breaker", twindb_agent.httpclient._breaker),
+                      (twindb_agent.httpclient, "_compact", twindb_agent.httpclient._compact)]
+        self.dispatcher = None
+
+    def tearDown(self):
+        for obj, attr, value in self.saved:
+            setattr(obj, attr, value)
+        if self.dispatcher:
+            self.dispatcher.stop()
+
+    def call(self, compact):
+        self.dispatcher = FakeDispatcher(plaintext=True, compact=compact)
+        self.dispatcher.start()
+        twindb_agent.config.AgentConfig._instance = twindb_agent.config.AgentConfig(api_host=self.dispatcher.address)
+        twindb_agent.gpg.TwinDBGPG = SimulatedGPG
+        twindb_agent.httpclient._breaker = twindb_agent.httpclient.CircuitBreaker()
+        twindb_agent.httpclient._compact = None
+        for i in range(2):
+            api = twindb_agent.api.TwinDBAPI()
+            self.assertEqual(api.call({"type": "get_config", "params": {}}), self.dispatcher.server_config)
+
+    def test_compact_dispatcher(self):
+        self.call(compact=True)
+        self.assertTrue(twindb_agent.httpclient._compact)
+
+    def test_legacy_dispatcher(self):
+        self.call(compact=False)
+        self.assertEqual(twindb_agent.httpclient._compact, None)
+
+    def test_encrypt_failure(self):
+        class BrokenGPG(SimulatedGPG):
+            def encrypt(self, msg, armor=True, compress=True):
+                return None
+
+        self.call(compact=True)
+        twindb_agent.gpg.TwinDBGPG = BrokenGPG
+        api = twindb_agent.api.TwinDBAPI()
+        self.assertEqual(api.call({"type": "get_config", "params": {}}), None)
+        self.assertFalse(api.success)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_xbstream
+----------------------------------
+
+Tests for `twindb_agent.xbstream` module.
+"""
+
+import struct
+import unittest
+from StringIO import StringIO
+
+from twindb_agent.xbstream import XBStreamException, filter_stream, read_chunks, table_filter
+
+
+def payload_chunk(path, payload, offset=0):
+    return "XBSTCK01" + "\0P" + struct.pack("<I", len(path)) + path + \
+        struct.pack("<QQI", len(payload), offset, 0) + payload
+
+
+def sparse_chunk(path, payload):
+    sparse_map = struct.pack("<II", 4096, len(payload))
+    return "XBSTCK01" + "\0S" + struct.pack("<I", len(path)) + path + struct.pack("<I", 1) + \
+        struct.pack("<QQI", len(payload), 0, 0) + sparse_map + payload
+
+
+def eof_chunk(path):
+    return "XBSTCK01" + "\0E" + struct.pack("<I", len(path)) + path
+
+
+class TestXBStream(unittest.TestCase):
+
+    def test_read_chunks(self):
+        chunks = [payload_chunk("ibdata1", "x" * 100), sparse_chunk("db/t1.ibd", "y" * 10), eof_chunk("ibdata1")]
+        self.assertEqual(list(read_chunks(StringIO("".join(chunks)))),
+                         zip(["ibdata1", "db/t1.ibd", "ibdata1"], chunks))
+        self.assertRaises(XBStreamException, list, read_chunks(StringIO(chunks[0][:-1])))
+        self.assertRaises(XBStreamException, list, read_chunks(StringIO("XBSTCK02")))
+
+    def test_table_filter(self):
+        keep = table_filter(["shop.orders"])
+        for path in ["ibdata1", "undo001", "xtrabackup_checkpoints", "backup-my.cnf", "shop/orders.frm",
+                     "shop/orders.ibd", "shop/orders.ibd.delta", "shop/orders#P#p0.ibd", "shop/orders.par",
+                     "shop/orders.MYD", "shop/orders.MYI", "shop/orders.CSV", "shop/orders.CSM", "shop/orders.ARZ"]:
+            self.assertTrue(keep(path), path)
+        for path in ["shop/orders_archive.ibd", "shop/users.ibd", "shop/users.MYD", "mysql/user.frm",
+                     "crm/orders.ibd"]:
+            self.assertFalse(keep(path), path)
+        self.assertRaises(XBStreamException, table_filter, ["orders"])
+
+    def test_filter_stream(self):
+        chunks = [payload_chunk("ibdata1", "a" * 10), payload_chunk("shop/users.ibd", "b" * 1000),
+                  payload_chunk("shop/orders.ibd", "c" * 10), eof_chunk("shop/users.ibd"),
+                  eof_chunk("shop/orders.ibd")]
+        dst = StringIO()
+        stats = filter_stream(StringIO("".join(chunks)), dst, table_filter(["shop.orders"]))
+        self.assertEqual(dst.getvalue(), chunks[0] + chunks[2] + chunks[4])
+        self.assertEqual(stats["paths"], set(["ibdata1", "shop/orders.ibd"]))
+        self.assertEqual(stats["skipped"], len(chunks[1]) + len(chunks[3]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,6 +30,9 @@ def get_opt_parser():
                       action="store_true", dest="debug", default=False)
     parser.add_option("--debug-local", help="Print debug information but don't send it to dispatcher",
                       action="store_true", dest="debug_local", default=False)
+    parser.add_option("--profile", help="Profile jobs and poll cycles of the agent. "
+                                        "Profiles are saved in profile_dir from the agent config",
+                      action="store_true", dest="profile", default=False)
 
     return parser
 
@@ -52,6 +55,9 @@ def main():
 
     os.environ["PATH"] += ":/sbin:/usr/sbin"
     read_agent_config(options)
+    if options.profile:
+        # Isn't saved in the config file, profiling is enabled for this run only
+        twindb_agent.config.AgentConfig.get_config().profile = True
 
     # Create loggers
     if options.debug_local:
@@ -0,0 +1,156 @@
+"""
+Resource usage of jobs
+
+A job process starts an account with start_job(). Pipeline stages wait for their processes with
+JobAccount.wait(), so CPU time, peak RSS and I/O of every stage are recorded.
+The summary is reported in the stop_job event.
+"""
+import errno
+import os
+import resource
+import time
+import twindb_agent.metrics
+
+# The longest interval between checks if a stage process has exited
+EXIT_CHECK_MAX = 1.0
+
+_account = None
+
+
+def read_proc_io(pid="self"):
+    """
+    Reads I/O counters of a process
+    :param pid: process id
+    :return: dictionary with rchar, wchar, read_bytes and write_bytes or None if they aren't available
+    """
+    try:
+        with open("/proc/%s/io" % pid) as f:
+            counters = {}
+            for line in f:
+                name, _, value = line.partition(":")
+                counters[name.strip()] = int(value)
+    except (IOError, ValueError):
+        return None
+    return dict((k, counters.get(k, 0)) for k in ["rchar", "wchar", "read_bytes", "write_bytes"])
+
+
+def _proc_state(pid):
+    """
+    :return: process state letter from /proc/<pid>/stat or None if it's not available
+    """
+    try:
+        with open("/proc/%s/stat" % pid) as f:
+            # Process name may contain spaces, the state follows the closing parenthesis
+            return f.read().rpartition(")")[2].split()[0]
+    except (IOError, IndexError):
+        return None
+
+
+def _io_delta(before, after):
+    if not before or not after:
+        return {}
+    return dict((k, after[k] - before[k]) for k in after)
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class JobAccount(object):
+    def __init__(self, job_type="unknown"):
+        self.job_type = job_type
+        self.started = time.time()
+        self.rusage_self = resource.getrusage(resource.RUSAGE_SELF)
+        self.rusage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io = read_proc_io()
+        self.stages = []
+        self.network = {"sent": 0, "received": 0}
+
+    def wait(self, proc, stage, started=None, network=None):
+        """
+        Waits for a process of a pipeline stage and records its resource usage
+        :param proc: subprocess.Popen instance
+        :param stage: name of the stage
+        :param started: time when the pipeline was started, the stage's wall time is counted from it
+        :param network: "sent" if the stage uploads data, "received" if it downloads.
+            Bytes the process wrote or read respectively are counted as network bytes
+        :return: exit code of the process
+        """
+        if started is None:
+            started = self.started
+        # I/O counters of an exited process can be read until it's reaped,
+        # so wait until it becomes a zombie, read the counters and only then reap it
+        delay = 0.01
+        while _proc_state(proc.pid) not in [None, "Z"]:
+            time.sleep(delay)
+            delay = min(delay * 2, EXIT_CHECK_MAX)
+        io = read_proc_io(proc.pid)
+        try:
+            pid, status, rusage = os.wait4(proc.pid, 0)
+        except OSError as err:
+            if err.errno != errno.ECHILD:
+                raise
+            # Already reaped, resources of the process are lost
+            proc.wait()
+            rusage = None
+        else:
+            proc.returncode = _exit_code(status)
+        wall_time = time.time() - started
+        twindb_agent.metrics.STAGE_LATENCY.observe(wall_time, self.job_type, stage)
+        record = {"stage": stage, "wall_time": round(wall_time, 3)}
+        if rusage:
+            record["cpu_user"] = round(rusage.ru_utime, 3)
+            record["cpu_sys"] = round(rusage.ru_stime, 3)
+            record["max_rss"] = rusage.ru_maxrss * 1024
+        if io:
+            record.update(io)
+            if network == "sent":
+                self.network["sent"] += io["wchar"]
+            elif network == "received":
+                self.network["received"] += io["rchar"]
+        self.stages.append(record)
+        return proc.returncode
+
+    def summary(self):
+        """
+        :return: resource usage of the job process and its children since the account was started
+        """
+        rusage_self = resource.getrusage(resource.RUSAGE_SELF)
+        rusage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        result = {
+            "wall_time": round(time.time() - self.started, 3),
+            "cpu_user": round(rusage_self.ru_utime - self.rusage_self.ru_utime +
+                              rusage_children.ru_utime - self.rusage_children.ru_utime, 3),
+            "cpu_sys": round(rusage_self.ru_stime - self.rusage_self.ru_stime +
+                             rusage_children.ru_stime - self.rusage_children.ru_stime, 3),
+            # ru_maxrss is in kilobytes on Linux
+            "max_rss": max(rusage_self.ru_maxrss, rusage_children.ru_maxrss) * 1024,
+            "network_bytes_sent": self.network["sent"],
+            "network_bytes_received": self.network["received"],
+            "stages": self.stages
+        }
+        # I/O of reaped children is added to the parent's counters
+        result.update(_io_delta(self.io, read_proc_io()))
+        return result
+
+
+def start_job(job_type):
+    """
+    Starts accounting of the job that runs in this process
+    :return: JobAccount instance
+    """
+    global _account
+    _account = JobAccount(job_type)
+    return _account
+
+
+def get_account():
+    """
+    :return: account of the current job. If no job was started, an account that was started now
+    """
+    global _account
+    if not _account:
+        _account = JobAccount()
+    return _account
@@ -1,14 +1,29 @@
+import errno
+import functools
 import json
 import logging
 import multiprocessing
-import time
+import os
+import signal
+import socket
 import sys
 import fcntl
+import time
 
+import twindb_agent.api
 import twindb_agent.config
 import twindb_agent.gpg
 import twindb_agent.handlers
 import twindb_agent.job
+import twindb_agent.journal
+import twindb_agent.loop
+import twindb_agent.metrics
+import twindb_agent.poll
+import twindb_agent.profiler
+import twindb_agent.replication
+import twindb_agent.scheduler
+import twindb_agent.spool
+import twindb_agent.status
 import twindb_agent.utils
 
 
@@ -17,44 +32,472 @@ class Agent(object):
         self.config = twindb_agent.config.AgentConfig.get_config()
         self.logger = logging.getLogger("twindb_remote")
         self.gpg = twindb_agent.gpg.TwinDBGPG()
+        self.poll = self.get_poll_scheduler(self.config)
+        self.spool = twindb_agent.spool.Spool()
+        # True while the spool is being replayed in the thread pool
+        self.spool_replaying = False
+        self.journal = twindb_agent.journal.JobJournal()
+        # Jobs left unfinished by the previous agent process are reconciled in the first poll cycle.
+        # Jobs whose processes were still running then are checked again in later cycles
+        self.reconciled = False
+        self.unreconciled_jobs = None
+        # Received job orders wait here for their start time
+        self.scheduler = twindb_agent.scheduler.JobScheduler(priorities=self.config.job_priorities)
+        self.loop = None
+        self.registered = False
+        # Process of the running job and connection it sends its metrics to
+        self.job_proc = None
+        self.job_metrics = None
+        self.job = None
+        self.job_deadline = None
+        self.job_aborted = False
+        self.next_cancel_check = 0
+        # Long-running jobs that run beside the serial jobs: job_id -> (process, metrics connection, job)
+        self.background_jobs = {}
+        self.next_background_cancel_check = 0
+        self.metrics_server = None
+        # Profiles poll cycles and reports if profiling is enabled
+        self.profiler = None
         self.logger.debug("Agent initialized")
         pass
 
+    @staticmethod
+    def get_poll_scheduler(config):
+        return twindb_agent.poll.PollScheduler(config.check_period,
+                                               jitter=config.check_period_jitter,
+                                               idle_max=config.check_period_idle_max,
+                                               error_max=config.check_period_error_max,
+                                               long_poll=config.long_poll)
+
     def start(self):
+        """
+        Runs the agent. Dispatcher polls, job supervision and reports are callbacks of the event loop.
+        Everything that blocks runs in the loop's thread pool, jobs run in separate processes.
+        """
         log = self.logger
         log.info("Agent is starting")
-        while True:
-            if self.is_registered():
-                log.debug("Checking if there are any new job orders")
-                job_order = self.get_job_order()
-                if job_order:
-                    log.info("Received job order %s" % json.dumps(job_order, indent=4, sort_keys=True))
-                    job = twindb_agent.job.Job(job_order)
-                    proc = multiprocessing.Process(target=job.process,
-                                                   name="%s-%s" % (job_order["type"], job_order["job_id"]))
-                    proc.start()
-                    # Dispatcher can't handle parallel jobs. Will wait till job finishes.
-                    # After the bug is fixed .join() should be removed
-                    # https://bugs.launchpad.net/twindb/+bug/1484342
-                    proc.join()
-
-                # Report replication status
-                log.debug("Reporting replication status")
-                proc = multiprocessing.Process(target=twindb_agent.handlers.report_show_slave_status,
-                                               name="report_sss")
-                proc.start()
-
-                # Report agent privileges
-                log.debug("Reporting agent granted privileges")
-                proc = multiprocessing.Process(target=twindb_agent.handlers.report_agent_privileges,
-                                               name="report_agent_privileges")
-                proc.start()
-
-                # Calling this has the side affect of "joining" any processes which have already finished.
-                multiprocessing.active_children()
+        if self.config.job_preemption not in [None, "cancel"]:
+            log.warning("job_preemption = %r isn't supported, urgent jobs wait for the running job"
+                        % self.config.job_preemption)
+        if self.config.metrics_port:
+            try:
+                self.metrics_server = twindb_agent.metrics.start_server(self.config.metrics_host,
+                                                                        self.config.metrics_port)
+            except socket.error as err:
+                log.error("Failed to serve metrics on %s:%d: %s"
+                          % (self.config.metrics_host, self.config.metrics_port, err))
+        if self.config.profile:
+            self.profiler = twindb_agent.profiler.CycleProfiler()
+            log.info("Profiling is enabled. Profiles are saved in %s" % self.profiler.profile_dir)
+        if self.config.lag_sample_interval:
+            twindb_agent.replication.start_sampler()
+        if self.config.status_sample_interval:
+            twindb_agent.status.start_collector()
+        self.loop = twindb_agent.loop.EventLoop(workers=self.config.worker_threads)
+        self.loop.call_soon(self.poll_dispatcher)
+        self.loop.call_every(self.config.check_period, self.report, jitter=self.config.check_period_jitter)
+        self.loop.call_every(self.config.job_check_period, self.supervise_background_jobs)
+        # The spool is replayed on its own timer, so it drains while a job runs
+        self.loop.call_every(self.config.check_period, self.drain_spool)
+        self.loop.run()
+
+    def poll_dispatcher(self):
+        """
+        Starts a poll cycle in the thread pool. The next one is scheduled when it's done
+        """
+        run_cycle = self.run_cycle
+        if self.profiler:
+            run_cycle = self.profiler.wrap("cycle", run_cycle)
+        self.loop.run_in_executor(run_cycle, callback=self.cycle_done)
+
+    def cycle_done(self, result, error):
+        if error:
+            self.poll.error()
+        self.schedule_wakeup()
+
+    def schedule_wakeup(self):
+        """
+        Schedules the next poll of the dispatcher or the start of the next queued job, whichever comes first
+        """
+        delay = self.poll_interval()
+        next_start = self.scheduler.next_start()
+        if next_start is not None:
+            delay = min(delay, max(0, next_start - time.time()))
+        self.loop.call_later(delay, self.wakeup)
+
+    def wakeup(self):
+        """
+        Starts a due job if there is one, otherwise polls the dispatcher
+        """
+        job_order = self.scheduler.pop_due()
+        if job_order and job_order["type"] in self.config.background_job_types:
+            self.loop.run_in_executor(self.run_background_job, args=(job_order,),
+                                      callback=lambda result, error: self.schedule_wakeup())
+        elif job_order:
+            self.loop.run_in_executor(self.run_job, args=(job_order,), callback=self.job_started)
+        else:
+            self.poll_dispatcher()
+
+    def job_started(self, result, error):
+        if self.job_proc:
+            self.supervise_job()
+        else:
+            # The job failed to start. The dispatcher sends it again as long as it isn't started
+            self.schedule_wakeup()
+
+    def supervise_job(self):
+        """
+        Checks the running job. The dispatcher is polled again only when the job is finished
+        """
+        self.collect_job_metrics()
+        if self.job_proc.is_alive():
+            if not self.job_aborted:
+                now = time.time()
+                if self.job_deadline and now >= self.job_deadline:
+                    self.abort_job(twindb_agent.job.JOB_DEADLINE_EXCEEDED)
+                elif not self.preempt_job() and now >= self.next_cancel_check:
+                    self.next_cancel_check = now + self.config.check_period
+                    job_id = self.job.job_order["job_id"]
+                    self.loop.run_in_executor(twindb_agent.handlers.is_job_cancelled, args=(job_id,),
+                                              callback=functools.partial(self.cancel_checked, job_id))
+                    if self.config.job_preemption == "cancel":
+                        self.loop.run_in_executor(self.poll_urgent_jobs)
+            self.loop.call_later(self.config.job_check_period, self.supervise_job)
+            return
+        self.job_proc.join()
+        self.collect_job_metrics()
+        self.job_metrics.close()
+        self.job_metrics = None
+        self.logger.debug("Process %s exited with code %s" % (self.job_proc.name, self.job_proc.exitcode))
+        self.job_proc = None
+        self.job = None
+        self.loop.call_soon(self.wakeup)
+
+    def cancel_checked(self, job_id, cancelled, error):
+        if cancelled and self.job and self.job.job_order["job_id"] == job_id and not self.job_aborted:
+            self.abort_job(twindb_agent.job.JOB_CANCELLED)
+
+    def supervise_background_jobs(self):
+        """
+        Checks long-running jobs. They have no deadline, they run until they fail or are cancelled
+        """
+        check_cancel = time.time() >= self.next_background_cancel_check
+        if check_cancel:
+            self.next_background_cancel_check = time.time() + self.config.check_period
+        for job_id, (proc, metrics, job) in self.background_jobs.items():
+            self.collect_job_metrics(metrics)
+            if proc.is_alive():
+                if check_cancel:
+                    self.loop.run_in_executor(twindb_agent.handlers.is_job_cancelled, args=(job_id,),
+                                              callback=functools.partial(self.background_cancel_checked, job_id))
+                continue
+            proc.join()
+            self.collect_job_metrics(metrics)
+            metrics.close()
+            self.logger.debug("Process %s exited with code %s" % (proc.name, proc.exitcode))
+            del self.background_jobs[job_id]
+
+    def background_cancel_checked(self, job_id, cancelled, error):
+        if cancelled and job_id in self.background_jobs:
+            proc, metrics, job = self.background_jobs.pop(job_id)
+            self.logger.warning("Aborting job %s: cancelled" % job_id)
+            self.loop.run_in_executor(self.terminate_job, args=(proc, job, twindb_agent.job.JOB_CANCELLED),
+                                      callback=lambda result, error: metrics.close())
+
+    def outranks(self, job_order, other):
+        """
+        :return: True if job_order is more urgent than the other job order
+        """
+        return self.scheduler.priority(job_order["type"]) < self.scheduler.priority(other["type"])
+
+    def poll_urgent_jobs(self):
+        """
+        Receives a job order while a job is running, so an urgent job can preempt it
+        """
+        try:
+            job_order = self.get_job_order()
+        except twindb_agent.api.TwinDBAPIException as err:
+            self.logger.error(err)
+            return
+        if job_order:
+            self.logger.info("Received job order %s" % json.dumps(job_order, indent=4, sort_keys=True))
+            self.schedule_job(job_order)
+
+    def preempt_job(self):
+        """
+        Cancels the running job if a more urgent job is due and job_preemption is "cancel"
+        :return: True if the running job is aborted
+        """
+        if self.config.job_preemption != "cancel":
+            return False
+        urgent = self.scheduler.peek_due()
+        if not urgent or not self.outranks(urgent, self.job.job_order):
+            return False
+        self.logger.warning("Job %s is preempted by job %s" % (self.job.job_order["job_id"], urgent["job_id"]))
+        self.abort_job(twindb_agent.job.JOB_PREEMPTED)
+        return True
+
+    def abort_job(self, ret_code):
+        """
+        Stops the running job in the thread pool
+        :param ret_code: JOB_CANCELLED, JOB_DEADLINE_EXCEEDED or JOB_PREEMPTED
+        """
+        reason = {twindb_agent.job.JOB_CANCELLED: "cancelled",
+                  twindb_agent.job.JOB_DEADLINE_EXCEEDED: "deadline exceeded",
+                  twindb_agent.job.JOB_PREEMPTED: "preempted"}[ret_code]
+        self.logger.warning("Aborting job %s: %s" % (self.job.job_order["job_id"], reason))
+        self.job_aborted = True
+        self.loop.run_in_executor(self.terminate_job, args=(self.job_proc, self.job, ret_code))
+
+    def terminate_job(self, proc, job, ret_code):
+        """
+        Kills process group of the job, cleans up after it and reports the job stopped with ret_code
+        """
+        log = self.logger
+        job_id = job.job_order["job_id"]
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            # Pipeline processes may outlive the job process, so the group is killed even if the job has exited
+            try:
+                os.killpg(proc.pid, sig)
+            except OSError as err:
+                if err.errno != errno.ESRCH:
+                    log.error("Failed to kill job %s: %s" % (job_id, err))
+                elif proc.is_alive():
+                    # The job hasn't created its process group yet
+                    os.kill(proc.pid, sig)
+            proc.join(self.config.job_kill_timeout)
+        try:
+            entry = self.journal.get(job_id)
+            if entry:
+                self.journal.cleanup(entry)
+            module_name = "twindb_agent.job_type.%s" % job.job_order["type"]
+            module = __import__(module_name, globals(), locals(), [job.job_order["type"]])
+            if hasattr(module, "cleanup"):
+                module.cleanup(job.job_order, entry)
+        except Exception as err:
+            # The job must be reported stopped whatever went wrong with the cleanup
+            log.error("Failed to clean up after job %s: %s" % (job_id, err))
+        finally:
+            try:
+                self.journal.remove(job_id)
+            except twindb_agent.journal.JobJournalException as err:
+                log.error(err)
+            twindb_agent.handlers.log_job_notify(params={"event": "stop_job",
+                                                         "job_id": int(job_id),
+                                                         "ret_code": ret_code})
+
+    def collect_job_metrics(self, metrics=None):
+        """
+        Adds metrics of the finished job to the agent's ones
+        :param metrics: connection the job sends its metrics to. The running serial job's one by default
+        """
+        if metrics is None:
+            metrics = self.job_metrics
+        try:
+            while metrics.poll():
+                twindb_agent.metrics.REGISTRY.merge(metrics.recv())
+        except (EOFError, IOError):
+            pass
+
+    def run_cycle(self):
+        """
+        Runs one poll of the dispatcher: queues a new job order if there is one.
+        Outcome of the poll is passed to the poll scheduler
+        """
+        log = self.logger
+        self.registered = self.is_registered()
+        if not self.registered:
+            log.warn("This agent(%s) isn't registered" % self.config.server_id)
+            # Registration doesn't change often, no need to ask the dispatcher at full speed
+            self.poll.error()
+            return
+
+        if not self.reconciled:
+            self.reconcile_jobs()
+
+        log.debug("Checking if there are any new job orders")
+        wait = self.config.long_poll
+        next_start = self.scheduler.next_start()
+        if next_start is not None:
+            # Don't hold a long poll past the start of a queued job
+            wait = min(wait, max(0, int(next_start - time.time())))
+        try:
+            response = twindb_agent.handlers.get_job(wait=wait)
+        except twindb_agent.api.TwinDBAPIException as err:
+            log.error(err)
+            self.poll.error()
+            return
+        if response and "next_start_scheduled" in response:
+            self.poll.announce(response["next_start_scheduled"])
+        if response and "job_id" in response:
+            job_order = response
+            log.info("Received job order %s" % json.dumps(job_order, indent=4, sort_keys=True))
+            self.poll.job_received()
+            self.schedule_job(job_order)
+        else:
+            self.poll.idle_cycle()
+
+    def schedule_job(self, job_order):
+        """
+        Queues a job order until its start time
+        """
+        job_id = job_order["job_id"]
+        if self.job and self.job.job_order["job_id"] == job_id or job_id in self.background_jobs:
+            # The dispatcher may send a job that is running if it was polled during the job
+            return
+        if self.scheduler.add(job_order):
+            # Job() decodes params in place, the journal keeps the job order as it was received
+            twindb_agent.journal.record(job_order["job_id"], "received", job_order=dict(job_order))
+            self.logger.info("Job %s is scheduled to start at %s"
+                             % (job_order["job_id"], job_order.get("start_scheduled")))
+
+    def reconcile_jobs(self):
+        """
+        Finishes jobs that the previous agent process left in the job journal.
+        Jobs that haven't started are resumed. If a backup was uploaded its record is sent to the dispatcher.
+        Other jobs can't be resumed, they are reported as failed.
+        After the first pass only jobs that were still running are checked.
+        """
+        log = self.logger
+        try:
+            entries = self.journal.entries()
+        except twindb_agent.journal.JobJournalException as err:
+            log.error(err)
+            return
+        running = set()
+        for entry in entries:
+            job_id = entry["job_id"]
+            state = entry["state"]
+            if self.unreconciled_jobs is not None and job_id not in self.unreconciled_jobs:
+                continue
+            if entry.get("pid") and twindb_agent.journal.is_alive(entry["pid"], entry.get("pid_started")):
+                # The job process outlived the agent, it will notify the dispatcher itself
+                log.info("Job %s is still running in process %d" % (job_id, entry["pid"]))
+                running.add(job_id)
+                continue
+            self.journal.cleanup(entry)
+            if state == "received" and "job_order" in entry:
+                log.info("Resuming job %s" % job_id)
+                self.scheduler.add(entry["job_order"])
+                continue
+            if state == "uploaded":
+                log.info("Saving details of backup copy taken by job %s" % job_id)
+                api = twindb_agent.api.TwinDBAPI()
+                api.call(entry["record_request"], spool=True)
+                if api.success or api.spooled:
+                    state = "recorded"
+            if state == "recorded":
+                log.info("Job %s was interrupted after it had finished" % job_id)
+                ret_code = 0
             else:
-                log.warn("This agent(%s) isn't registered" % self.config.server_id)
-            time.sleep(self.config.check_period)
+                log.error("Job %s was interrupted in state %s and can't be resumed" % (job_id, state))
+                ret_code = -1
+            twindb_agent.handlers.log_job_notify(params={"event": "stop_job",
+                                                         "job_id": int(job_id),
+                                                         "ret_code": ret_code,
+                                                         "interrupted_state": state})
+            try:
+                self.journal.remove(job_id)
+            except twindb_agent.journal.JobJournalException as err:
+                log.error(err)
+        self.unreconciled_jobs = running
+        self.reconciled = not running
+
+    def report(self):
+        """
+        Reports replication status and agent privileges if the agent is registered
+        """
+        if not self.registered:
+            return
+        log = self.logger
+        # Report replication status
+        log.debug("Reporting replication status")
+        self.spawn(twindb_agent.handlers.report_show_slave_status, "report_sss")
+
+        # Report agent privileges
+        log.debug("Reporting agent granted privileges")
+        self.spawn(twindb_agent.handlers.report_agent_privileges, "report_agent_privileges")
+
+        # Report MySQL status metrics
+        self.spawn(twindb_agent.handlers.report_metrics, "report_metrics")
+
+    def drain_spool(self):
+        """
+        Starts replay of the spool in the thread pool unless the previous replay is still running
+        """
+        if self.spool_replaying or not self.spool.pending():
+            return
+        self.spool_replaying = True
+        self.loop.run_in_executor(self.replay_spool, callback=self.spool_replayed)
+
+    def spool_replayed(self, result, error):
+        self.spool_replaying = False
+
+    def replay_spool(self):
+        """
+        Delivers requests that were spooled while the dispatcher was unreachable
+        """
+        try:
+            self.spool.replay(self.send_spooled)
+        except (twindb_agent.spool.SpoolException, IOError, OSError) as err:
+            self.logger.error("Failed to replay spooled requests: %s" % err)
+
+    @staticmethod
+    def send_spooled(request):
+        """
+        :return: True if the dispatcher received the request
+        """
+        api = twindb_agent.api.TwinDBAPI()
+        api.call(request)
+        return api.delivered
+
+    @staticmethod
+    def start_job_process(job_order):
+        """
+        Starts a job order in a separate process
+        :return: tuple (Job, process, connection the job sends its metrics to)
+        """
+        job = twindb_agent.job.Job(job_order)
+        metrics, metrics_conn = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(target=job.run, args=(metrics_conn,),
+                                       name="%s-%s" % (job_order["type"], job_order["job_id"]))
+        proc.start()
+        metrics_conn.close()
+        return job, proc, metrics
+
+    def run_background_job(self, job_order):
+        """
+        Starts a long-running job. It doesn't occupy the serial job slot
+        """
+        job, proc, metrics = self.start_job_process(job_order)
+        self.background_jobs[job_order["job_id"]] = (proc, metrics, job)
+
+    def run_job(self, job_order):
+        """
+        Starts a job order in a separate process
+        """
+        # Dispatcher can't handle parallel jobs. The agent doesn't poll it until the job finishes.
+        # After the bug is fixed supervise_job() shouldn't hold polls
+        # https://bugs.launchpad.net/twindb/+bug/1484342
+        job, self.job_proc, self.job_metrics = self.start_job_process(job_order)
+        self.job = job
+        self.job_deadline = job.get_deadline()
+        self.job_aborted = False
+        self.next_cancel_check = time.time() + self.config.check_period
+
+    def spawn(self, target, name):
+        """
+        Runs target in the thread pool
+        """
+        if self.profiler:
+            target = self.profiler.wrap(name, target)
+        self.loop.run_in_executor(target)
+
+    def poll_interval(self):
+        """
+        :return: time in seconds to sleep before the next iteration of the main loop
+        """
+        return self.poll.next_interval()
 
     @staticmethod
     def stop(signum=None, frame=None):
@@ -97,12 +540,23 @@ class Agent(object):
 
     @staticmethod
     def get_job_order():
-        return twindb_agent.handlers.get_job()
+        """
+        :return: job order or None if there is no job
+        Raises TwinDBAPIException if the dispatcher failed to respond
+        """
+        job_order = twindb_agent.handlers.get_job()
+        if job_order and "job_id" in job_order:
+            return job_order
+        return None
 
     def backup(self):
         log = logging.getLogger("twindb_console")
         if twindb_agent.handlers.schedule_backup():
-            job_order = self.get_job_order()
+            try:
+                job_order = self.get_job_order()
+            except twindb_agent.api.TwinDBAPIException as err:
+                log.error(err)
+                sys.exit(2)
             if job_order:
                 log.info("Received job order %s" % json.dumps(job_order, indent=4, sort_keys=True))
                 if job_order["type"] != "backup":
@@ -118,6 +572,10 @@ class Agent(object):
                     sys.exit(2)
 
                 job = twindb_agent.job.Job(job_order)
+                delay = int(job_order["start_scheduled"] or 0) - time.time()
+                if delay > 0:
+                    log.info("Waiting %d seconds before the backup job is started" % delay)
+                    time.sleep(delay)
                 log.info("Starting backup job")
                 fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
                 if job.process():
@@ -1,7 +1,32 @@
 import json
 import logging
+import re
+import twindb_agent.cache
 import twindb_agent.gpg
 import twindb_agent.httpclient
+import twindb_agent.spool
+import twindb_agent.utils
+import twindb_agent.wire
+
+
+# Errors of the dispatcher that mean it doesn't accept the agent
+AUTH_ERRORS = re.compile(r"not registered|unknown server|auth|permission denied|public key", re.IGNORECASE)
+
+
+class Envelope(object):
+    """
+    Decoded response of the dispatcher
+    """
+    __slots__ = ["success", "data", "error", "debug"]
+
+    def __init__(self, success=False, data=None, error=None, debug=None):
+        self.success = success
+        self.data = data
+        self.error = error
+        self.debug = debug
+
+    def as_dict(self):
+        return {"success": self.success, "data": self.data, "error": self.error, "debug": self.debug}
 
 
 class TwinDBAPI(object):
@@ -13,54 +38,124 @@ class TwinDBAPI(object):
         self.gpg = twindb_agent.gpg.TwinDBGPG(logger_name=logger_name)
         self.logger = logging.getLogger(logger_name)
         self.success = None
+        self.delivered = False
+        self.spooled = False
         self.response = None
+        self.envelope = None
         self.data = None
         self.error = None
         self.debug = None
+        # True if the dispatcher rejected the agent or its response wasn't encrypted for the agent's key
+        self.auth_failed = False
 
-    def call(self, data):
+    def call(self, data, spool=False):
+        """
+        Sends request to the dispatcher
+        :param data: request
+        :param spool: if True and the dispatcher is unreachable the request is saved in the spool
+            and replayed later. The call is successful then, but returns no data.
+            The request is always sent directly first, so a backlog in the spool doesn't delay it
+        :return: "data" of the response
+        """
         log = self.logger
 
         response_body = self.http.get_response(data)
         if not response_body:
+            if spool:
+                return self.spool(data)
             self.success = False
             log.error("Empty response from dispatcher")
             return None
+        self.delivered = True
         try:
-            response_body_decoded = json.JSONDecoder().decode(response_body)
-        except ValueError as err:
+            if self.http.response_encoding:
+                envelope = self.decode_compact(response_body, self.http.response_encoding)
+            else:
+                envelope = self.decode_legacy(response_body)
+        except TwinDBAPIException as err:
             self.success = False
             log.error(err)
+            self.check_auth()
             return None
-        try:
-            self.success = response_body_decoded["success"]
-            self.response = response_body_decoded["response"]
-        except KeyError as err:
-            self.success = False
-            log.error(err)
-            return None
-
-        if self.response:
-            response_decrypted = self.gpg.decrypt(self.response)
-        else:
-            response_decrypted = None
-        log.debug("API response:\n%s" % json.dumps(response_decrypted, indent=4, sort_keys=True))
-        try:
-            self.data = json.JSONDecoder().decode(response_decrypted)["data"]
-        except TypeError:
-            self.data = None
-        try:
-            self.error = json.JSONDecoder().decode(response_decrypted)["error"]
-        except TypeError:
-            self.error = None
-        try:
-            self.debug = json.JSONDecoder().decode(response_decrypted)["debug"]
-        except TypeError:
-            self.debug = None
+        self.envelope = envelope
+        self.success = envelope.success
+        self.data = envelope.data
+        self.error = envelope.error
+        self.debug = envelope.debug
+        log.debug("API response:\n%s", twindb_agent.utils.LazyJSON(envelope.as_dict()))
 
         if not self.success:
             log.warning("Unsucessfull TwinDB API call")
             log.error(self.error)
             log.debug(self.debug)
+            if self.error and AUTH_ERRORS.search(str(self.error)):
+                self.auth_failed = True
+        self.check_auth()
 
         return self.data
+
+    def check_auth(self):
+        """
+        Makes the agent check its registration with the dispatcher if the dispatcher rejected it
+        """
+        if self.auth_failed:
+            self.logger.warning("Dispatcher rejected the agent, registration will be checked again")
+            twindb_agent.cache.registration_cache().invalidate()
+
+    def decode_legacy(self, response_body):
+        """
+        Decodes legacy response. It's JSON with base64 encoded armored ciphertext of the JSON envelope
+        :return: Envelope
+        """
+        try:
+            response_body_decoded = json.loads(response_body)
+            success = response_body_decoded["success"]
+            self.response = response_body_decoded["response"]
+        except (ValueError, KeyError, TypeError) as err:
+            raise TwinDBAPIException("Failed to decode response: %r" % err)
+        if not self.response:
+            return Envelope(success)
+        response_decrypted = self.gpg.decrypt(self.response)
+        if response_decrypted is None:
+            self.auth_failed = True
+            return Envelope(success)
+        try:
+            envelope = json.loads(response_decrypted)
+            return Envelope(success, envelope.get("data"), envelope.get("error"), envelope.get("debug"))
+        except (ValueError, AttributeError) as err:
+            raise TwinDBAPIException("Failed to decode response envelope: %r" % err)
+
+    def decode_compact(self, response_body, encoding):
+        """
+        Decodes compact response. It's binary ciphertext of the serialized envelope
+        :return: Envelope
+        """
+        response_decrypted = self.gpg.decrypt(response_body, armored=False)
+        if response_decrypted is None:
+            self.auth_failed = True
+            raise TwinDBAPIException("Failed to decrypt %s response" % encoding)
+        try:
+            envelope = twindb_agent.wire.decode(response_decrypted, encoding)
+            return Envelope(envelope["success"], envelope.get("data"), envelope.get("error"), envelope.get("debug"))
+        except (twindb_agent.wire.WireFormatException, KeyError, TypeError, AttributeError) as err:
+            raise TwinDBAPIException("Failed to decode %s response: %s" % (encoding, err))
+
+    def spool(self, data):
+        """
+        Saves request in the spool
+        :return: None
+        """
+        try:
+            seq = twindb_agent.spool.Spool().append(data)
+        except (twindb_agent.spool.SpoolException, IOError, OSError) as err:
+            self.logger.error("Failed to spool %s request: %s" % (data["type"], err))
+            seq = None
+        self.success = seq is not None
+        self.spooled = self.success
+        if self.spooled:
+            self.logger.warning("Dispatcher is unreachable. Request %s is spooled with seq %d" % (data["type"], seq))
+        return None
+
+
+class TwinDBAPIException(Exception):
+    pass
@@ -0,0 +1,115 @@
+"""
+Caches of dispatcher responses shared by the agent and its job processes
+"""
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import twindb_agent.config
+
+# Files of the GPG home directory the agent's keys are kept in. Old and new GnuPG formats
+KEYRING_FILES = ["pubring.gpg", "secring.gpg", "pubring.kbx", "private-keys-v1.d"]
+
+
+class SharedCache(object):
+    """
+    Keeps a value in a file, so every process of the agent sees the same copy.
+
+    The file is readable by the owner only, cached values may include credentials.
+    It's replaced atomically, a reader never sees a partially written value.
+    """
+    def __init__(self, path, ttl, logger_name="twindb_local"):
+        """
+        :param path: file to keep the value in
+        :param ttl: seconds the value is fresh after it was stored or revalidated
+        """
+        self.path = path
+        self.ttl = ttl
+        self.logger = logging.getLogger(logger_name)
+
+    def load(self):
+        """
+        :return: cache entry - dictionary with "value", "stored" time and metadata, or None if nothing is cached
+        """
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                self.logger.error("Failed to read cache %s: %s" % (self.path, err))
+            return None
+        except ValueError as err:
+            self.logger.error("Broken cache %s: %s" % (self.path, err))
+            return None
+
+    def is_fresh(self, entry, now=None):
+        if now is None:
+            now = time.time()
+        return entry is not None and 0 <= now - entry.get("stored", 0) < self.ttl
+
+    def get(self):
+        """
+        :return: the cached value if it's fresh, otherwise None
+        """
+        entry = self.load()
+        if self.is_fresh(entry):
+            return entry["value"]
+        return None
+
+    def store(self, value, **meta):
+        """
+        Saves a value. A failure is logged, the cache is an optimization
+        :param meta: details to keep with the value, e.g. its version
+        :return: the saved entry
+        """
+        entry = dict(meta)
+        entry["value"] = value
+        entry["stored"] = time.time()
+        tmp_path = None
+        try:
+            cache_dir = os.path.dirname(self.path) or "."
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, 0700)
+            # Processes and threads storing at the same time write their own files, mkstemp creates them 0600
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".", suffix=".tmp", dir=cache_dir)
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as err:
+            self.logger.error("Failed to save cache %s: %s" % (self.path, err))
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return entry
+
+    def invalidate(self):
+        try:
+            os.remove(self.path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                self.logger.error("Failed to invalidate cache %s: %s" % (self.path, err))
+
+
+def registration_cache():
+    """
+    :return: SharedCache of the agent's registration state
+    """
+    agent_config = twindb_agent.config.AgentConfig.get_config()
+    return SharedCache(agent_config.registration_cache_file, agent_config.registration_cache_ttl)
+
+
+def keyring_fingerprint(gpg_homedir, server_id):
+    """
+    Fingerprint of the agent's key material. It changes when GPG keys are imported, generated or deleted
+    :return: hex digest of server_id and size, mtime and inode of the keyring files
+    """
+    digest = hashlib.sha1(str(server_id))
+    for name in KEYRING_FILES:
+        try:
+            st = os.stat(os.path.join(gpg_homedir, name))
+            digest.update("%s:%d:%r:%d;" % (name, st.st_size, st.st_mtime, st.st_ino))
+        except OSError:
+            digest.update("%s:-;" % name)
+    return digest.hexdigest()
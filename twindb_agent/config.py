@@ -35,6 +35,53 @@ class AgentConfig(object):
 
         self.pid_file = twindb_agent.globals.pid_file
         self.check_period = twindb_agent.globals.check_period
+        self.check_period_jitter = twindb_agent.globals.check_period_jitter
+        self.check_period_idle_max = twindb_agent.globals.check_period_idle_max
+        self.check_period_error_max = twindb_agent.globals.check_period_error_max
+        self.long_poll = twindb_agent.globals.long_poll
+        self.job_check_period = twindb_agent.globals.job_check_period
+        self.job_deadlines = dict(twindb_agent.globals.job_deadlines)
+        self.job_kill_timeout = twindb_agent.globals.job_kill_timeout
+        self.job_priorities = dict(twindb_agent.globals.job_priorities)
+        self.job_preemption = twindb_agent.globals.job_preemption
+        self.background_job_types = list(twindb_agent.globals.background_job_types)
+        self.worker_threads = twindb_agent.globals.worker_threads
+        self.api_connect_timeout = twindb_agent.globals.api_connect_timeout
+        self.api_timeout = twindb_agent.globals.api_timeout
+        self.api_retry_attempts = dict(twindb_agent.globals.api_retry_attempts)
+        self.circuit_breaker_threshold = twindb_agent.globals.circuit_breaker_threshold
+        self.circuit_breaker_reset = twindb_agent.globals.circuit_breaker_reset
+        self.api_wire_format = twindb_agent.globals.api_wire_format
+        self.api_wire_compress = twindb_agent.globals.api_wire_compress
+        self.spool_dir = twindb_agent.globals.spool_dir
+        self.spool_max_size = twindb_agent.globals.spool_max_size
+        self.job_journal_dir = twindb_agent.globals.job_journal_dir
+        self.config_cache_file = twindb_agent.globals.config_cache_file
+        self.config_cache_ttl = twindb_agent.globals.config_cache_ttl
+        self.registration_cache_file = twindb_agent.globals.registration_cache_file
+        self.registration_cache_ttl = twindb_agent.globals.registration_cache_ttl
+        self.privilege_cache_file = twindb_agent.globals.privilege_cache_file
+        self.privilege_cache_ttl = twindb_agent.globals.privilege_cache_ttl
+        self.lag_sample_interval = twindb_agent.globals.lag_sample_interval
+        self.lag_sample_size = twindb_agent.globals.lag_sample_size
+        self.binlog_dir = twindb_agent.globals.binlog_dir
+        self.binlog_chunk_size = twindb_agent.globals.binlog_chunk_size
+        self.binlog_chunk_interval = twindb_agent.globals.binlog_chunk_interval
+        self.binlog_stream_server_id = twindb_agent.globals.binlog_stream_server_id
+        self.backup_manifest = twindb_agent.globals.backup_manifest
+        self.backup_segment_size = twindb_agent.globals.backup_segment_size
+        self.restore_parallelism = twindb_agent.globals.restore_parallelism
+        self.restore_mysqld_user = twindb_agent.globals.restore_mysqld_user
+        self.restore_mysqld_timeout = twindb_agent.globals.restore_mysqld_timeout
+        self.status_sample_interval = twindb_agent.globals.status_sample_interval
+        self.status_history_size = twindb_agent.globals.status_history_size
+        self.status_report_resolution = twindb_agent.globals.status_report_resolution
+        self.status_variables = list(twindb_agent.globals.status_variables)
+        self.metrics_host = twindb_agent.globals.metrics_host
+        self.metrics_port = twindb_agent.globals.metrics_port
+        self.profile = twindb_agent.globals.profile
+        self.profile_dir = twindb_agent.globals.profile_dir
+        self.profile_top = twindb_agent.globals.profile_top
         self.time_zone = twindb_agent.globals.time_zone
 
         self.mysql_user = twindb_agent.globals.mysql_user
@@ -132,6 +179,8 @@ class AgentConfig(object):
                                                             "config_file", "pid_file"]:
                     if isinstance(self.__dict__[var], int):
                         f.write("%s = %d\n" % (var, self.__dict__[var]))
+                    elif not isinstance(self.__dict__[var], basestring):
+                        f.write("%s = %r\n" % (var, self.__dict__[var]))
                     else:
                         if "\n" in self.__dict__[var]:
                             f.write("%s = \"\"\"%s\"\"\"\n" % (var, self.__dict__[var]))
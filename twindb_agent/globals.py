@@ -10,6 +10,99 @@ ssh_port = 4194
 
 pid_file = "/var/run/twindb-agent.pid"
 check_period = 60
+# Poll interval deviates from check_period randomly by this fraction
+check_period_jitter = 0.2
+# The longest poll intervals when the agent is idle and when the dispatcher fails
+check_period_idle_max = 300
+check_period_error_max = 900
+# If non-zero get_job waits on the dispatcher side up to long_poll seconds for a job
+long_poll = 0
+# How often the agent checks if the running job has finished
+job_check_period = 1
+# Jobs are aborted if they run longer than this many seconds. A "deadline" job parameter overrides it
+job_deadlines = {"backup": 24 * 3600, "restore": 24 * 3600, "send_key": 600}
+# Aborted job gets SIGTERM and SIGKILL if it doesn't exit within job_kill_timeout seconds
+job_kill_timeout = 30
+# If several jobs are due the job type with lower number starts first
+job_priorities = {"restore": 0, "send_key": 0, "backup": 10}
+# What happens to a running job when a more urgent job is due:
+#   None - the urgent job waits until the running one finishes
+#   "cancel" - the running job is aborted and its temporary files are removed
+# Jobs can't be paused: a job stopped at an arbitrary moment may hold the spool lock or a MySQL backup lock,
+# and the urgent job would wait for it forever
+# With preemption enabled the agent polls the dispatcher while a job is running
+job_preemption = None
+# Long-running jobs. They run beside other jobs and have no deadline
+background_job_types = ["binlog_stream"]
+# Size of the thread pool for dispatcher calls and reports
+worker_threads = 4
+# Timeouts of requests to the dispatcher in seconds
+api_connect_timeout = 10
+api_timeout = 30
+# Overrides number of attempts for request types, e.g. {"notify": 10}
+api_retry_attempts = {}
+# After this many consecutive failures requests to the dispatcher are suspended for circuit_breaker_reset seconds
+circuit_breaker_threshold = 5
+circuit_breaker_reset = 60
+# Format of messages to the dispatcher: "legacy", "compact" or "auto" to switch to compact
+# when the dispatcher supports it. Compact messages are compressed if api_wire_compress is True
+api_wire_format = "auto"
+api_wire_compress = True
+# Requests that failed to reach the dispatcher are saved here and replayed later
+spool_dir = "/var/spool/twindb"
+spool_max_size = 64 * 1024 * 1024
+# States of unfinished jobs are kept here, so jobs are not lost if the agent restarts
+job_journal_dir = "/var/lib/twindb/jobs"
+# Server config from the dispatcher is cached for config_cache_ttl seconds. 0 disables the cache
+config_cache_file = "/var/lib/twindb/config.json"
+config_cache_ttl = 300
+# Registration of the agent is checked with the dispatcher once in registration_cache_ttl seconds,
+# or sooner if its GPG keys change or the dispatcher rejects the agent
+registration_cache_file = "/var/lib/twindb/registration.json"
+registration_cache_ttl = 3600
+# Privileges of the MySQL user are read again after privilege_cache_ttl seconds,
+# or sooner if the server ran GRANT, REVOKE, user management statements or FLUSH, or restarted
+privilege_cache_file = "/var/lib/twindb/privileges.json"
+privilege_cache_ttl = 600
+# Replication lag is sampled every lag_sample_interval seconds, 0 disables sampling.
+# Up to lag_sample_size samples are kept between replication reports
+lag_sample_interval = 1.0
+lag_sample_size = 3600
+# SHOW GLOBAL STATUS is sampled every status_sample_interval seconds, 0 disables the collector.
+# Up to status_history_size samples are kept, reports average them over status_report_resolution seconds
+status_sample_interval = 10
+status_history_size = 720
+status_report_resolution = 60
+status_variables = ["Questions", "Com_select", "Com_insert", "Com_update", "Com_delete", "Slow_queries",
+                    "Bytes_received", "Bytes_sent", "Threads_running", "Threads_connected",
+                    "Innodb_rows_read", "Innodb_rows_inserted", "Innodb_rows_updated", "Innodb_rows_deleted",
+                    "Innodb_data_read", "Innodb_data_written", "Innodb_os_log_written",
+                    "Innodb_buffer_pool_read_requests", "Innodb_buffer_pool_reads",
+                    "Innodb_buffer_pool_pages_dirty", "Innodb_row_lock_waits"]
+# Binary logs are streamed to binlog_dir and uploaded in chunks of up to binlog_chunk_size bytes.
+# A chunk is uploaded at least every binlog_chunk_interval seconds while there are new events
+binlog_dir = "/var/lib/twindb/binlog"
+binlog_chunk_size = 16 * 1024 * 1024
+binlog_chunk_interval = 60
+# Server id mysqlbinlog uses to connect. It must differ from server ids of the replication topology
+binlog_stream_server_id = 65535
+# With backup_manifest the backup copy is encrypted in segments of about backup_segment_size bytes
+# and a manifest of segments and files is saved next to it. Restores then download only segments they need
+backup_manifest = False
+backup_segment_size = 64 * 1024 * 1024
+# Point-in-time restore downloads restore_parallelism binary log chunks at once and replays them
+# on a temporary mysqld that runs as restore_mysqld_user and must start in restore_mysqld_timeout seconds
+restore_parallelism = 4
+restore_mysqld_user = "mysql"
+restore_mysqld_timeout = 300
+# Metrics in Prometheus text format are served on http://metrics_host:metrics_port/metrics. 0 disables it
+metrics_host = "127.0.0.1"
+metrics_port = 9571
+# Profiling of jobs and poll cycles. Profiles are saved in profile_dir,
+# profile_top slowest functions of a job are reported in its stop_job event
+profile = False
+profile_dir = "/var/lib/twindb/profile"
+profile_top = 10
 time_zone = "UTC"
 mysql_user = None
 mysql_password = None
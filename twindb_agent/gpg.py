@@ -6,6 +6,7 @@ import logging
 import os
 import subprocess
 import twindb_agent.config
+import twindb_agent.metrics
 
 
 class TwinDBGPG(object):
@@ -145,37 +146,45 @@ Expire-Date: 0
             # exit_on_error("Failed to generate GPG keys pair")
         return True
 
-    def encrypt(self, msg):
+    def encrypt(self, msg, armor=True, compress=True):
         """
         Encrypts message with TwinDB public key
         If server_id is non-zero (which means the server is registered)
         signs the message with the server's private key
         :param msg: string to encrypt
+        :param armor: if False returns binary ciphertext as is
+        :param compress: if False gpg doesn't compress the message. Use it if the message is compressed already
         :return:  64-base encoded and encrypted message or None if error happens.
         To read the encrypted message - decrypt and 64-base decode
         """
         log = self.logger
         server_email = "%s@twindb.com" % self.config.server_id
         enc_cmd = ["gpg", "--homedir", self.config.gpg_homedir, "-r", self.config.api_email, "--batch",
-                   "--trust-model", "always",
-                   "--armor", "--sign", "--local-user", server_email, "--encrypt"]
+                   "--trust-model", "always"]
+        if armor:
+            enc_cmd.append("--armor")
+        if not compress:
+            enc_cmd += ["--compress-algo", "none"]
+        enc_cmd += ["--sign", "--local-user", server_email, "--encrypt"]
         cout = "No output"
         cerr = "No output"
         try:
-            log.debug("Encrypting message:")
-            log.debug(msg)
-            log.debug("Encryptor command: ")
-            log.debug(enc_cmd)
-            p = subprocess.Popen(enc_cmd,
-                                 stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            cout, cerr = p.communicate(msg)
+            log.debug("Encrypting message:\n%s", msg)
+            log.debug("Encryptor command: %r", enc_cmd)
+            with twindb_agent.metrics.GPG_LATENCY.time("encrypt"):
+                p = subprocess.Popen(enc_cmd,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+                cout, cerr = p.communicate(msg)
             if p.returncode != 0:
                 raise OSError(p.returncode)
             ct = cout
+            if not armor:
+                log.debug("Encrypted message: %d bytes", len(ct))
+                return ct
             ct_64 = b64encode(ct)
-            log.debug("Encrypted message: " + ct_64)
+            log.debug("Encrypted message: %s", ct_64)
         except OSError as err:
             log.error("Failed to run command %r. %s" % (enc_cmd, err))
             log.error("Failed to encrypt message: " + msg)
@@ -184,10 +193,11 @@ Expire-Date: 0
             return None
         return ct_64
 
-    def decrypt(self, msg_64):
+    def decrypt(self, msg_64, armored=True):
         """
         Decrypts message with local private key
         :param msg_64: 64-base encoded and encrypted message. Before encryption the message was 64-base encoded
+        :param armored: if False msg_64 is binary ciphertext
         :return: Plain text message or None if error happens
         """
         log = self.logger
@@ -198,23 +208,24 @@ Expire-Date: 0
         cerr = "No output"
         gpg_cmd = ["gpg", "--homedir", self.config.gpg_homedir, "-d", "-q"]
         try:
-            log.debug("Decrypting message:")
-            log.debug(msg_64)
-            log.debug("Decryptor command:")
-            log.debug(gpg_cmd)
-            p = subprocess.Popen(gpg_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            msg = b64decode(msg_64)
-            cout, cerr = p.communicate(msg)
+            if armored:
+                log.debug("Decrypting message:\n%s", msg_64)
+            else:
+                log.debug("Decrypting message: %d bytes", len(msg_64))
+            log.debug("Decryptor command: %r", gpg_cmd)
+            msg = b64decode(msg_64) if armored else msg_64
+            with twindb_agent.metrics.GPG_LATENCY.time("decrypt"):
+                p = subprocess.Popen(gpg_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                cout, cerr = p.communicate(msg)
             if p.returncode != 0:
                 raise OSError(p.returncode)
         except OSError as err:
             log.error("Failed to run command %r. %s" % (gpg_cmd, err))
-            log.error("Failed to decrypt message: " + msg_64)
+            log.error("Failed to decrypt message: %r" % msg_64)
             log.error("STDOUT: " + cout)
             log.error("STDERR: " + cerr)
             return None
-        log.debug("Decrypted message:")
-        log.debug(cout)
+        log.debug("Decrypted message:\n%s", cout)
         return cout
 
 
@@ -3,20 +3,32 @@ import logging
 import os
 import subprocess
 import sys
+import twindb_agent.cache
 import twindb_agent.config
 import twindb_agent.httpclient
 import twindb_agent.gpg
+import twindb_agent.replication
+import twindb_agent.status
 import twindb_agent.twindb_mysql
 import twindb_agent.api
 
 
 def get_config():
     """
-    Gets backup config from TwinDB dispatcher
+    Gets backup config from TwinDB dispatcher.
+    The config is cached in a file shared with job processes. When the cached config expires
+    the dispatcher is asked for the config with the cached "config_version". If the version is still current
+    the dispatcher responds {"not_modified": true} instead of sending the config again.
     :return: Backup config or None if error happened
     """
     agent_config = twindb_agent.config.AgentConfig.get_config()
     log = logging.getLogger("twindb_remote")
+    cache = get_config_cache()
+    entry = None
+    if cache:
+        entry = cache.load()
+        if cache.is_fresh(entry):
+            return entry["value"]
     log.debug("Getting config for server_id = %s" % agent_config.server_id)
 
     api = twindb_agent.api.TwinDBAPI()
@@ -26,14 +38,46 @@ def get_config():
             "server_id": agent_config.server_id
         }
     }
+    if entry and entry.get("version"):
+        data["params"]["config_version"] = entry["version"]
     config = api.call(data)
+    if not cache or not api.success or not config:
+        return config
+    if config.get("not_modified") and entry:
+        log.debug("Config version %s is current" % entry["version"])
+        config = entry["value"]
+    cache.store(config, version=config.get("config_version"))
     return config
 
 
-def get_job():
+def get_config_cache():
+    """
+    :return: SharedCache of the server config or None if caching is disabled
+    """
+    agent_config = twindb_agent.config.AgentConfig.get_config()
+    if not agent_config.config_cache_ttl:
+        return None
+    return twindb_agent.cache.SharedCache(agent_config.config_cache_file, agent_config.config_cache_ttl)
+
+
+def invalidate_config():
+    """
+    Drops the cached server config, the next get_config() gets it from the dispatcher
+    """
+    cache = get_config_cache()
+    if cache:
+        logging.getLogger("twindb_local").debug("Server config is changed, dropping the cached one")
+        cache.invalidate()
+
+
+def get_job(wait=0):
     """
     Gets job order from TwinDB dispatcher
-    :return: Job order in python dictionary or None if error happened
+    :param wait: if non-zero the dispatcher holds the request up to wait seconds until a job arrives
+    :return: Job order in python dictionary or None if there is no job.
+    Instead of None the dispatcher may return {"next_start_scheduled": <unix timestamp>}
+    to tell when the next job is scheduled.
+    Raises TwinDBAPIException if the dispatcher failed to respond
     """
     agent_config = twindb_agent.config.AgentConfig.get_config()
     log = logging.getLogger("twindb_remote")
@@ -44,17 +88,30 @@ def get_job():
         "type": "get_job",
         "params": {}
     }
+    if wait:
+        data["params"]["wait"] = wait
     job_order = api.call(data)
+    if not api.success:
+        raise twindb_agent.api.TwinDBAPIException("Failed to get job order from dispatcher")
+    if job_order and job_order.get("config_changed"):
+        invalidate_config()
     return job_order
 
 
 def is_registered():
     """
-    Checks whether the server is registered or not
+    Checks whether the server is registered or not.
+    Positive answer of the dispatcher is cached until it expires or the agent's GPG keys change.
+    An agent that isn't registered asks the dispatcher every time, so it notices the registration at once
     :return: True if registered, False if not so much
     """
     agent_config = twindb_agent.config.AgentConfig.get_config()
     log = logging.getLogger("twindb_console")
+    cache = twindb_agent.cache.registration_cache()
+    fingerprint = twindb_agent.cache.keyring_fingerprint(agent_config.gpg_homedir, agent_config.server_id)
+    entry = cache.load()
+    if cache.is_fresh(entry) and entry.get("fingerprint") == fingerprint:
+        return entry["value"]
     log.debug("Getting registration status for server_id = %s" % agent_config.server_id)
 
     twindb_email = "%s@twindb.com" % agent_config.server_id
@@ -82,8 +139,10 @@ def is_registered():
     api_response = api.call(data)
     if api_response:
         if api_response["registered"]:
+            cache.store(True, fingerprint=fingerprint)
             return True
         else:
+            cache.invalidate()
             return False
     else:
         # API call was unsuccessfull, consider the agent unregistered
@@ -98,6 +157,7 @@ def register(code):
     """
     agent_config = twindb_agent.config.AgentConfig.get_config()
     log = logging.getLogger("twindb_console")
+    twindb_agent.cache.registration_cache().invalidate()
 
     # Check that the agent can connect to local MySQL
     mysql = twindb_agent.twindb_mysql.MySQL(logger_name="twindb_console")
@@ -232,11 +292,12 @@ def commit_registration():
         return False
 
 
-def log_job_notify(params):
+def log_job_notify(params, spool=True):
     """
     Notifies a job event to TwinDB dispatcher
     :param params: { event: "start_job", job_id: job_id } or
              { event: "stop_job", job_id: job_id, ret_code: ret }
+    :param spool: if True the event is spooled when the dispatcher is unreachable
     :return: True of False if error happened
     """
     log = logging.getLogger("twindb_remote")
@@ -247,7 +308,7 @@ def log_job_notify(params):
     }
     job_id = int(params["job_id"])
     api = twindb_agent.api.TwinDBAPI()
-    api.call(data)
+    api.call(data, spool=spool)
     if api.success:
         log.debug("Dispatcher acknowledged job_id = %d notification" % job_id)
         return True
@@ -256,6 +317,23 @@ def log_job_notify(params):
         return False
 
 
+def is_job_cancelled(job_id):
+    """
+    Asks TwinDB dispatcher if a running job is cancelled
+    :param job_id: job id
+    :return: True if the job must be stopped. False if not or if the dispatcher failed to respond
+    """
+    log = logging.getLogger("twindb_remote")
+    log.debug("Checking if job_id = %s is cancelled" % job_id)
+    data = {
+        "type": "get_job_status",
+        "params": {"job_id": job_id}
+    }
+    api = twindb_agent.api.TwinDBAPI()
+    status = api.call(data)
+    return bool(api.success and status and status.get("cancel"))
+
+
 def report_show_slave_status():
     """
     Reports slave status to TwinDB dispatcher
@@ -284,6 +362,10 @@ def report_show_slave_status():
             "mysql_slave_sql_running": ss["mysql_slave_sql_running"],
         }
     }
+    sampler = twindb_agent.replication.get_sampler()
+    if sampler:
+        # Lag statistics since the previous report
+        data["params"]["mysql_lag"] = sampler.summary()
     api = twindb_agent.api.TwinDBAPI()
     api.call(data)
     if not api.success:
@@ -291,6 +373,37 @@ def report_show_slave_status():
     return
 
 
+def report_metrics():
+    """
+    Reports MySQL status collected since the previous report
+    :return: nothing
+    """
+    collector = twindb_agent.status.get_collector()
+    if not collector:
+        return
+    agent_config = twindb_agent.config.AgentConfig.get_config()
+    log = logging.getLogger("twindb_remote")
+    batch = collector.downsample(agent_config.status_report_resolution)
+    if not batch["timestamps"]:
+        return
+    log.debug("Reporting MySQL status for server_id = %s" % agent_config.server_id)
+    data = {
+        "type": "report_metrics",
+        "params": {
+            "server_id": agent_config.server_id,
+            "resolution": agent_config.status_report_resolution,
+            "timestamps": batch["timestamps"],
+            "metrics": batch["metrics"]
+        }
+    }
+    api = twindb_agent.api.TwinDBAPI()
+    # The history is already cleared, the batch waits in the spool while the dispatcher is unreachable
+    api.call(data, spool=True)
+    if not api.success:
+        log.error("Could not report MySQL status to the dispatcher, %d intervals are lost" % len(batch["timestamps"]))
+    return
+
+
 def report_agent_privileges():
     """
     Reports what privileges are given to the agent
@@ -308,10 +421,12 @@ def report_agent_privileges():
                                             mysql_password=server_config["mysql_password"])
 
     con = mysql.get_mysql_connection()
-    cursor = con.cursor()
-    query = "SELECT PRIVILEGE_TYPE FROM information_schema.USER_PRIVILEGES"
-    log.debug("Sending query : %s" % query)
-    cursor.execute(query)
+    if not con:
+        return
+    snapshot = mysql.get_privileges(con)
+    con.close()
+    if not snapshot:
+        return
 
     privileges = {
         "Reload_priv": "N",
@@ -320,7 +435,7 @@ def report_agent_privileges():
         "Super_priv": "N",
         "Create_tablespace_priv": "N"
     }
-    for (priv,) in cursor:
+    for priv in snapshot["privileges"]:
         if priv == "RELOAD":
             privileges["Reload_priv"] = "Y"
         elif priv == "LOCK TABLES":
@@ -366,6 +481,7 @@ def unregister(delete_backups=False):
     api = twindb_agent.api.TwinDBAPI(logger_name="twindb_console")
     api.call(data)
     if api.success:
+        twindb_agent.cache.registration_cache().invalidate()
         log.info("The server is successfully unregistered")
     else:
         log.error("Failed to unregister the agent")
@@ -4,10 +4,163 @@ Class that communicates to TwinDB dispatcher
 import httplib
 import json
 import logging
+import random
 import socket
+import threading
+import time
 import urllib
+import uuid
 import twindb_agent.config
 import twindb_agent.gpg
+import twindb_agent.metrics
+import twindb_agent.utils
+import twindb_agent.wire
+
+
+class RetryPolicy(object):
+    def __init__(self, attempts=3, backoff=1.0, backoff_max=30.0, idempotent=True):
+        """
+        :param attempts: how many times a request is sent before giving up
+        :param backoff: base delay in seconds. The delay doubles after every failed attempt
+        :param backoff_max: the longest delay between attempts
+        :param idempotent: False if the dispatcher must not apply the request twice.
+            Such requests carry an idempotency key, the dispatcher ignores repeated requests with the same key
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.idempotent = idempotent
+
+    def delay(self, attempt):
+        """
+        :param attempt: number of failed attempts so far
+        :return: random delay before the next attempt ("full jitter")
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** (attempt - 1)))
+
+
+# The main loop retries polls and reports on its own, so they fail fast.
+# Job notifications and backup records are worth waiting for, they are spooled only after that.
+# A timed out attempt may have reached the dispatcher, so they are retried and replayed with the same key.
+RETRY_POLICIES = {
+    "get_job": RetryPolicy(attempts=1),
+    "get_job_status": RetryPolicy(attempts=1),
+    "report_sss": RetryPolicy(attempts=1),
+    "report_agent_privileges": RetryPolicy(attempts=1),
+    "log": RetryPolicy(attempts=2, backoff=0.5),
+    "notify": RetryPolicy(attempts=5, idempotent=False),
+    "update_backup_data": RetryPolicy(attempts=5, idempotent=False),
+    "update_binlog_data": RetryPolicy(attempts=5, idempotent=False),
+    "get_backups_chain": RetryPolicy(attempts=5)
+}
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to the dispatcher after too many consecutive failures.
+
+    In "closed" state requests are sent as usual. After threshold consecutive failures
+    the breaker is "open" and requests fail immediately. reset_timeout seconds later
+    it's "half-open": one request goes through and its outcome closes or opens the breaker again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.calls = 0
+        self.short_circuited = 0
+        self.last_latency = None
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def allow(self, now=None):
+        """
+        :return: True if a request may be sent now
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            if self.state == self.CLOSED:
+                return True
+            self.short_circuited += 1
+            return False
+
+    def success(self, latency):
+        with self._lock:
+            self.calls += 1
+            self.last_latency = latency
+            self.failures = 0
+            self.state = self.CLOSED
+            self.opened_at = None
+
+    def failure(self, latency, error, now=None):
+        """
+        :return: True if the breaker has just opened
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self.calls += 1
+            self.last_latency = latency
+            self.last_error = str(error)
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.opened_at = now
+                return True
+            return False
+
+    def get_state(self):
+        """
+        :return: dictionary with breaker state and timings
+        """
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "opened_at": self.opened_at,
+                "calls": self.calls,
+                "short_circuited": self.short_circuited,
+                "last_latency": self.last_latency,
+                "last_error": self.last_error
+            }
+
+
+_breaker = None
+
+
+def get_breaker():
+    """
+    :return: CircuitBreaker shared by all clients in this process
+    """
+    global _breaker
+    if not _breaker:
+        config = twindb_agent.config.AgentConfig.get_config()
+        _breaker = CircuitBreaker(threshold=config.circuit_breaker_threshold,
+                                  reset_timeout=config.circuit_breaker_reset)
+    return _breaker
+
+
+# None until the dispatcher tells whether it supports compact messages
+_compact = None
+
+
+def set_compact(compact):
+    """
+    Remembers whether the dispatcher accepts compact requests
+    """
+    global _compact
+    _compact = compact
 
 
 class TwinDBHTTPClient(object):
@@ -17,12 +170,38 @@ class TwinDBHTTPClient(object):
             self.logger = logging.getLogger(logger_name)
         else:
             self.logger = logging.getLogger("twindb_local")
+        self.breaker = get_breaker()
+        # Encoding of the last response or None if the response is in legacy format
+        self.response_encoding = None
+
+    def use_compact(self):
+        """
+        :return: True if requests should be sent in compact format
+        """
+        if self.config.api_wire_format == "compact":
+            return _compact is not False
+        return self.config.api_wire_format == "auto" and _compact is True
+
+    def get_encoding(self):
+        return twindb_agent.wire.default_encoding(compress=self.config.api_wire_compress)
+
+    def get_retry_policy(self, request_type):
+        policy = RETRY_POLICIES.get(request_type, DEFAULT_RETRY_POLICY)
+        if request_type in self.config.api_retry_attempts:
+            policy = RetryPolicy(attempts=self.config.api_retry_attempts[request_type],
+                                 backoff=policy.backoff, backoff_max=policy.backoff_max,
+                                 idempotent=policy.idempotent)
+        return policy
 
     def get_response(self, request):
         """
         Sends HTTP POST request to TwinDB dispatcher
         It converts python data structure in "data" variable into JSON string,
-        then encrypts it and then sends as variable "data" in HTTP request
+        then encrypts it and then sends as variable "data" in HTTP request.
+        Failed requests are retried according to the request type retry policy.
+        Nothing is sent while the circuit breaker is open.
+        A request that isn't idempotent gets an "idempotency_key". It's added to the request itself,
+        so a spooled copy is replayed with the same key.
         Inputs
             request    - Data structure with variables
         Returns
@@ -30,13 +209,55 @@ class TwinDBHTTPClient(object):
             None    - if error happened or empty response
         """
         log = self.logger
+        policy = self.get_retry_policy(request["type"])
+        if not policy.idempotent and "idempotency_key" not in request:
+            request["idempotency_key"] = uuid.uuid4().hex
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                log.debug("Dispatcher is down, %s request isn't sent" % request["type"])
+                twindb_agent.metrics.API_REQUESTS.inc(request["type"], "short_circuited")
+                return None
+            attempt += 1
+            started = time.time()
+            try:
+                response_body = self.send(request)
+            except TwinDBHTTPClientRetryableException as err:
+                log.error(err)
+                latency = time.time() - started
+                twindb_agent.metrics.API_LATENCY.observe(latency, request["type"])
+                twindb_agent.metrics.API_REQUESTS.inc(request["type"], "error")
+                if self.breaker.failure(latency, err):
+                    log.warning("Dispatcher failed %d times in a row. Requests are suspended for %d seconds"
+                                % (self.breaker.threshold, self.breaker.reset_timeout))
+                if attempt >= policy.attempts:
+                    return None
+                delay = policy.delay(attempt)
+                log.info("Retrying %s request in %.1f seconds" % (request["type"], delay))
+                time.sleep(delay)
+                continue
+            latency = time.time() - started
+            twindb_agent.metrics.API_LATENCY.observe(latency, request["type"])
+            twindb_agent.metrics.API_REQUESTS.inc(request["type"], "ok" if response_body is not None else "empty")
+            self.breaker.success(latency)
+            return response_body
+
+    def send(self, request):
+        """
+        Makes one attempt to send a request
+        Returns
+            String with body of HTTP response
+            None    - if the dispatcher returned an empty response or an HTTP client error
+        Raises TwinDBHTTPClientRetryableException if the dispatcher is unreachable or failed
+        """
+        log = self.logger
         response_body = None
 
-        log.debug("Enter get_response(uri=" + self.config.api_uri + ")")
+        log.debug("Enter send(uri=%s)", self.config.api_uri)
         if self.config.api_proto == "http":
-            conn = httplib.HTTPConnection(self.config.api_host)
+            conn = httplib.HTTPConnection(self.config.api_host, timeout=self.config.api_connect_timeout)
         elif self.config.api_proto == "https":
-            conn = httplib.HTTPSConnection(self.config.api_host)
+            conn = httplib.HTTPSConnection(self.config.api_host, timeout=self.config.api_connect_timeout)
         else:
             raise TwinDBHTTPClientException("Unsupported protocol " + self.config.api_proto)
 
@@ -45,59 +266,70 @@ class TwinDBHTTPClient(object):
         http_response = "Empty response"
         try:
             conn.connect()
-            log.debug("Sending to " + self.config.api_host + ": %s" % json.dumps(request, indent=4, sort_keys=True))
-            data_json = json.dumps(request)
+            # Long poll get_job is held by the dispatcher up to "wait" seconds
+            conn.sock.settimeout(self.config.api_timeout + (request.get("params") or {}).get("wait", 0))
+            log.debug("Sending to %s: %s", self.config.api_host, twindb_agent.utils.LazyJSON(request))
             gpg = twindb_agent.gpg.TwinDBGPG()
-            data_json_enc = gpg.encrypt(data_json)
-            data_json_enc_urlenc = urllib.urlencode({'data': data_json_enc})
-            conn.putrequest('POST', "/" + self.config.api_dir + "/" + self.config.api_uri)
             headers = dict()
-            headers['Content-Length'] = "%d" % (len(data_json_enc_urlenc))
-            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            compact = self.use_compact()
+            if compact:
+                payload, encoding = twindb_agent.wire.encode(request, self.get_encoding())
+                # gpg doesn't need to compress what is compressed already
+                body = gpg.encrypt(payload, armor=False, compress="+zlib" not in encoding)
+                if body is None:
+                    # Nothing is sent, the attempt fails like any other request that got no response
+                    log.error("Failed to encrypt %s request" % request["type"])
+                    return None
+                headers['Content-Type'] = twindb_agent.wire.CONTENT_TYPE
+                headers[twindb_agent.wire.ENCODING_HEADER] = encoding
+            else:
+                data_json = json.dumps(request)
+                data_json_enc = gpg.encrypt(data_json)
+                body = urllib.urlencode({'data': data_json_enc})
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            if self.config.api_wire_format != "legacy":
+                headers[twindb_agent.wire.WIRE_HEADER] = twindb_agent.wire.WIRE_VERSION
+                headers[twindb_agent.wire.ACCEPT_ENCODING_HEADER] = ",".join(twindb_agent.wire.supported_encodings())
+            headers['Content-Length'] = "%d" % (len(body))
+            conn.putrequest('POST', "/" + self.config.api_dir + "/" + self.config.api_uri)
             for k in headers:
                 conn.putheader(k, headers[k])
             conn.endheaders()
-            conn.send(data_json_enc_urlenc)
+            conn.send(body)
             http_response = conn.getresponse()
 
+            self.response_encoding = None
+            if compact and http_response.status == 415:
+                # The dispatcher doesn't understand compact requests anymore
+                log.warning("Dispatcher rejected compact request. Falling back to legacy format")
+                set_compact(False)
+                http_response.read()
+                conn.close()
+                return self.send(request)
             if http_response.status == 200:
                 response_body = http_response.read()
-                log.debug("Response body: '%s'" % response_body)
                 if len(response_body) == 0:
                     return None
-                url = "%(proto)s://%(host)s/%(api_dir)s/%(uri)s" % {
-                    "proto": self.config.api_proto,
-                    "host": self.config.api_host,
-                    "api_dir": self.config.api_dir,
-                    "uri": self.config.api_uri
-                }
-                d = json.JSONDecoder()
-                try:
-                    json.loads(response_body)
-                except ValueError:
-                    msg = response_body
-                else:
-                    msg = json.dumps(d.decode(response_body), indent=4, sort_keys=True)
-                log.debug("Response from %(url)s : '%(resp)s'" % {
-                    "url": url,
-                    "resp": msg
-                })
-            else:
-                pass
-                # log.info("HTTP error %d %s" % (http_response.status, http_response.reason))
-                # log.debug(traceback.format_exc())
+                if http_response.getheader("Content-Type") == twindb_agent.wire.CONTENT_TYPE:
+                    self.response_encoding = http_response.getheader(twindb_agent.wire.ENCODING_HEADER, "json")
+                    if self.config.api_wire_format == "auto" and not compact:
+                        log.info("Dispatcher supports compact messages. Switching to compact format")
+                        set_compact(True)
+                    log.debug("Received %d bytes %s response", len(response_body), self.response_encoding)
+                    return response_body
+                log.debug("Response from %s : '%s'", url, twindb_agent.utils.LazyJSON(response_body))
+            elif http_response.status >= 500:
+                raise TwinDBHTTPClientRetryableException("HTTP error %d %s from %s"
+                                                         % (http_response.status, http_response.reason, url))
         except socket.error as err:
             log.error("Exception while making request " + url)
-            log.error(err)
-            log.error("TwinDB dispatcher is unreachable")
-            return None
+            raise TwinDBHTTPClientRetryableException("TwinDB dispatcher is unreachable: %s" % err)
         except KeyError as err:
             log.error("Failed to decode response from server: %s" % http_response)
             log.error("Could not find key %s" % err)
             return None
         except httplib.BadStatusLine as err:
-            log.error("Exception while making request %s: %s" % (url, err))
-            return None
+            raise TwinDBHTTPClientRetryableException("Exception while making request %s: %s" % (url, err))
         finally:
             conn.close()
         return response_body
@@ -109,3 +341,7 @@ class TwinDBHTTPClientException(Exception):
 
 class TwinDBHTTPClientLoggingException(Exception):
     pass
+
+
+class TwinDBHTTPClientRetryableException(Exception):
+    pass
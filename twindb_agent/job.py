@@ -4,12 +4,23 @@ Classes to work with jobs
 import json
 import logging
 import os
+import signal
 import time
+import twindb_agent.accounting
 import twindb_agent.config
+import twindb_agent.journal
+import twindb_agent.metrics
+import twindb_agent.profiler
 import twindb_agent.twindb_mysql
 import twindb_agent.handlers
 
 
+# stop_job return codes of jobs aborted by the agent
+JOB_CANCELLED = -3
+JOB_DEADLINE_EXCEEDED = -4
+JOB_PREEMPTED = -5
+
+
 class Job(object):
     def __init__(self, job_order, logger_name="twindb_remote"):
         # TODO "params" in a job order is a string on some reason.
@@ -22,6 +33,89 @@ class Job(object):
         self.logger_name = logger_name
         self.logger = logging.getLogger(logger_name)
         self.server_config = twindb_agent.handlers.get_config()
+        self.profiler = None
+        # Resource usage of the job, started when the job is executed
+        self.account = None
+
+    def run(self, metrics_conn=None):
+        """
+        Entry point of the job process
+        :param metrics_conn: multiprocessing connection. Metrics collected by the job are sent there when it's done
+        :return: what process() returns
+        """
+        # The job and its pipeline run in their own process group, so the agent can abort the whole tree
+        os.setpgid(0, 0)
+        # Signal handlers of the agent are inherited by fork, an aborted job just exits
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # The process is forked from the agent, drop metrics of the agent
+        twindb_agent.metrics.REGISTRY.reset()
+        if self.agent_config.profile or self.job_order["params"].get("profile"):
+            self.profiler = twindb_agent.profiler.Profiler()
+            self.profiler.start()
+        try:
+            return self.process()
+        finally:
+            self.stop_profiler()
+            if metrics_conn:
+                metrics_conn.send(twindb_agent.metrics.REGISTRY.snapshot())
+                metrics_conn.close()
+
+    def get_deadline(self):
+        """
+        :return: unix time when the job must be aborted or None if the job has no deadline
+        """
+        timeout = self.job_order["params"].get("deadline")
+        if not timeout:
+            timeout = self.agent_config.job_deadlines.get(self.job_order["type"])
+        if not timeout:
+            return None
+        start = max(time.time(), int(self.job_order.get("start_scheduled") or 0))
+        return start + int(timeout)
+
+    def stop_profiler(self):
+        """
+        Stops profiling the job and saves the profile in <profile_dir>/job_<job_id>.prof
+        :return: list of hotspots or None if the job isn't profiled
+        """
+        if not self.profiler:
+            return None
+        profiler = self.profiler
+        self.profiler = None
+        profiler.stop()
+        path = os.path.join(self.agent_config.profile_dir, "job_%s.prof" % self.job_order["job_id"])
+        try:
+            twindb_agent.profiler.prepare_dir(self.agent_config.profile_dir)
+            profiler.save(path)
+            self.logger.info("Profile of the job is saved in %s" % path, {"job_id": self.job_order["job_id"]})
+        except (IOError, OSError) as err:
+            self.logger.warning("Failed to save profile in %s: %s" % (path, err), {"job_id": self.job_order["job_id"]})
+        return profiler.hotspots(self.agent_config.profile_top)
+
+    def notify_stop(self, ret_code):
+        """
+        Sends stop_job event with resource usage of the job. If the job is profiled the event includes its hotspots.
+        The job is done after that, it's removed from the job journal
+        """
+        params = {"event": "stop_job",
+                  "job_id": int(self.job_order["job_id"]),
+                  "ret_code": ret_code}
+        if self.account:
+            params["resources"] = self.account.summary()
+        hotspots = self.stop_profiler()
+        if hotspots is not None:
+            params["profile"] = hotspots
+        result = twindb_agent.handlers.log_job_notify(params=params)
+        self.forget()
+        return result
+
+    def forget(self):
+        """
+        Removes the job from the job journal
+        """
+        try:
+            twindb_agent.journal.JobJournal().remove(self.job_order["job_id"])
+        except twindb_agent.journal.JobJournalException as err:
+            self.logger.error(err, {"job_id": self.job_order["job_id"]})
 
     def process(self):
         """
@@ -50,38 +144,39 @@ class Job(object):
             if not self.job_order["start_scheduled"]:
                 raise JobError("Job start time isn't set")
 
+            # The agent starts jobs when they are due
             start_scheduled = int(self.job_order["start_scheduled"])
-            now = int(time.time())
-            delay = start_scheduled - now
-            if delay < 0:
-                delay = 0
-            log.info("Wating %d seconds before job is started" % delay, log_params)
-            time.sleep(delay)
+            if start_scheduled > time.time():
+                raise JobTooSoonError("Job %d is scheduled to start in %d seconds"
+                                      % (job_id, start_scheduled - time.time()))
 
+            # A job doesn't start unless the dispatcher knows about it, start_job isn't spooled
             if not twindb_agent.handlers.log_job_notify(params={"event": "start_job",
                                                                 "job_id": job_id,
-                                                                "pid": os.getpid()}):
+                                                                "pid": os.getpid()}, spool=False):
                 raise JobError("Failed to notify dispatcher about job start")
+            twindb_agent.journal.record(job_id, "started", pid=os.getpid())
 
             # Execute a job
             module_name = "twindb_agent.job_type.%s" % self.job_order["type"]
             module = __import__(module_name, globals(), locals(), [self.job_order["type"]])
-            ret = module.execute(self.job_order, self.logger_name)
+            self.account = twindb_agent.accounting.start_job(self.job_order["type"])
+            with twindb_agent.metrics.JOB_LATENCY.time(self.job_order["type"]):
+                ret = module.execute(self.job_order, self.logger_name)
+            twindb_agent.metrics.JOBS.inc(self.job_order["type"], str(ret))
 
             log.info("job_id = %d finished with code %d" % (job_id, ret), log_params)
 
-            twindb_agent.handlers.log_job_notify(params={"event": "stop_job",
-                                                         "job_id": job_id,
-                                                         "ret_code": ret})
+            self.notify_stop(ret)
         except JobError as err:
             log.error("Job error: %s" % err, log_params)
+            twindb_agent.metrics.JOBS.inc(self.job_order["type"], "-1")
 
-            twindb_agent.handlers.log_job_notify(params={"event": "stop_job",
-                                                         "job_id": job_id,
-                                                         "ret_code": -1})
+            self.notify_stop(-1)
             return False
         except JobTooSoonError as err:
             log.debug(err, log_params)
+            self.forget()
             return False
         return True
 
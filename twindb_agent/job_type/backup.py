@@ -1,12 +1,18 @@
 import tempfile
 import datetime
 import fcntl
+import json
+import time
+import twindb_agent.accounting
 import twindb_agent.api
 import twindb_agent.config
 import twindb_agent.gpg
 import twindb_agent.httpclient
+import twindb_agent.journal
+import twindb_agent.manifest
 import twindb_agent.twindb_mysql
 import twindb_agent.utils
+import twindb_agent.xbstream
 
 from twindb_agent.handlers import *
 
@@ -25,6 +31,35 @@ def execute(job_order, logger_name="twindb_remote"):
     return ret
 
 
+def cleanup(job_order, journal_entry, logger_name="twindb_remote"):
+    """
+    Removes partially uploaded backup copy of an aborted backup job
+    :param job_order: job order
+    :param journal_entry: entry of the job in the job journal
+    """
+    log = logging.getLogger(logger_name)
+    log_params = {"job_id": job_order["job_id"]}
+    if not journal_entry or journal_entry["state"] != "streaming" or not journal_entry.get("backup_name"):
+        return
+    agent_config = twindb_agent.config.AgentConfig.get_config()
+    server_config = get_config()
+    backup_name = journal_entry["backup_name"]
+    if not server_config:
+        log.error("Failed to get server config from dispatcher, partial backup copy %s is left" % backup_name,
+                  log_params)
+        return
+    ssh_cmd = ["ssh", "-oStrictHostKeyChecking=no", "-i", agent_config.ssh_private_key_file,
+               "-p", str(agent_config.ssh_port),
+               "user_id_%s@%s" % (server_config["user_id"], job_order["params"]["ip"]), "/bin/rm -f %s" % backup_name]
+    log.info("Removing partial backup copy %s" % backup_name, log_params)
+    try:
+        ret = subprocess.call(ssh_cmd)
+        if ret != 0:
+            log.error("Failed to remove %s, ssh exited with code %d" % (backup_name, ret), log_params)
+    except OSError as err:
+        log.error("Failed to run command %r: %s" % (ssh_cmd, err), log_params)
+
+
 def take_backup_xtrabackup(job_order, logger_name):
     """
     # Takes backup copy with XtraBackup
@@ -89,12 +124,36 @@ def take_backup_xtrabackup(job_order, logger_name):
                 found_lsn = line.split("'")[1]
         return found_lsn
 
-    def record_backup(name, size, backup_lsn=None):
+    def upload_manifest(file_name, manifest):
+        """
+        Encrypts the manifest and saves it in TwinDB storage
+        :param file_name: file name to save the manifest in
+        :param manifest: manifest dictionary
+        :return: True if the manifest is saved
+        """
+        try:
+            data = twindb_agent.manifest.encrypt(json.dumps(manifest))
+        except twindb_agent.manifest.ManifestException as e:
+            log.error("Failed to encrypt manifest. %s" % e, log_params)
+            return False
+        ssh_process = start_ssh_cmd(file_name, subprocess.PIPE, subprocess.PIPE)
+        if not ssh_process:
+            return False
+        cout, cerr = ssh_process.communicate(data)
+        if ssh_process.returncode != 0:
+            log.error("Failed to save manifest %s: %s" % (file_name, cerr), log_params)
+            return False
+        log.info("Saved manifest %s: %d segments, %d files"
+                 % (file_name, len(manifest["segments"]), len(manifest["files"])), log_params)
+        return True
+
+    def record_backup(name, size, backup_lsn=None, manifest_name=None):
         """
         Saves details about backup copy in TwinDB dispatcher
         :param name: name of backup
         :param size: size of the backup in bytes
         :param backup_lsn: last LSN if it was incremental backup
+        :param manifest_name: name of the manifest if the backup copy is segmented
         :return: JSON string with status of the request i.e. { "success": True } or None if error happened
         """
         log.info("Saving information about backup:", log_params)
@@ -113,11 +172,20 @@ def take_backup_xtrabackup(job_order, logger_name):
                 "ancestor": job_order["params"]["ancestor"]
             }
         }
+        if manifest_name:
+            data["params"]["manifest"] = manifest_name
         log.debug("Saving a record %s" % data, log_params)
+        # If the agent restarts before the record is saved, it sends the record when it starts again
+        twindb_agent.journal.record(job_order["job_id"], "uploaded", record_request=data)
         api = twindb_agent.api.TwinDBAPI(logger_name=logger_name)
-        api.call(data)
-        if api.success:
+        api.call(data, spool=True)
+        if api.spooled:
+            log.warning("Backup copy details are spooled until the dispatcher is reachable", log_params)
+            twindb_agent.journal.record(job_order["job_id"], "recorded")
+            return True
+        elif api.success:
             log.info("Saved backup copy details", log_params)
+            twindb_agent.journal.record(job_order["job_id"], "recorded")
             return True
         else:
             log.error("Failed to save backup copy details")
@@ -229,24 +297,50 @@ def take_backup_xtrabackup(job_order, logger_name):
     # Grab an exclusive lock to make sure only one XtrBackup process is runnning
     lockfile = open("/tmp/twindb.xtrabackup.lock", "w+")
     fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+    started = time.time()
     try:
         log.debug("Starting XtraBackup process: %r" % xtrabackup_cmd, log_params)
         xbk_proc = subprocess.Popen(xtrabackup_cmd, stdout=subprocess.PIPE, stderr=err_descriptors["xtrabackup"])
     except OSError as err:
         log.error("Failed to run command %r. %s" % (xtrabackup_cmd, err), log_params)
         return -1
-    gpg_proc = start_gpg_cmd(xbk_proc.stdout, err_descriptors["gpg"])
-    ssh_proc = start_ssh_cmd(backup_name, gpg_proc.stdout, err_descriptors["ssh"])
+    manifest = None
+    account = twindb_agent.accounting.get_account()
+    if agent_config.backup_manifest:
+        # Segments are encrypted by the agent, there is no GPG process in the pipe
+        ssh_proc = start_ssh_cmd(backup_name, subprocess.PIPE, err_descriptors["ssh"])
+        twindb_agent.journal.record(job_order["job_id"], "streaming", backup_name=backup_name,
+                                    processes=[(xbk_proc, "innobackupex"), (ssh_proc, "ssh")],
+                                    tmp_paths=[extra_config])
+        writer = twindb_agent.manifest.SegmentWriter(ssh_proc.stdin, agent_config.backup_segment_size)
+        try:
+            manifest = writer.write_stream(xbk_proc.stdout)
+        except (twindb_agent.manifest.ManifestException, twindb_agent.xbstream.XBStreamException) as err:
+            err_descriptors["gpg"].write(str(err))
+        finally:
+            ssh_proc.stdin.close()
+            xbk_proc.stdout.close()  # Allow xbk_proc to receive a SIGPIPE if segmenting fails.
+        account.wait(xbk_proc, "xtrabackup", started)
+        account.wait(ssh_proc, "ssh", started, network="sent")
+        ret_code_gpg = 0 if manifest else 1
+    else:
+        gpg_proc = start_gpg_cmd(xbk_proc.stdout, err_descriptors["gpg"])
+        ssh_proc = start_ssh_cmd(backup_name, gpg_proc.stdout, err_descriptors["ssh"])
+        twindb_agent.journal.record(job_order["job_id"], "streaming", backup_name=backup_name,
+                                    processes=[(xbk_proc, "innobackupex"), (gpg_proc, "gpg"), (ssh_proc, "ssh")],
+                                    tmp_paths=[extra_config])
 
-    xbk_proc.stdout.close()  # Allow xbk_proc to receive a SIGPIPE if gpg exits.
-    gpg_proc.stdout.close()  # Allow gpg_proc to receive a SIGPIPE if ssh exits.
+        xbk_proc.stdout.close()  # Allow xbk_proc to receive a SIGPIPE if gpg exits.
+        gpg_proc.stdout.close()  # Allow gpg_proc to receive a SIGPIPE if ssh exits.
 
-    xbk_proc.wait()
-    gpg_proc.wait()
-    ssh_proc.communicate()
+        # Stages run in a pipe, time of a stage is time until its process exits
+        account.wait(xbk_proc, "xtrabackup", started)
+        account.wait(gpg_proc, "gpg", started)
+        account.wait(ssh_proc, "ssh", started, network="sent")
+        ret_code_gpg = gpg_proc.returncode
+    ssh_proc.stdout.close()
 
     ret_code_ssh = ssh_proc.returncode
-    ret_code_gpg = gpg_proc.returncode
     ret_code_xbk = xbk_proc.returncode
 
     err_str = dict()
@@ -273,7 +367,13 @@ def take_backup_xtrabackup(job_order, logger_name):
         if not file_size:
             log.error("Backup copy size must not be zero", log_params)
             return -1
-        if not record_backup(backup_name, file_size, lsn):
+        manifest_name = None
+        if manifest:
+            manifest_name = "%s.manifest" % backup_name
+            if not upload_manifest(manifest_name, manifest):
+                log.error("Failed to save manifest of %s" % backup_name, log_params)
+                return -1
+        if not record_backup(backup_name, file_size, lsn, manifest_name):
             log.error("Failed to save backup copy details", log_params)
             return -1
     else:
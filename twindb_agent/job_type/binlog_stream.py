@@ -0,0 +1,348 @@
+import errno
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+import twindb_agent.accounting
+import twindb_agent.api
+import twindb_agent.config
+import twindb_agent.handlers
+import twindb_agent.journal
+import twindb_agent.twindb_mysql
+
+try:
+    import mysql.connector
+except ImportError:
+    # On CentOS 5 mysql.connector is in python 2.6 directory
+    import sys
+    sys.path.insert(0, '/usr/lib/python2.6/site-packages')
+    import mysql.connector
+
+# Size of blocks a chunk is read and encrypted in
+READ_BLOCK = 1024 * 1024
+# How often the stream checks for new events
+POLL_INTERVAL = 1
+# mysqlbinlog runs for days, its messages go to a file rather than a pipe nobody reads meanwhile
+MYSQLBINLOG_ERR = "/tmp/twindb.mysqlbinlog.err"
+# How much of the end of mysqlbinlog messages is logged when it exits
+ERR_TAIL = 4096
+
+
+def execute(job_order, logger_name="twindb_remote"):
+    """
+    Streams binary logs of the local server to TwinDB storage until the job is aborted
+    :param job_order: job order
+    :return: -1 if streaming has stopped because of an error
+    """
+    log = logging.getLogger(logger_name)
+    log_params = {"job_id": job_order["job_id"]}
+    log.info("Starting binlog stream job", log_params)
+    stream = BinlogStream(job_order, logger_name)
+    ret = stream.run()
+    log.info("Binlog stream job is complete", log_params)
+    return ret
+
+
+class BinlogStream(object):
+    """
+    Copies binary logs with mysqlbinlog --read-from-remote-server --raw --stop-never into binlog_dir.
+    New events are encrypted and uploaded in chunks. A chunk is a byte range of a binary log,
+    so the original binary log is the concatenation of its chunks.
+    Position of the last uploaded chunk is saved in binlog_dir/checkpoint.json, the next job continues from it.
+    """
+    def __init__(self, job_order, logger_name="twindb_remote"):
+        self.job_order = job_order
+        self.logger = logging.getLogger(logger_name)
+        self.log_params = {"job_id": job_order["job_id"]}
+        self.agent_config = twindb_agent.config.AgentConfig.get_config()
+        self.binlog_dir = self.agent_config.binlog_dir
+        self.checkpoint_file = os.path.join(self.binlog_dir, "checkpoint.json")
+        self.server_config = None
+        # Time when the last chunk was uploaded
+        self.last_upload = time.time()
+
+    def error(self, msg):
+        self.logger.error(msg, self.log_params)
+
+    def info(self, msg):
+        self.logger.info(msg, self.log_params)
+
+    def debug(self, msg):
+        self.logger.debug(msg, self.log_params)
+
+    def load_checkpoint(self):
+        """
+        :return: dictionary with "file" and "position" of the next byte to upload or None if there is no checkpoint
+        """
+        try:
+            with open(self.checkpoint_file) as f:
+                return json.load(f)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                self.error("Failed to read checkpoint %s: %s" % (self.checkpoint_file, err))
+        except ValueError as err:
+            self.error("Broken checkpoint %s: %s" % (self.checkpoint_file, err))
+        return None
+
+    def save_checkpoint(self, binlog_file, position):
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"file": binlog_file, "position": position}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_file, self.checkpoint_file)
+
+    def local_binlogs(self):
+        """
+        :return: sorted names of binary logs in binlog_dir
+        """
+        return sorted(name for name in os.listdir(self.binlog_dir)
+                      if not name.startswith("checkpoint.json") and os.path.isfile(os.path.join(self.binlog_dir, name)))
+
+    def next_chunk(self, checkpoint, now=None, flush=False):
+        """
+        Finds the next chunk to upload
+        :param checkpoint: dictionary with "file" and "position" of the next byte to upload
+        :param now: current time
+        :param flush: if True new events are uploaded even if the chunk isn't full and isn't due
+        :return: tuple (binlog file, start position, end position, True if the file is complete)
+            or None if there's nothing to upload yet
+        """
+        if now is None:
+            now = time.time()
+        binlog_file = checkpoint["file"]
+        path = os.path.join(self.binlog_dir, binlog_file)
+        if not os.path.exists(path):
+            return None
+        size = os.path.getsize(path)
+        # mysqlbinlog writes files one by one. If there is a newer file, this one is complete
+        complete = any(name > binlog_file for name in self.local_binlogs())
+        start = checkpoint["position"]
+        end = min(size, start + self.agent_config.binlog_chunk_size)
+        if end > start:
+            if end - start == self.agent_config.binlog_chunk_size or complete or flush \
+                    or now - self.last_upload >= self.agent_config.binlog_chunk_interval:
+                return binlog_file, start, end, complete and end == size
+            return None
+        if complete:
+            return binlog_file, start, start, True
+        return None
+
+    def ssh_cmd(self, command):
+        return ["ssh", "-oStrictHostKeyChecking=no",
+                "-i", self.agent_config.ssh_private_key_file,
+                "-p", str(self.agent_config.ssh_port),
+                "user_id_%s@%s" % (self.server_config["user_id"], self.job_order["params"]["ip"]),
+                command]
+
+    def upload_chunk(self, binlog_file, start, end):
+        """
+        Encrypts bytes start..end of a binary log and saves them in TwinDB storage
+        :return: name of the chunk in the storage or None if error happened
+        """
+        name = "server_id_%s_%s.%d.gpg" % (self.agent_config.server_id, binlog_file, start)
+        gpg_cmd = ["gpg", "--homedir", self.agent_config.gpg_homedir, "--encrypt", "--yes", "--batch",
+                   "--no-permission-warning", "--quiet", "--recipient", self.agent_config.server_id]
+        ssh_cmd = self.ssh_cmd("/bin/cat - > %s" % name)
+        started = time.time()
+        remaining = end - start
+        try:
+            gpg_proc = subprocess.Popen(gpg_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            ssh_proc = subprocess.Popen(ssh_cmd, stdin=gpg_proc.stdout)
+        except OSError as err:
+            self.error("Failed to start upload of %s: %s" % (name, err))
+            return None
+        gpg_proc.stdout.close()  # Allow gpg to receive a SIGPIPE if ssh exits.
+        try:
+            with open(os.path.join(self.binlog_dir, binlog_file), "rb") as f:
+                f.seek(start)
+                while remaining > 0:
+                    block = f.read(min(READ_BLOCK, remaining))
+                    if not block:
+                        break
+                    gpg_proc.stdin.write(block)
+                    remaining -= len(block)
+        except IOError as err:
+            self.error("Failed to upload %s: %s" % (name, err))
+        finally:
+            gpg_proc.stdin.close()
+        account = twindb_agent.accounting.get_account()
+        account.wait(gpg_proc, "gpg", started)
+        account.wait(ssh_proc, "ssh", started, network="sent")
+        if remaining or gpg_proc.returncode != 0 or ssh_proc.returncode != 0:
+            self.error("Failed to upload %s. GPG exited with code %d, SSH exited with code %d"
+                       % (name, gpg_proc.returncode, ssh_proc.returncode))
+            return None
+        return name
+
+    def record_chunk(self, name, binlog_file, start, end):
+        """
+        Saves details about an uploaded chunk in TwinDB dispatcher
+        :return: True if the dispatcher has the record or it's spooled
+        """
+        data = {
+            "type": "update_binlog_data",
+            "params": {
+                "job_id": self.job_order["job_id"],
+                "name": name,
+                "volume_id": self.job_order["params"]["volume_id"],
+                "binlog_file": binlog_file,
+                "start_position": start,
+                "end_position": end,
+                "size": end - start
+            }
+        }
+        api = twindb_agent.api.TwinDBAPI()
+        api.call(data, spool=True)
+        return api.success
+
+    def ship(self, checkpoint, flush=False):
+        """
+        Uploads chunks that are ready
+        :param flush: if True all new events are uploaded
+        :return: the updated checkpoint or None if error happened
+        """
+        while True:
+            chunk = self.next_chunk(checkpoint, flush=flush)
+            if not chunk:
+                return checkpoint
+            binlog_file, start, end, complete = chunk
+            if end > start:
+                name = self.upload_chunk(binlog_file, start, end)
+                if not name or not self.record_chunk(name, binlog_file, start, end):
+                    return None
+                self.debug("Uploaded %s bytes %d..%d" % (binlog_file, start, end))
+                self.last_upload = time.time()
+            if complete:
+                os.remove(os.path.join(self.binlog_dir, binlog_file))
+                later = [b for b in self.local_binlogs() if b > binlog_file]
+                checkpoint = {"file": later[0], "position": 0}
+            else:
+                checkpoint = {"file": binlog_file, "position": end}
+            self.save_checkpoint(checkpoint["file"], checkpoint["position"])
+
+    def first_binlog(self, server):
+        """
+        :return: name of the oldest binary log on the server or None if error happened
+        """
+        conn = server.get_mysql_connection()
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SHOW BINARY LOGS")
+            rows = cursor.fetchall()
+            cursor.close()
+            conn.close()
+        except mysql.connector.Error as err:
+            self.error("Failed to read binary logs list: %s" % err)
+            return None
+        if not rows:
+            self.error("Binary logging is disabled")
+            return None
+        return rows[0][0]
+
+    def write_defaults_file(self):
+        """
+        Saves MySQL credentials in an option file readable by the owner only,
+        so the password doesn't show up in the process list
+        :return: name of the file
+        """
+        fd, path = tempfile.mkstemp(prefix="twindb.mysqlbinlog.", suffix=".cnf")
+        with os.fdopen(fd, "w") as f:
+            f.write("[client]\n")
+            for option in ["user", "password"]:
+                value = self.server_config["mysql_%s" % option].replace("\\", "\\\\").replace('"', '\\"')
+                f.write('%s="%s"\n' % (option, value))
+        return path
+
+    def mysqlbinlog_cmd(self, checkpoint, defaults_file, unix_socket):
+        # --defaults-extra-file must be the first option
+        return ["mysqlbinlog", "--defaults-extra-file=%s" % defaults_file,
+                "--read-from-remote-server", "--raw", "--stop-never",
+                "--stop-never-slave-server-id=%d" % self.agent_config.binlog_stream_server_id,
+                "--socket=%s" % unix_socket,
+                "--result-file=%s/" % self.binlog_dir.rstrip("/"),
+                checkpoint["file"]]
+
+    def run(self):
+        if "params" not in self.job_order:
+            self.error("There are no params in the job order")
+            return -1
+        for param in ["ip", "volume_id"]:
+            if param not in self.job_order["params"]:
+                self.error("There is no %s in the job order" % param)
+                return -1
+        self.server_config = twindb_agent.handlers.get_config()
+        if not self.server_config:
+            self.error("Failed to get server config from dispatcher")
+            return -1
+        server = twindb_agent.twindb_mysql.MySQL(mysql_user=self.server_config["mysql_user"],
+                                                 mysql_password=self.server_config["mysql_password"])
+        if not os.path.exists(self.binlog_dir):
+            os.makedirs(self.binlog_dir, 0700)
+
+        # The dispatcher may tell where to start, otherwise continue from the checkpoint or the oldest binary log
+        params = self.job_order["params"]
+        checkpoint = self.load_checkpoint()
+        if params.get("start_file"):
+            checkpoint = {"file": params["start_file"], "position": int(params.get("start_position", 0))}
+        if not checkpoint:
+            first = self.first_binlog(server)
+            if not first:
+                return -1
+            checkpoint = {"file": first, "position": 0}
+        # mysqlbinlog copies the file from the start, bytes before the checkpoint aren't uploaded again
+        for name in self.local_binlogs():
+            os.remove(os.path.join(self.binlog_dir, name))
+        self.save_checkpoint(checkpoint["file"], checkpoint["position"])
+
+        try:
+            defaults_file = self.write_defaults_file()
+        except (IOError, OSError) as err:
+            self.error("Failed to save MySQL credentials for mysqlbinlog: %s" % err)
+            return -1
+        try:
+            return self.stream(checkpoint, defaults_file, server.get_unix_socket())
+        finally:
+            os.remove(defaults_file)
+
+    def stream(self, checkpoint, defaults_file, unix_socket):
+        """
+        Runs mysqlbinlog and uploads new events until it exits
+        :return: -1 as the stream ends only because of an error
+        """
+        mysqlbinlog_cmd = self.mysqlbinlog_cmd(checkpoint, defaults_file, unix_socket)
+        self.info("Streaming binary logs from %s:%d" % (checkpoint["file"], checkpoint["position"]))
+        started = time.time()
+        try:
+            err_file = open(MYSQLBINLOG_ERR, "w+")
+        except IOError as err:
+            self.error("Failed to open %s: %s" % (MYSQLBINLOG_ERR, err))
+            return -1
+        try:
+            mysqlbinlog = subprocess.Popen(mysqlbinlog_cmd, stderr=err_file)
+        except OSError as err:
+            self.error("Failed to run mysqlbinlog: %s" % err)
+            err_file.close()
+            return -1
+        twindb_agent.journal.record(self.job_order["job_id"], "streaming", processes=[(mysqlbinlog, "mysqlbinlog")],
+                                    tmp_paths=[defaults_file])
+
+        # The stream runs until the job is aborted or mysqlbinlog fails
+        while mysqlbinlog.poll() is None:
+            time.sleep(POLL_INTERVAL)
+            checkpoint = self.ship(checkpoint)
+            if checkpoint is None:
+                mysqlbinlog.terminate()
+                break
+        account = twindb_agent.accounting.get_account()
+        account.wait(mysqlbinlog, "mysqlbinlog", started)
+        err_file.seek(max(0, os.fstat(err_file.fileno()).st_size - ERR_TAIL))
+        self.error("mysqlbinlog exited with code %d: %s" % (mysqlbinlog.returncode, err_file.read()))
+        err_file.close()
+        if checkpoint:
+            self.ship(checkpoint, flush=True)
+        return -1
@@ -1,16 +1,33 @@
+import hashlib
 import json
 import logging
 import os
+import pwd
 import shutil
+import struct
 import subprocess
 import tempfile
+import threading
+import time
+import twindb_agent.accounting
 import twindb_agent.api
 import twindb_agent.config
 import twindb_agent.gpg
 import twindb_agent.handlers
 import twindb_agent.httpclient
+import twindb_agent.journal
+import twindb_agent.manifest
+import twindb_agent.xbstream
 import twindb_agent.utils
 
+# Account that replays binary logs on the temporary server. It's authenticated by the socket
+# and exists only while the server runs
+REPLAY_USER = "twindb_replay"
+# Common header of binary log events: timestamp, type, server id, event size, next position, flags
+EVENT_HEADER = struct.Struct("<IBIIIH")
+# Events of a binary log start after the magic number
+BINLOG_MAGIC_SIZE = 4
+
 
 def execute(job_order, logger_name="twindb_remote"):
     """
@@ -25,15 +42,128 @@ def execute(job_order, logger_name="twindb_remote"):
              log_params)
     restore = Restore(job_order)
     ret = restore.restore_xtrabackup()
+    if ret == 0 and restore.is_point_in_time():
+        ret = restore.restore_binlogs()
     log.info("Restore job is complete", log_params)
     return ret
 
 
+class ChunkPrefetcher(object):
+    """
+    Downloads chunks in parallel and yields them in order.
+    Up to window chunks are downloaded ahead of the one being consumed, so disk usage is bounded.
+    """
+    def __init__(self, chunks, fetch, tmp_dir, parallelism=4, window=None):
+        """
+        :param chunks: list of chunks
+        :param fetch: function (chunk, path) that saves the chunk in path. It returns True on success
+        :param tmp_dir: directory for downloaded chunks
+        :param parallelism: number of parallel downloads
+        :param window: how many chunks may wait to be consumed. 2 * parallelism by default
+        """
+        self.chunks = chunks
+        self.fetch = fetch
+        self.tmp_dir = tmp_dir
+        self.parallelism = parallelism
+        self.window = window or 2 * parallelism
+        self.results = [None] * len(chunks)
+        self.next_chunk = 0
+        self.consumed = 0
+        self.cancelled = False
+        self._cond = threading.Condition()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self.cancelled and self.next_chunk < len(self.chunks) \
+                        and self.next_chunk >= self.consumed + self.window:
+                    self._cond.wait()
+                if self.cancelled or self.next_chunk >= len(self.chunks):
+                    return
+                i = self.next_chunk
+                self.next_chunk += 1
+            path = os.path.join(self.tmp_dir, "chunk.%d" % i)
+            try:
+                ok = self.fetch(self.chunks[i], path)
+            except Exception:
+                ok = False
+            with self._cond:
+                self.results[i] = path if ok else False
+                self._cond.notify_all()
+
+    def __iter__(self):
+        """
+        :return: iterator of (chunk, path of the downloaded chunk). The path is None if the download failed
+        """
+        workers = [threading.Thread(target=self._worker) for _ in range(min(self.parallelism, len(self.chunks)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            for i, chunk in enumerate(self.chunks):
+                with self._cond:
+                    while self.results[i] is None:
+                        self._cond.wait()
+                    path = self.results[i] or None
+                yield chunk, path
+                if path and os.path.exists(path):
+                    os.remove(path)
+                with self._cond:
+                    self.consumed = i + 1
+                    self._cond.notify_all()
+        finally:
+            with self._cond:
+                self.cancelled = True
+                self._cond.notify_all()
+
+
+class BinlogEvents(object):
+    """
+    Follows event headers of a binary log that is read in pieces and keeps the latest event timestamp
+    """
+    def __init__(self, position):
+        """
+        :param position: offset of the first event to read
+        """
+        self.next_event = position
+        self.timestamp = None
+        self._header = ""
+
+    def scan(self, f, start, end):
+        """
+        Reads headers of events in a piece of the binary log. A header may continue in the next piece
+        :param f: file object with bytes from start to end of the binary log
+        :return: False if an event header is broken
+        """
+        while self.next_event < end:
+            if self.next_event >= start:
+                f.seek(self.next_event - start)
+                self._header = f.read(EVENT_HEADER.size)
+            else:
+                f.seek(0)
+                self._header += f.read(EVENT_HEADER.size - len(self._header))
+            if len(self._header) < EVENT_HEADER.size:
+                return True
+            timestamp, _, _, size, _, _ = EVENT_HEADER.unpack(self._header)
+            self._header = ""
+            if size < EVENT_HEADER.size:
+                return False
+            self.timestamp = max(self.timestamp, timestamp)
+            self.next_event += size
+        return True
+
+
 class Restore(object):
     def __init__(self, job_order):
         self.job_order = job_order
         self.logger = logging.getLogger("twindb_remote")
         self.log_params = {"job_id": job_order["job_id"]}
+        # For a partial restore, function that takes a path in xbstream and returns True if the file is needed
+        self.keep = None
+        # Timestamp of the latest binary log event fed to mysqlbinlog
+        self.last_timestamp = None
+        # Chunks are downloaded in several threads, journal updates must not interleave
+        self._journal_lock = threading.Lock()
 
     def error(self, msg):
         self.logger.error(msg, self.log_params)
@@ -41,6 +171,10 @@ class Restore(object):
     def info(self, msg):
         self.logger.info(msg, self.log_params)
 
+    def record(self, **kwargs):
+        with self._journal_lock:
+            twindb_agent.journal.record(self.job_order["job_id"], **kwargs)
+
     def warning(self, msg):
         self.logger.warning(msg, self.log_params)
 
@@ -56,11 +190,25 @@ class Restore(object):
             self.error("There are no params in the job order")
             return -1
         # Check that job order has all required parameters
-        mandatory_params = ["backup_copy_id", "restore_dir", "server_id"]
+        # A point-in-time restore may leave the choice of the backup copy to the dispatcher
+        mandatory_params = ["restore_dir", "server_id"]
+        if not self.is_point_in_time():
+            mandatory_params.append("backup_copy_id")
         for param in mandatory_params:
             if param not in self.job_order["params"]:
                 self.error("There is no %s in the job order" % param)
                 return -1
+        tables = self.job_order["params"].get("tables")
+        if tables:
+            if self.is_point_in_time():
+                self.error("Binary logs can't be replayed on a partial restore")
+                return -1
+            try:
+                self.keep = twindb_agent.xbstream.table_filter(tables)
+            except twindb_agent.xbstream.XBStreamException as err:
+                self.error(err)
+                return -1
+            self.info("Restoring tables %s" % ", ".join(tables))
         dst_dir = self.job_order["params"]["restore_dir"]
         try:
             if os.path.isdir(dst_dir):
@@ -76,11 +224,16 @@ class Restore(object):
             self.error("Can't use directory %s as destination for backup" % dst_dir)
             return -1
 
+        job_id = self.job_order["job_id"]
+        twindb_agent.journal.record(job_id, "streaming")
         full_copy = True
         backups_chain = self.get_backups_chain()
         if not backups_chain:
             self.error("Failed to get backups chain from dispatcher")
             return -1
+        if "backup_copy_id" not in self.job_order["params"]:
+            self.job_order["params"]["backup_copy_id"] = backups_chain[-1]["backup_copy_id"]
+            self.info("Restoring the nearest backup copy %d" % backups_chain[-1]["backup_copy_id"])
         for backup_copy in backups_chain:
             self.debug("Processing backup copy %r" % backup_copy)
 
@@ -100,12 +253,14 @@ class Restore(object):
                 # if this is the last copy in the chain then --apply-log
                 # otherwise just apply the redo log
                 if backup_copy["backup_copy_id"] == self.job_order["params"]["backup_copy_id"]:
-                    xb_cmd = ["innobackupex", "--apply-log", dst_dir]
+                    xb_cmd = ["innobackupex", "--apply-log"] + self.export_options() + [dst_dir]
                 else:
                     xb_cmd = ["innobackupex", "--apply-log", "--redo-only", dst_dir]
                 try:
+                    started = time.time()
                     p_xb = subprocess.Popen(xb_cmd, stdout=xb_err, stderr=xb_err)
-                    p_xb.communicate()
+                    twindb_agent.journal.record(job_id, processes=[(p_xb, "innobackupex")])
+                    twindb_agent.accounting.get_account().wait(p_xb, "apply_log", started)
                 except OSError as err:
                     self.error("Failed to run %r: %s" % (xb_cmd, err))
                     return -1
@@ -119,6 +274,7 @@ class Restore(object):
                 full_copy = False
             else:
                 inc_dir = tempfile.mkdtemp()
+                twindb_agent.journal.record(job_id, tmp_paths=[inc_dir])
                 if not self.extract_archive(backup_copy, inc_dir):
                     self.error("Failed to extract %s in %s" % (backup_copy["name"], inc_dir))
                 try:
@@ -129,11 +285,15 @@ class Restore(object):
                 xb_cmd = ["innobackupex", "--apply-log"]
                 if backup_copy["backup_copy_id"] != self.job_order["params"]["backup_copy_id"]:
                     xb_cmd.append("--redo-only")
+                else:
+                    xb_cmd += self.export_options()
                 xb_cmd.append('--incremental-dir=%s' % inc_dir)
                 xb_cmd.append(dst_dir)
                 try:
+                    started = time.time()
                     p_xb = subprocess.Popen(xb_cmd, stdout=xb_err, stderr=xb_err)
-                    p_xb.wait()
+                    twindb_agent.journal.record(job_id, processes=[(p_xb, "innobackupex")])
+                    twindb_agent.accounting.get_account().wait(p_xb, "apply_log", started)
                 except OSError as err:
                     self.error("Failed to run %r: %s" % (xb_cmd, err))
                     return -1
@@ -149,8 +309,37 @@ class Restore(object):
         for f in ["/tmp/twindb.xb.err", "/tmp/twindb.gpg.err", "/tmp/twindb.ssh.err"]:
             if os.path.isfile(f):
                 os.remove(f)
+        if tables:
+            return self.check_exported_tables(dst_dir, tables)
         return 0
 
+    def export_options(self):
+        """
+        :return: options of the final prepare. A partial restore exports tablespaces of the tables
+        """
+        if self.keep:
+            return ["--export"]
+        return []
+
+    def check_exported_tables(self, dst_dir, tables):
+        """
+        Checks that every requested table is exported after the prepare
+        :return: 0 if all tables are ready to import or non-zero otherwise
+        """
+        ret = 0
+        for table in tables:
+            database, _, name = table.partition(".")
+            path = os.path.join(dst_dir, database, name)
+            if os.path.exists(path + ".ibd") and os.path.exists(path + ".cfg"):
+                self.info("Table %s is exported. Import %s.ibd and %s.cfg with ALTER TABLE ... IMPORT TABLESPACE"
+                          % (table, path, path))
+            elif os.path.exists(path + ".frm") and not os.path.exists(path + ".ibd"):
+                self.info("Table %s isn't an InnoDB table, copy %s.* to the datadir" % (table, path))
+            else:
+                self.error("Table %s isn't in the backup copy or it isn't exported" % table)
+                ret = -1
+        return ret
+
     def extract_archive(self, arc, dst_dir):
         """
         Extracts an Xtrabackup archive arc in  dst_dir
@@ -168,6 +357,8 @@ class Restore(object):
             if param not in arc:
                 log.error("There is no %s in the archive parameters" % param, log_params)
                 return False
+        if arc.get("manifest"):
+            return self.extract_segments(arc, dst_dir)
         log.info("Extracting %s in %s" % (arc["name"], dst_dir), log_params)
         ssh_cmd = [
             "ssh",
@@ -190,27 +381,43 @@ class Restore(object):
             log.error("Failed to open %s: %s" % (desc_file, err), log_params)
             return False
 
+        started = time.time()
         log.info("Starting: %r" % ssh_cmd, log_params)
         p1 = subprocess.Popen(ssh_cmd, stdout=subprocess.PIPE, stderr=err_desc["ssh"])
         log.info("Starting: %r" % gpg_cmd, log_params)
         p2 = subprocess.Popen(gpg_cmd, stdin=p1.stdout, stdout=subprocess.PIPE,
                               stderr=err_desc["gpg"])
         log.info("Starting: %r" % xb_cmd, log_params)
-        p3 = subprocess.Popen(xb_cmd, stdin=p2.stdout, stdout=subprocess.PIPE,
+        # A partial restore filters the stream, so files of other tables are never written to disk
+        p3 = subprocess.Popen(xb_cmd, stdin=subprocess.PIPE if self.keep else p2.stdout, stdout=subprocess.PIPE,
                               stderr=err_desc["xb"], cwd=dst_dir)
+        twindb_agent.journal.record(self.job_order["job_id"], processes=[(p1, "ssh"), (p2, "gpg"), (p3, "xbstream")])
         p1.stdout.close()  # Allow ssh to receive a SIGPIPE if gpg exits.
+        filter_ok = True
+        if self.keep:
+            try:
+                stats = twindb_agent.xbstream.filter_stream(p2.stdout, p3.stdin, self.keep)
+                log.info("Extracted %d files (%d bytes) from %s, skipped %d bytes"
+                         % (len(stats["paths"]), stats["copied"], arc["name"], stats["skipped"]), log_params)
+            except (IOError, twindb_agent.xbstream.XBStreamException) as err:
+                log.error("Failed to filter %s: %s" % (arc["name"], err), log_params)
+                filter_ok = False
+            finally:
+                p3.stdin.close()
         p2.stdout.close()  # Allow gpg to receive a SIGPIPE if xtrabackup exits.
 
-        p1.wait()
-        p2.wait()
-        p3.wait()
+        account = twindb_agent.accounting.get_account()
+        account.wait(p1, "ssh", started, network="received")
+        account.wait(p2, "gpg", started)
+        account.wait(p3, "xbstream", started)
+        p3.stdout.close()
         for desc in ["xb", "gpg", "ssh"]:
             err_desc[desc].seek(0)
 
         log.info("SSH stderr: " + err_desc["ssh"].read(), log_params)
         log.info("GPG stderr: " + err_desc["gpg"].read(), log_params)
         log.info("xbstream stderr: " + err_desc["xb"].read())
-        if p1.returncode != 0 or p2.returncode != 0 or p3.returncode != 0:
+        if not filter_ok or p1.returncode != 0 or p2.returncode != 0 or p3.returncode != 0:
             log.info("Failed to extract backup %s in %s" % (arc["name"], dst_dir), log_params)
             return False
         desc_file = None
@@ -224,6 +431,126 @@ class Restore(object):
         log.info("Extracted successfully %s in %s" % (arc["name"], dst_dir), log_params)
         return True
 
+    def ssh_cmd(self, ip, command):
+        server_config = twindb_agent.handlers.get_config()
+        agent_config = twindb_agent.config.AgentConfig.get_config()
+        return ["ssh", "-oStrictHostKeyChecking=no",
+                "-i", agent_config.ssh_private_key_file,
+                "-p", str(agent_config.ssh_port),
+                "user_id_%s@%s" % (server_config["user_id"], ip),
+                command]
+
+    def get_manifest(self, arc):
+        """
+        Downloads and decrypts the manifest of a segmented backup copy
+        :return: the manifest dictionary or None if error happened
+        """
+        ssh_cmd = self.ssh_cmd(arc["ip"], "/bin/cat %s" % arc["manifest"])
+        try:
+            p1 = subprocess.Popen(ssh_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            p2 = subprocess.Popen(["gpg", "--decrypt", "--batch", "--quiet"], stdin=p1.stdout,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            p1.stdout.close()  # Allow ssh to receive a SIGPIPE if gpg exits.
+            data, gpg_err = p2.communicate()
+            p1.wait()
+        except OSError as err:
+            self.error("Failed to download manifest %s: %s" % (arc["manifest"], err))
+            return None
+        if p1.returncode != 0 or p2.returncode != 0:
+            self.error("Failed to download manifest %s. SSH: %s GPG: %s"
+                       % (arc["manifest"], p1.stderr.read(), gpg_err))
+            return None
+        try:
+            return twindb_agent.manifest.load(data)
+        except twindb_agent.manifest.ManifestException as err:
+            self.error(err)
+            return None
+
+    def fetch_segment(self, arc, segment, path):
+        """
+        Downloads a byte range of a segmented backup copy and decrypts it
+        :param path: local file to save the decrypted segment in
+        :return: True if the segment is saved and its checksum matches
+        """
+        # tail counts bytes from 1
+        ssh_cmd = self.ssh_cmd(arc["ip"], "/usr/bin/tail -c +%d %s | /usr/bin/head -c %d"
+                               % (segment["offset"] + 1, arc["name"], segment["size"]))
+        started = time.time()
+        try:
+            with open(path, "wb") as f:
+                p1 = subprocess.Popen(ssh_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                p2 = subprocess.Popen(["gpg", "--decrypt", "--batch", "--quiet"], stdin=p1.stdout, stdout=f,
+                                      stderr=subprocess.PIPE)
+                p1.stdout.close()  # Allow ssh to receive a SIGPIPE if gpg exits.
+                self.record(processes=[(p1, "ssh"), (p2, "gpg")])
+                account = twindb_agent.accounting.get_account()
+                account.wait(p1, "ssh", started, network="received")
+                account.wait(p2, "gpg", started)
+        except (IOError, OSError) as err:
+            self.error("Failed to download segment at %d of %s: %s" % (segment["offset"], arc["name"], err))
+            return False
+        if p1.returncode != 0 or p2.returncode != 0:
+            self.error("Failed to download segment at %d of %s. SSH: %s GPG: %s"
+                       % (segment["offset"], arc["name"], p1.stderr.read(), p2.stderr.read()))
+            return False
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), ""):
+                digest.update(block)
+        if digest.hexdigest() != segment["sha256"]:
+            self.error("Checksum of segment at %d of %s doesn't match" % (segment["offset"], arc["name"]))
+            return False
+        return True
+
+    def extract_segments(self, arc, dst_dir):
+        """
+        Extracts a segmented backup copy in dst_dir.
+        Only segments with needed files are downloaded, restore_parallelism segments at once.
+        :return: True if the copy is successfully extracted
+        """
+        agent_config = twindb_agent.config.AgentConfig.get_config()
+        manifest = self.get_manifest(arc)
+        if not manifest:
+            return False
+        segments = twindb_agent.manifest.segments_for(manifest, self.keep)
+        self.info("Extracting %s in %s: %d of %d segments"
+                  % (arc["name"], dst_dir, len(segments), len(manifest["segments"])))
+        tmp_dir = tempfile.mkdtemp()
+        self.record(tmp_paths=[tmp_dir])
+        started = time.time()
+        try:
+            xb_proc = subprocess.Popen(["xbstream", "-x"], stdin=subprocess.PIPE, cwd=dst_dir)
+        except OSError as err:
+            self.error("Failed to run xbstream: %s" % err)
+            return False
+        self.record(processes=[(xb_proc, "xbstream")])
+        ok = True
+        prefetcher = ChunkPrefetcher(segments, lambda segment, path: self.fetch_segment(arc, segment, path),
+                                     tmp_dir, agent_config.restore_parallelism)
+        try:
+            for segment, path in prefetcher:
+                if not path:
+                    ok = False
+                    break
+                with open(path, "rb") as f:
+                    # Segments of a partial restore also have chunks of other files
+                    if self.keep:
+                        twindb_agent.xbstream.filter_stream(f, xb_proc.stdin, self.keep)
+                    else:
+                        shutil.copyfileobj(f, xb_proc.stdin)
+        except (IOError, twindb_agent.xbstream.XBStreamException) as err:
+            self.error("Failed to extract %s: %s" % (arc["name"], err))
+            ok = False
+        finally:
+            xb_proc.stdin.close()
+            twindb_agent.accounting.get_account().wait(xb_proc, "xbstream", started)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not ok or xb_proc.returncode != 0:
+            self.error("Failed to extract backup %s in %s" % (arc["name"], dst_dir))
+            return False
+        self.info("Extracted successfully %s in %s" % (arc["name"], dst_dir))
+        return True
+
     def get_backups_chain(self):
         """
         Gets a chain of parents of the given backup_copy_id
@@ -238,15 +565,391 @@ class Restore(object):
         """
         log = self.logger
         log_params = self.log_params
-        backup_copy_id = self.job_order["params"]["backup_copy_id"]
-        log.debug("Getting backups chain for backup_copy_id %d" % backup_copy_id, log_params)
+        params = self.job_order["params"]
+        if "backup_copy_id" in params:
+            backup_copy_id = params["backup_copy_id"]
+            log.debug("Getting backups chain for backup_copy_id %d" % backup_copy_id, log_params)
+            data = {
+                "type": "get_backups_chain",
+                "params": {
+                    "backup_copy_id": backup_copy_id
+                }
+            }
+        else:
+            # The chain of the latest backup copy taken before the target
+            log.debug("Getting the nearest backups chain of server %s" % params["server_id"], log_params)
+            data = {
+                "type": "get_backups_chain",
+                "params": {
+                    "server_id": params["server_id"],
+                    "stop_datetime": params.get("stop_datetime"),
+                    "stop_gtid": params.get("stop_gtid")
+                }
+            }
+        api = twindb_agent.api.TwinDBAPI()
+        backups_chain = api.call(data)
+        return backups_chain
 
+    def is_point_in_time(self):
+        """
+        :return: True if the job order asks to restore to a timestamp or a GTID after the backup copy
+        """
+        params = self.job_order.get("params", {})
+        return bool(params.get("stop_datetime") or params.get("stop_gtid"))
+
+    def read_binlog_info(self, dst_dir):
+        """
+        Reads coordinates of the restored copy in the master's binary log
+        :return: dictionary with "file", "position" and "gtid" (None if GTIDs are disabled) or None if error happened
+        """
+        path = os.path.join(dst_dir, "xtrabackup_binlog_info")
+        try:
+            with open(path) as f:
+                fields = f.read().split()
+        except IOError as err:
+            self.error("Failed to read %s: %s" % (path, err))
+            return None
+        if len(fields) < 2 or not fields[1].isdigit():
+            self.error("Unexpected content of %s: %r" % (path, fields))
+            return None
+        # A GTID set may be split over several lines
+        return {"file": fields[0], "position": int(fields[1]), "gtid": "".join(fields[2:]) or None}
+
+    def get_binlog_chunks(self, start_file):
+        """
+        Gets archived binary log chunks of the server starting from start_file
+        :return: list of chunks ordered by binary log and position or None if error happened:
+            {
+            "name": "server_id_479a41b3-d22d-41a8-b7d3-4e40302622f6_mysql-bin.000012.0.gpg",
+            "ip": "127.0.0.1",
+            "binlog_file": "mysql-bin.000012",
+            "start_position": 0,
+            "end_position": 16777216
+            },
+            {...}
+        """
         data = {
-            "type": "get_backups_chain",
+            "type": "get_binlog_chunks",
             "params": {
-                "backup_copy_id": backup_copy_id
+                "server_id": self.job_order["params"]["server_id"],
+                "start_file": start_file
             }
         }
         api = twindb_agent.api.TwinDBAPI()
-        backups_chain = api.call(data)
-        return backups_chain
+        chunks = api.call(data)
+        if not api.success or chunks is None:
+            return None
+        chunks = sorted((c for c in chunks if c["binlog_file"] >= start_file),
+                        key=lambda c: (c["binlog_file"], c["start_position"]))
+        return chunks
+
+    def check_chunks(self, chunks, start_file):
+        """
+        Checks that chunks make up complete binary logs from start_file on
+        :return: True if there are no gaps
+        """
+        if not chunks or chunks[0]["binlog_file"] != start_file:
+            self.error("There are no archived chunks of %s" % start_file)
+            return False
+        previous = None
+        for chunk in chunks:
+            if previous and previous["binlog_file"] == chunk["binlog_file"]:
+                expected = previous["end_position"]
+            else:
+                expected = 0
+            if chunk["start_position"] != expected:
+                self.error("Archived %s has a gap at %d" % (chunk["binlog_file"], expected))
+                return False
+            previous = chunk
+        return True
+
+    def fetch_chunk(self, chunk, path):
+        """
+        Downloads and decrypts a chunk
+        :param path: local file to save the decrypted chunk in
+        :return: True if the chunk is saved
+        """
+        ssh_cmd = self.ssh_cmd(chunk["ip"], "/bin/cat %s" % chunk["name"])
+        gpg_cmd = ["gpg", "--decrypt", "--batch", "--quiet"]
+        started = time.time()
+        try:
+            with open(path, "wb") as f:
+                p1 = subprocess.Popen(ssh_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                p2 = subprocess.Popen(gpg_cmd, stdin=p1.stdout, stdout=f, stderr=subprocess.PIPE)
+                p1.stdout.close()  # Allow ssh to receive a SIGPIPE if gpg exits.
+                self.record(processes=[(p1, "ssh"), (p2, "gpg")])
+                account = twindb_agent.accounting.get_account()
+                account.wait(p1, "ssh", started, network="received")
+                account.wait(p2, "gpg", started)
+        except (IOError, OSError) as err:
+            self.error("Failed to download %s: %s" % (chunk["name"], err))
+            return False
+        if p1.returncode != 0 or p2.returncode != 0:
+            self.error("Failed to download %s. SSH: %s GPG: %s"
+                       % (chunk["name"], p1.stderr.read(), p2.stderr.read()))
+            return False
+        expected = chunk["end_position"] - chunk["start_position"]
+        if os.path.getsize(path) != expected:
+            self.error("Downloaded %s has %d bytes, expected %d" % (chunk["name"], os.path.getsize(path), expected))
+            return False
+        return True
+
+    def mysqlbinlog_cmd(self, binlog_file, binlog_info):
+        """
+        :return: mysqlbinlog command that reads binlog_file from stdin and prints events up to the target
+        """
+        params = self.job_order["params"]
+        cmd = ["mysqlbinlog"]
+        if binlog_file == binlog_info["file"]:
+            cmd.append("--start-position=%d" % binlog_info["position"])
+        if params.get("stop_datetime"):
+            cmd.append("--stop-datetime=%s" % params["stop_datetime"])
+        if params.get("stop_gtid"):
+            cmd.append("--include-gtids=%s" % params["stop_gtid"])
+            if binlog_info["gtid"]:
+                cmd.append("--exclude-gtids=%s" % binlog_info["gtid"])
+        else:
+            # The temporary server runs without GTIDs unless the target is a GTID set
+            cmd.append("--skip-gtids")
+        cmd.append("-")
+        return cmd
+
+    @staticmethod
+    def replay_init_sql():
+        """
+        :return: statements the temporary server runs at start. They create the replay account
+            for the OS user of the agent. Nothing of it goes to the binary log.
+            CREATE USER can't be used, it fails if the account was left by an interrupted restore
+            and MySQL 5.5 and 5.6 have no IF NOT EXISTS
+        """
+        os_user = pwd.getpwuid(os.getuid()).pw_name
+        return ("SET SESSION sql_log_bin = 0;\n"
+                "INSERT INTO mysql.user (Host, User, plugin, authentication_string, ssl_cipher, x509_issuer, "
+                "x509_subject) VALUES ('localhost', '%s', 'auth_socket', '%s', '', '', '') "
+                "ON DUPLICATE KEY UPDATE plugin = VALUES(plugin), "
+                "authentication_string = VALUES(authentication_string);\n"
+                "FLUSH PRIVILEGES;\n"
+                "GRANT ALL PRIVILEGES ON *.* TO '%s'@'localhost' WITH GRANT OPTION;\n"
+                % (REPLAY_USER, os_user, REPLAY_USER))
+
+    def mysqld_cmd(self, dst_dir, tmp_dir):
+        """
+        Command of the temporary server. Grant tables are loaded, so GRANT and CREATE USER in binary logs
+        are replayed. If the target is a GTID set, the server runs with GTIDs like the source
+        :return: tuple (command, socket)
+        """
+        agent_config = twindb_agent.config.AgentConfig.get_config()
+        socket = os.path.join(tmp_dir, "mysql.sock")
+        cmd = ["mysqld", "--defaults-file=%s" % os.path.join(dst_dir, "backup-my.cnf"),
+               "--datadir=%s" % dst_dir, "--socket=%s" % socket,
+               "--pid-file=%s" % os.path.join(tmp_dir, "mysqld.pid"),
+               "--log-error=%s" % os.path.join(tmp_dir, "mysqld.err"),
+               "--user=%s" % agent_config.restore_mysqld_user,
+               "--init-file=%s" % os.path.join(tmp_dir, "init.sql"),
+               "--plugin-load=auth_socket=auth_socket.so",
+               "--skip-networking", "--skip-slave-start"]
+        if self.job_order["params"].get("stop_gtid"):
+            cmd += ["--gtid-mode=ON", "--enforce-gtid-consistency=ON",
+                    "--log-bin=%s" % os.path.join(tmp_dir, "replay-bin"), "--log-slave-updates",
+                    "--server-id=%d" % agent_config.binlog_stream_server_id]
+        return cmd, socket
+
+    @staticmethod
+    def mysql_cmd(socket, *args):
+        return ["mysql", "--socket=%s" % socket, "--user=%s" % REPLAY_USER] + list(args)
+
+    def start_mysqld(self, dst_dir, tmp_dir):
+        """
+        Starts a temporary MySQL server on the restored copy. It isn't reachable over network
+        :return: tuple (process, socket) or None if error happened
+        """
+        agent_config = twindb_agent.config.AgentConfig.get_config()
+        cmd, socket = self.mysqld_cmd(dst_dir, tmp_dir)
+        try:
+            with open(os.path.join(tmp_dir, "init.sql"), "w") as f:
+                f.write(self.replay_init_sql())
+            subprocess.call(["chown", "-R", agent_config.restore_mysqld_user, dst_dir, tmp_dir])
+            proc = subprocess.Popen(cmd)
+        except (IOError, OSError) as err:
+            self.error("Failed to start mysqld: %s" % err)
+            return None
+        self.record(processes=[(proc, "mysqld")])
+        deadline = time.time() + agent_config.restore_mysqld_timeout
+        while time.time() < deadline and proc.poll() is None:
+            if subprocess.call(self.mysql_cmd(socket, "-e", "SELECT 1"),
+                               stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT) == 0:
+                return proc, socket
+            time.sleep(1)
+        self.error("Temporary mysqld didn't start, see %s" % os.path.join(tmp_dir, "mysqld.err"))
+        if proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+        return None
+
+    def replay(self, chunks, binlog_info, socket):
+        """
+        Replays chunks on the server listening on socket.
+        Chunks are downloaded in parallel ahead of the replay. Every binary log is fed to its own mysqlbinlog
+        as its chunks arrive, all mysqlbinlog output goes to one mysql client.
+        :return: True if all events up to the target are applied
+        """
+        agent_config = twindb_agent.config.AgentConfig.get_config()
+        tmp_dir = tempfile.mkdtemp()
+        self.record(tmp_paths=[tmp_dir])
+        started = time.time()
+        try:
+            mysql_proc = subprocess.Popen(self.mysql_cmd(socket, "--binary-mode"), stdin=subprocess.PIPE)
+        except OSError as err:
+            self.error("Failed to run mysql: %s" % err)
+            return False
+        self.record(processes=[(mysql_proc, "mysql")])
+        ok = True
+        mysqlbinlog = None
+        binlog_file = None
+        events = None
+        stop_time = self.stop_timestamp() if self.job_order["params"].get("stop_datetime") else None
+        prefetcher = ChunkPrefetcher(chunks, self.fetch_chunk, tmp_dir, agent_config.restore_parallelism)
+        try:
+            for chunk, path in prefetcher:
+                if not path:
+                    ok = False
+                    break
+                if chunk["binlog_file"] != binlog_file:
+                    if mysqlbinlog:
+                        finished = self.finish_mysqlbinlog(mysqlbinlog, binlog_file, started)
+                        mysqlbinlog = None
+                        if not finished:
+                            ok = False
+                            break
+                        if self.gtid_executed(socket):
+                            self.info("All of %s is replayed with %s" % (self.job_order["params"]["stop_gtid"],
+                                                                         binlog_file))
+                            break
+                    binlog_file = chunk["binlog_file"]
+                    self.info("Replaying %s" % binlog_file)
+                    if binlog_file == binlog_info["file"]:
+                        events = BinlogEvents(binlog_info["position"])
+                    else:
+                        events = BinlogEvents(BINLOG_MAGIC_SIZE)
+                    mysqlbinlog = subprocess.Popen(self.mysqlbinlog_cmd(binlog_file, binlog_info),
+                                                   stdin=subprocess.PIPE, stdout=mysql_proc.stdin)
+                    self.record(processes=[(mysqlbinlog, "mysqlbinlog")])
+                with open(path, "rb") as f:
+                    if stop_time is not None and not events.scan(f, chunk["start_position"], chunk["end_position"]):
+                        self.error("Broken event header in %s at %d" % (binlog_file, events.next_event))
+                        ok = False
+                        break
+                    f.seek(0)
+                    shutil.copyfileobj(f, mysqlbinlog.stdin)
+                self.last_timestamp = max(self.last_timestamp, events.timestamp)
+                if stop_time is not None and self.last_timestamp >= stop_time:
+                    # mysqlbinlog stops at this event, later chunks aren't needed
+                    self.info("%s has events at %s" % (binlog_file, self.job_order["params"]["stop_datetime"]))
+                    break
+            if mysqlbinlog and not self.finish_mysqlbinlog(mysqlbinlog, binlog_file, started):
+                ok = False
+        except (IOError, OSError) as err:
+            self.error("Failed to replay %s: %s" % (binlog_file, err))
+            ok = False
+        finally:
+            mysql_proc.stdin.close()
+            twindb_agent.accounting.get_account().wait(mysql_proc, "replay", started)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if mysql_proc.returncode != 0:
+            self.error("mysql exited with code %d" % mysql_proc.returncode)
+            return False
+        return ok
+
+    def stop_timestamp(self):
+        """
+        :return: stop_datetime as Unix time. Like mysqlbinlog, it's read in the local time zone
+        """
+        return time.mktime(time.strptime(self.job_order["params"]["stop_datetime"], "%Y-%m-%d %H:%M:%S"))
+
+    def gtid_executed(self, socket):
+        """
+        :return: True if the server listening on socket has executed all transactions of stop_gtid
+        """
+        stop_gtid = self.job_order["params"].get("stop_gtid")
+        if not stop_gtid:
+            return False
+        stop_gtid = stop_gtid.replace("\\", "\\\\").replace("'", "\\'")
+        sql = "SELECT GTID_SUBSET('%s', @@GLOBAL.gtid_executed)" % stop_gtid
+        try:
+            out = subprocess.check_output(self.mysql_cmd(socket, "--skip-column-names", "-e", sql))
+        except (OSError, subprocess.CalledProcessError) as err:
+            self.warning("Failed to read executed GTIDs: %s" % err)
+            return False
+        return out.strip() == "1"
+
+    def target_reached(self, socket):
+        """
+        Checks that the replay got to the target. Archived binary logs may end before it
+        :return: True if all of stop_gtid is executed or an event at or after stop_datetime is found
+        """
+        params = self.job_order["params"]
+        if params.get("stop_gtid") and self.gtid_executed(socket):
+            return True
+        if params.get("stop_datetime") and self.last_timestamp >= self.stop_timestamp():
+            return True
+        self.error("Archived binary logs end before %s" % (params.get("stop_gtid") or params["stop_datetime"]))
+        return False
+
+    def finish_mysqlbinlog(self, proc, binlog_file, started):
+        proc.stdin.close()
+        twindb_agent.accounting.get_account().wait(proc, "mysqlbinlog", started)
+        if proc.returncode != 0:
+            self.error("mysqlbinlog failed to decode %s with code %d" % (binlog_file, proc.returncode))
+            return False
+        return True
+
+    def stop_mysqld(self, proc, socket):
+        """
+        Removes the replay account and shuts the temporary server down with SIGTERM
+        """
+        sql = "SET SESSION sql_log_bin = 0; DROP USER '%s'@'localhost'" % REPLAY_USER
+        if subprocess.call(self.mysql_cmd(socket, "-e", sql)) != 0:
+            self.warning("Failed to drop account %s, it may be left in the restored copy" % REPLAY_USER)
+        proc.terminate()
+        proc.wait()
+
+    def restore_binlogs(self):
+        """
+        Rolls the restored copy forward to stop_datetime or stop_gtid by replaying archived binary logs
+        :return: 0 if the target is reached or non-zero if failed
+        """
+        params = self.job_order["params"]
+        dst_dir = params["restore_dir"]
+        if params.get("stop_datetime"):
+            try:
+                self.stop_timestamp()
+            except ValueError as err:
+                self.error("Wrong stop_datetime %r: %s" % (params["stop_datetime"], err))
+                return -1
+        binlog_info = self.read_binlog_info(dst_dir)
+        if not binlog_info:
+            return -1
+        self.info("Backup copy ends at %s:%d" % (binlog_info["file"], binlog_info["position"]))
+        chunks = self.get_binlog_chunks(binlog_info["file"])
+        if chunks is None:
+            self.error("Failed to get binary log chunks from dispatcher")
+            return -1
+        if not self.check_chunks(chunks, binlog_info["file"]):
+            return -1
+        tmp_dir = tempfile.mkdtemp()
+        self.record(tmp_paths=[tmp_dir])
+        try:
+            server = self.start_mysqld(dst_dir, tmp_dir)
+            if not server:
+                return -1
+            mysqld, socket = server
+            try:
+                ok = self.replay(chunks, binlog_info, socket) and self.target_reached(socket)
+            finally:
+                self.stop_mysqld(mysqld, socket)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not ok:
+            return -1
+        self.info("Rolled %s forward to %s" % (dst_dir, params.get("stop_gtid") or params["stop_datetime"]))
+        return 0
@@ -0,0 +1,203 @@
+"""
+Crash-safe journal of jobs
+"""
+import errno
+import json
+import logging
+import os
+import shutil
+import signal
+import twindb_agent.config
+
+# States of a job in the order it goes through them
+STATES = ["received", "started", "streaming", "uploaded", "recorded"]
+
+
+class JobJournal(object):
+    """
+    Keeps state of every unfinished job in journal_dir/<job_id>.json.
+
+    A state file is atomically replaced and fsync-ed on every transition, so after a crash or
+    a restart the agent knows how far each job got. The entry is removed when the dispatcher
+    is notified that the job has stopped.
+    """
+    def __init__(self, journal_dir=None, logger_name="twindb_local"):
+        self.journal_dir = journal_dir or twindb_agent.config.AgentConfig.get_config().job_journal_dir
+        self.logger = logging.getLogger(logger_name)
+
+    def _path(self, job_id):
+        return os.path.join(self.journal_dir, "%s.json" % job_id)
+
+    def get(self, job_id):
+        """
+        :return: journal entry of the job or None if the job isn't in the journal
+        """
+        try:
+            with open(self._path(job_id)) as f:
+                return json.load(f)
+        except IOError as err:
+            if err.errno == errno.ENOENT:
+                return None
+            raise JobJournalException("Failed to read journal entry of job %s: %s" % (job_id, err))
+        except ValueError as err:
+            self.logger.error("Broken journal entry of job %s: %s" % (job_id, err))
+            return None
+
+    def update(self, job_id, state=None, processes=(), tmp_paths=(), **details):
+        """
+        Saves new state of a job
+        :param job_id: job id
+        :param state: one of STATES. If None the state doesn't change
+        :param processes: list of (subprocess.Popen, command name) tuples. Pipeline processes of the job,
+            they are killed if they outlive the job
+        :param tmp_paths: temporary files and directories of the job, they are removed if the job doesn't finish
+        :param details: values to save in the job's entry. If there is "pid" of the job process,
+            its start time is saved as "pid_started"
+        :return: the updated entry
+        """
+        entry = self.get(job_id) or {"job_id": job_id, "state": None, "processes": [], "tmp_paths": []}
+        if state:
+            entry["state"] = state
+        # A pid alone may belong to another process after a reboot or a pid wraparound
+        entry["processes"] += [{"pid": proc.pid, "name": name, "started": process_start_time(proc.pid)}
+                               for proc, name in processes]
+        if "pid" in details and "pid_started" not in details:
+            details["pid_started"] = process_start_time(details["pid"])
+        entry["tmp_paths"] += [path for path in tmp_paths if path]
+        entry.update(details)
+        self._write(job_id, entry)
+        return entry
+
+    def remove(self, job_id):
+        try:
+            os.remove(self._path(job_id))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise JobJournalException("Failed to remove journal entry of job %s: %s" % (job_id, err))
+
+    def entries(self):
+        """
+        :return: list of journal entries ordered by job_id
+        """
+        try:
+            names = os.listdir(self.journal_dir)
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                return []
+            raise JobJournalException("Failed to read journal directory %s: %s" % (self.journal_dir, err))
+        entries = []
+        for name in names:
+            if name.endswith(".json"):
+                entry = self.get(name[:-len(".json")])
+                if entry:
+                    entries.append(entry)
+        entries.sort(key=lambda e: int(e["job_id"]))
+        return entries
+
+    def cleanup(self, entry):
+        """
+        Kills pipeline processes of the job that are still running and removes its temporary files
+        """
+        log = self.logger
+        for proc in entry.get("processes", []):
+            if process_name(proc["pid"]) == proc["name"][:15] and is_alive(proc["pid"], proc.get("started")):
+                log.warning("Killing orphaned process %s (pid %d) of job %s"
+                            % (proc["name"], proc["pid"], entry["job_id"]))
+                try:
+                    os.kill(proc["pid"], signal.SIGTERM)
+                except OSError as err:
+                    log.error("Failed to kill process %d: %s" % (proc["pid"], err))
+        for path in entry.get("tmp_paths", []):
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+            except (IOError, OSError) as err:
+                log.error("Failed to remove %s: %s" % (path, err))
+
+    def _write(self, job_id, entry):
+        try:
+            if not os.path.exists(self.journal_dir):
+                os.makedirs(self.journal_dir, 0700)
+            path = self._path(job_id)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entry, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, path)
+            # Make the rename durable
+            dir_fd = os.open(self.journal_dir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except (IOError, OSError) as err:
+            raise JobJournalException("Failed to save journal entry of job %s: %s" % (job_id, err))
+
+
+def record(job_id, state=None, **kwargs):
+    """
+    Saves a transition of a job in the journal. A failure is logged, but the job goes on
+    :param kwargs: see JobJournal.update()
+    :return: True if the transition is saved
+    """
+    journal = JobJournal()
+    try:
+        journal.update(job_id, state, **kwargs)
+    except JobJournalException as err:
+        logging.getLogger("twindb_remote").error(err, {"job_id": job_id})
+        return False
+    return True
+
+
+def process_name(pid):
+    """
+    :return: command name of a running process (at most 15 characters) or None if it doesn't run
+    """
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            stat = f.read()
+    except IOError:
+        return None
+    state = stat.rpartition(")")[2].split()[0]
+    if state == "Z":
+        return None
+    return stat[stat.find("(") + 1:stat.rfind(")")]
+
+
+def process_start_time(pid):
+    """
+    Identifies a process instance, so a pid reused by another process isn't mistaken for it
+    :return: boot id and start time of the process in clock ticks since boot or None if it doesn't run
+    """
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            stat = f.read()
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            boot_id = f.read().strip()
+    except IOError:
+        return None
+    # Fields after the command name start with field 3 (state), start time is field 22
+    return "%s:%s" % (boot_id, stat.rpartition(")")[2].split()[19])
+
+
+def is_alive(pid, started=None):
+    """
+    :param started: start time of the process as returned by process_start_time().
+        If given, the process must have started at that time
+    :return: True if the process is running
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        if err.errno != errno.EPERM:
+            return False
+    if process_name(pid) is None:
+        return False
+    return started is None or process_start_time(pid) == started
+
+
+class JobJournalException(Exception):
+    pass
@@ -3,6 +3,7 @@ import logging.handlers
 import os
 import twindb_agent.config
 import twindb_agent.httpclient
+import twindb_agent.spool
 
 FMT_STR = "%(asctime)s: %(processName)s: %(levelname)s: %(module)s: %(funcName)s():%(lineno)d: %(message)s"
 FMT_REMOTE_STR = "%(levelname)s: %(processName)s: %(module)s: %(funcName)s():%(lineno)d: %(message)s"
@@ -32,7 +33,11 @@ class RlogHandler(logging.Handler):
             pass
         request["params"]["msg"] = record.getMessage()
         httpclient = twindb_agent.httpclient.TwinDBHTTPClient()
-        httpclient.get_response(request)
+        try:
+            if not httpclient.get_response(request):
+                twindb_agent.spool.Spool().append(request)
+        except (twindb_agent.spool.SpoolException, IOError, OSError):
+            self.handleError(record)
 
 
 def create_local_logger(debug=False):
@@ -0,0 +1,156 @@
+"""
+Event loop of the agent
+"""
+import heapq
+import itertools
+import logging
+import Queue
+import random
+import threading
+import time
+
+
+class Timer(object):
+    __slots__ = ["when", "callback", "args", "cancelled"]
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Periodic(object):
+    """
+    Handle of a callback scheduled with EventLoop.call_every()
+    """
+    def __init__(self):
+        self.timer = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.timer:
+            self.timer.cancel()
+
+
+class EventLoop(object):
+    """
+    Runs timers in the main thread and blocking calls (HTTP, GPG, MySQL) in a pool of worker threads.
+
+    Callbacks scheduled with call_soon(), call_later() and call_every() run in the thread
+    that called run(), one at a time, so they must not block. Blocking work goes to
+    run_in_executor() and its result is passed to a callback in the loop thread.
+    """
+    # The loop wakes up at least that often, so signal handlers get a chance to run
+    max_wait = 1.0
+
+    def __init__(self, workers=4, logger_name="twindb_local"):
+        self.logger = logging.getLogger(logger_name)
+        self._timers = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = False
+        self._tasks = Queue.Queue()
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name="twindb-worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def call_soon(self, callback, *args):
+        """
+        Schedules callback to run in the loop thread as soon as possible. Thread safe
+        """
+        return self.call_later(0, callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedules callback to run in the loop thread after delay seconds. Thread safe
+        :return: Timer. Call its cancel() to cancel the callback
+        """
+        timer = Timer(time.time() + delay, callback, args)
+        with self._cond:
+            heapq.heappush(self._timers, (timer.when, next(self._seq), timer))
+            self._cond.notify()
+        return timer
+
+    def call_every(self, interval, callback, jitter=0.0):
+        """
+        Runs callback every interval seconds. The first call is after a random delay up to interval,
+        so periodic tasks of agents started together don't run in lockstep
+        :param jitter: relative deviation of the interval
+        :return: Periodic. Call its cancel() to stop
+        """
+        periodic = Periodic()
+
+        def tick():
+            if periodic.cancelled:
+                return
+            try:
+                callback()
+            finally:
+                if not periodic.cancelled:
+                    periodic.timer = self.call_later(interval * random.uniform(1 - jitter, 1 + jitter), tick)
+        periodic.timer = self.call_later(random.uniform(0, interval), tick)
+        return periodic
+
+    def run_in_executor(self, func, args=(), callback=None):
+        """
+        Runs func(*args) in a worker thread
+        :param callback: called in the loop thread as callback(result, error) when func returns.
+            error is the exception raised by func or None
+        """
+        self._tasks.put((func, args, callback))
+
+    def _worker(self):
+        while True:
+            func, args, callback = self._tasks.get()
+            result = None
+            error = None
+            try:
+                result = func(*args)
+            except Exception as err:
+                self.logger.error("%s() failed: %s" % (getattr(func, "__name__", func), err))
+                error = err
+            if callback:
+                self.call_soon(callback, result, error)
+
+    def run(self):
+        """
+        Runs callbacks until stop() is called
+        """
+        self._running = True
+        while True:
+            with self._cond:
+                timer = None
+                while self._running and not timer:
+                    now = time.time()
+                    if self._timers and self._timers[0][0] <= now:
+                        timer = heapq.heappop(self._timers)[2]
+                    else:
+                        timeout = self.max_wait
+                        if self._timers:
+                            timeout = min(timeout, self._timers[0][0] - now)
+                        self._cond.wait(timeout)
+                if not self._running:
+                    return
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception as err:
+                self.logger.error("Callback %s() failed: %s" % (getattr(timer.callback, "__name__", timer.callback),
+                                                                err))
+
+    def stop(self):
+        """
+        Makes run() return. Thread safe
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
@@ -0,0 +1,176 @@
+"""
+Segmented backup copies with a manifest
+
+A plain backup copy is one GPG message, it can be read only from the start to the end.
+With backup_manifest enabled the xbstream is cut at chunk boundaries into segments of about
+backup_segment_size bytes and every segment is encrypted separately. The copy is the concatenation
+of the encrypted segments. The manifest, saved next to the copy and encrypted too, lists
+    segments: offset and size in the copy, offset and size in the xbstream, SHA256 of the xbstream bytes
+    files: ranges of the xbstream with chunks of the file, total size and SHA256 of the chunks
+so a restore can download and decrypt only the segments it needs, several at once.
+"""
+import bisect
+import hashlib
+import json
+import Queue
+import subprocess
+import threading
+import twindb_agent.config
+import twindb_agent.xbstream
+
+MANIFEST_VERSION = 1
+
+
+def encrypt(data):
+    """
+    Encrypts data with the agent's key
+    :return: GPG message
+    """
+    agent_config = twindb_agent.config.AgentConfig.get_config()
+    gpg_cmd = ["gpg", "--homedir", agent_config.gpg_homedir, "--encrypt", "--yes", "--batch",
+               "--no-permission-warning", "--quiet", "--recipient", agent_config.server_id]
+    try:
+        proc = subprocess.Popen(gpg_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as err:
+        raise ManifestException("Failed to run command %r: %s" % (gpg_cmd, err))
+    out, err = proc.communicate(data)
+    if proc.returncode != 0:
+        raise ManifestException("GPG exited with code %d: %s" % (proc.returncode, err))
+    return out
+
+
+class SegmentWriter(object):
+    """
+    Cuts an xbstream into segments, encrypts them and writes them to out.
+    A segment is encrypted in a separate thread while the next one is read.
+    """
+    def __init__(self, out, segment_size, encrypt_func=encrypt):
+        """
+        :param out: file object the encrypted segments are written to
+        :param segment_size: a segment is closed when it has at least this many bytes
+        :param encrypt_func: function that takes plain data and returns it encrypted
+        """
+        self.out = out
+        self.segment_size = segment_size
+        self.encrypt = encrypt_func
+        self.segments = []
+        self.files = {}
+        self._hashes = {}
+        self._buffer = []
+        self._buffered = 0
+        # Offsets of the next byte in the xbstream and in the copy
+        self._plain_offset = 0
+        self._offset = 0
+        self._queue = Queue.Queue(maxsize=1)
+        self._error = None
+
+    def _encrypt_segments(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            if self._error:
+                continue
+            try:
+                encrypted = self.encrypt(data)
+                self.out.write(encrypted)
+            except (IOError, ManifestException) as err:
+                self._error = err
+                continue
+            self.segments.append({"offset": self._offset, "size": len(encrypted),
+                                  "plain_offset": self._plain_offset, "plain_size": len(data),
+                                  "sha256": hashlib.sha256(data).hexdigest()})
+            self._offset += len(encrypted)
+            self._plain_offset += len(data)
+
+    def _add_chunk(self, path, chunk, position):
+        entry = self.files.get(path)
+        if entry is None:
+            entry = self.files[path] = {"ranges": [], "size": 0}
+            self._hashes[path] = hashlib.sha256()
+        ranges = entry["ranges"]
+        if ranges and ranges[-1][0] + ranges[-1][1] == position:
+            ranges[-1][1] += len(chunk)
+        else:
+            ranges.append([position, len(chunk)])
+        entry["size"] += len(chunk)
+        self._hashes[path].update(chunk)
+        self._buffer.append(chunk)
+        self._buffered += len(chunk)
+
+    def _close_segment(self):
+        if self._buffer:
+            self._queue.put("".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def write_stream(self, stream):
+        """
+        Reads an xbstream to the end and writes it as encrypted segments
+        :param stream: file object with xbstream
+        :return: the manifest
+        """
+        worker = threading.Thread(target=self._encrypt_segments)
+        worker.daemon = True
+        worker.start()
+        position = 0
+        try:
+            for path, chunk in twindb_agent.xbstream.read_chunks(stream):
+                if self._error:
+                    break
+                self._add_chunk(path, chunk, position)
+                position += len(chunk)
+                if self._buffered >= self.segment_size:
+                    self._close_segment()
+            self._close_segment()
+        finally:
+            self._queue.put(None)
+            worker.join()
+        if self._error:
+            raise ManifestException("Failed to write a segment: %s" % self._error)
+        return self.manifest()
+
+    def manifest(self):
+        for path, digest in self._hashes.items():
+            self.files[path]["sha256"] = digest.hexdigest()
+        return {"version": MANIFEST_VERSION, "segment_size": self.segment_size,
+                "segments": self.segments, "files": self.files}
+
+
+def load(data):
+    """
+    :param data: decrypted manifest
+    :return: the manifest dictionary
+    """
+    try:
+        manifest = json.loads(data)
+    except ValueError as err:
+        raise ManifestException("Broken manifest: %s" % err)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ManifestException("Unsupported manifest version %r" % manifest.get("version"))
+    return manifest
+
+
+def segments_for(manifest, keep=None):
+    """
+    Finds segments with chunks of needed files
+    :param keep: function that takes a path and returns True if the file is needed. None means all files
+    :return: list of segments in the order of the xbstream
+    """
+    segments = manifest["segments"]
+    if keep is None:
+        return list(segments)
+    starts = [segment["plain_offset"] for segment in segments]
+    needed = set()
+    for path, entry in manifest["files"].items():
+        if not keep(path):
+            continue
+        for offset, size in entry["ranges"]:
+            first = bisect.bisect_right(starts, offset) - 1
+            last = bisect.bisect_right(starts, offset + size - 1) - 1
+            needed.update(range(first, last + 1))
+    return [segments[i] for i in sorted(needed)]
+
+
+class ManifestException(Exception):
+    pass
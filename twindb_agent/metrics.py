@@ -0,0 +1,233 @@
+"""
+Counters and latency histograms of agent operations
+
+Metrics are exposed in Prometheus text format on http://metrics_host:metrics_port/metrics.
+Jobs run in separate processes, they send their metrics to the agent process when they finish.
+
+Recording is cheap enough for hot paths:
+    with twindb_agent.metrics.API_LATENCY.time(request_type):
+        ...
+    twindb_agent.metrics.API_REQUESTS.inc(request_type, "ok")
+"""
+import BaseHTTPServer
+import bisect
+import logging
+import threading
+import time
+
+# Latency buckets in seconds, from sub-millisecond API calls to multi-hour backup stages
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 14400)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = zip(names, values)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                             for k, v in pairs)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter(object):
+    type = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, **kwargs):
+        """
+        Increments the counter
+        :param label_values: values of labels in the order they were declared
+        :param amount: increment, 1 by default
+        """
+        amount = kwargs.get("amount", 1)
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.values)
+
+    def merge(self, values):
+        with self._lock:
+            for key, value in values.items():
+                key = tuple(key)
+                self.values[key] = self.values.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+
+    def render(self):
+        lines = []
+        for key, value in sorted(self.snapshot().items()):
+            lines.append("%s%s %s" % (self.name, _format_labels(self.labels, key), _format_value(value)))
+        return lines
+
+
+class _HistogramTimer(object):
+    __slots__ = ["histogram", "label_values", "started"]
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.time() - self.started, *self.label_values)
+        return False
+
+
+class Histogram(object):
+    type = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def time(self, *label_values):
+        """
+        :return: context manager that observes time spent in the block
+        """
+        return _HistogramTimer(self, label_values)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((key, [list(entry[0]), entry[1]]) for key, entry in self.values.items())
+
+    def merge(self, values):
+        with self._lock:
+            for key, (counts, total) in values.items():
+                key = tuple(key)
+                entry = self.values.get(key)
+                if entry is None:
+                    entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+                for i, count in enumerate(counts):
+                    entry[0][i] += count
+                entry[1] += total
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+
+    def render(self):
+        lines = []
+        for key, (counts, total) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, ("le", _format_value(bound)))
+                lines.append("%s_bucket%s %d" % (self.name, labels, cumulative))
+            lines.append("%s_sum%s %s" % (self.name, _format_labels(self.labels, key), _format_value(total)))
+            lines.append("%s_count%s %d" % (self.name, _format_labels(self.labels, key), cumulative))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """
+        :return: values of all metrics. Can be sent to another process and merged there
+        """
+        return dict((m.name, m.snapshot()) for m in self.metrics)
+
+    def merge(self, snapshot):
+        for m in self.metrics:
+            if m.name in snapshot:
+                m.merge(snapshot[m.name])
+
+    def reset(self):
+        for m in self.metrics:
+            m.reset()
+
+    def render(self):
+        """
+        :return: all metrics in Prometheus text format
+        """
+        lines = []
+        for m in self.metrics:
+            lines.append("# HELP %s %s" % (m.name, m.help))
+            lines.append("# TYPE %s %s" % (m.name, m.type))
+            lines += m.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+API_REQUESTS = REGISTRY.register(Counter("twindb_api_requests_total", "Requests to the dispatcher by result",
+                                         ["type", "result"]))
+API_LATENCY = REGISTRY.register(Histogram("twindb_api_request_seconds", "Latency of dispatcher requests",
+                                          ["type"]))
+GPG_LATENCY = REGISTRY.register(Histogram("twindb_gpg_seconds", "Time spent in gpg encrypting and decrypting messages",
+                                          ["operation"]))
+SUBPROCESS_LATENCY = REGISTRY.register(Histogram("twindb_subprocess_seconds", "Run time of auxiliary commands",
+                                                 ["command"]))
+MYSQL_LATENCY = REGISTRY.register(Histogram("twindb_mysql_seconds", "Latency of MySQL connects and queries",
+                                            ["operation"]))
+STAGE_LATENCY = REGISTRY.register(Histogram("twindb_pipeline_stage_seconds", "Run time of job pipeline stages",
+                                            ["job_type", "stage"]))
+JOBS = REGISTRY.register(Counter("twindb_jobs_total", "Finished jobs by return code", ["type", "ret_code"]))
+JOB_LATENCY = REGISTRY.register(Histogram("twindb_job_seconds", "Run time of jobs", ["type"]))
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        body = REGISTRY.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.getLogger("twindb_local").debug(fmt, *args)
+
+
+def start_server(host, port):
+    """
+    Serves metrics in a background thread
+    :return: BaseHTTPServer.HTTPServer instance. Raises socket.error if the port can't be bound
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server")
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,98 @@
+"""
+Scheduling of dispatcher polls
+"""
+import heapq
+import random
+import time
+
+
+class PollScheduler(object):
+    """
+    Decides how long the agent sleeps between iterations of the main loop.
+
+    The interval is check_period randomized by +/- jitter, so agents started together
+    drift apart instead of polling the dispatcher in lockstep. The interval grows
+    while the agent is idle or the dispatcher fails and drops back to check_period
+    as soon as there is work. If the dispatcher announced when the next job is
+    scheduled the agent wakes up right after that moment.
+    """
+    # Number of idle cycles at full speed before the agent starts to back off
+    idle_cycles = 10
+    idle_factor = 1.5
+    error_factor = 2.0
+
+    def __init__(self, check_period, jitter=0.0, idle_max=0, error_max=0, long_poll=0, rng=None):
+        """
+        :param check_period: base interval in seconds
+        :param jitter: relative deviation of the interval, e.g. 0.2 means +/- 20%
+        :param idle_max: the longest interval when idle. Idle backoff is off if it's not above check_period
+        :param error_max: the longest interval when the dispatcher fails.
+            Error backoff is off if it's not above check_period
+        :param long_poll: how long get_job blocks on the dispatcher side. Zero if long poll is off
+        :param rng: random.Random instance
+        """
+        self.check_period = check_period
+        self.jitter = jitter
+        self.idle_max = idle_max
+        self.error_max = error_max
+        self.long_poll = long_poll
+        self.rng = rng or random.Random()
+        self.idle = 0
+        self.errors = 0
+        self.announced = []
+
+    def job_received(self):
+        self.idle = 0
+        self.errors = 0
+
+    def idle_cycle(self):
+        self.idle += 1
+        self.errors = 0
+
+    def error(self):
+        self.errors += 1
+
+    def announce(self, start_scheduled):
+        """
+        Remembers when the dispatcher is going to have a job for the agent
+        :param start_scheduled: unix timestamp
+        """
+        start_scheduled = int(start_scheduled)
+        if start_scheduled not in self.announced:
+            heapq.heappush(self.announced, start_scheduled)
+
+    def base_interval(self):
+        """
+        :return: interval before jitter is applied
+        """
+        if self.errors:
+            if self.error_max > self.check_period:
+                return min(self.error_max, self.check_period * self.error_factor ** self.errors)
+            return self.check_period
+        if self.long_poll:
+            # get_job has already waited on the dispatcher side
+            return 0
+        if self.idle > self.idle_cycles and self.idle_max > self.check_period:
+            return min(self.idle_max, self.check_period * self.idle_factor ** (self.idle - self.idle_cycles))
+        return self.check_period
+
+    def next_interval(self, now=None):
+        """
+        :return: time in seconds to sleep before the next poll
+        """
+        if now is None:
+            now = time.time()
+        while self.announced and self.announced[0] <= now:
+            # The announced time has come. Poll at full speed until the job arrives
+            heapq.heappop(self.announced)
+            self.idle = 0
+
+        interval = self.base_interval()
+        if interval:
+            interval *= self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+        else:
+            interval = self.rng.uniform(0, self.jitter * self.check_period)
+        if self.announced and self.announced[0] - now < interval:
+            # Wake up a little after the job is due rather than before it
+            interval = self.announced[0] - now + self.rng.uniform(0, 1)
+        return interval
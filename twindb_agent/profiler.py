@@ -0,0 +1,113 @@
+"""
+Profiling of jobs and of the agent's poll cycles
+
+Profiling is off by default. It's enabled for everything by --profile command line option
+(or profile = True in the agent config) and for a single job by "profile" job parameter.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import twindb_agent.config
+
+
+class Profiler(object):
+    """
+    Deterministic profiler of code that runs in one thread
+    """
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def get_stats(self):
+        self.profile.create_stats()
+        return pstats.Stats(self.profile)
+
+    def save(self, path):
+        """
+        Writes profile in pstats format. Read it with python -m pstats <path>
+        """
+        self.profile.dump_stats(path)
+
+    def hotspots(self, top=None):
+        """
+        :param top: number of functions to return, profile_top from the agent config by default
+        :return: list of functions where most time is spent (excluding time in callees), slowest first
+        """
+        if top is None:
+            top = twindb_agent.config.AgentConfig.get_config().profile_top
+        return get_hotspots(self.get_stats(), top)
+
+
+class CycleProfiler(object):
+    """
+    Accumulates profiles of repeating calls (poll cycles, reports) that may run in different threads
+    """
+    def __init__(self, profile_dir=None, logger_name="twindb_local"):
+        if not profile_dir:
+            profile_dir = twindb_agent.config.AgentConfig.get_config().profile_dir
+        self.profile_dir = profile_dir
+        self.logger = logging.getLogger(logger_name)
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def run(self, name, func, *args):
+        """
+        Calls func(*args) under profiler and adds its profile to the ones of the previous calls of the same name.
+        The accumulated profile is saved in <profile_dir>/agent.<name>.prof
+        :return: what func returns
+        """
+        profiler = Profiler()
+        profiler.start()
+        try:
+            return func(*args)
+        finally:
+            profiler.stop()
+            with self._lock:
+                if name in self.stats:
+                    self.stats[name].add(profiler.get_stats())
+                else:
+                    self.stats[name] = profiler.get_stats()
+                try:
+                    prepare_dir(self.profile_dir)
+                    self.stats[name].dump_stats(os.path.join(self.profile_dir, "agent.%s.prof" % name))
+                except (IOError, OSError) as err:
+                    self.logger.warning("Failed to save profile of %s: %s" % (name, err))
+
+    def wrap(self, name, func):
+        """
+        :return: function that runs func under profiler
+        """
+        def profiled(*args):
+            return self.run(name, func, *args)
+        profiled.__name__ = getattr(func, "__name__", name)
+        return profiled
+
+
+def get_hotspots(stats, top):
+    """
+    :param stats: pstats.Stats instance
+    :param top: number of functions to return
+    :return: list of dictionaries with function, number of calls, own and cumulative time
+    """
+    result = []
+    for (filename, line, func), (cc, nc, tt, ct, callers) in stats.stats.items():
+        result.append({
+            "function": "%s:%d(%s)" % (filename, line, func),
+            "calls": nc,
+            "tottime": round(tt, 6),
+            "cumtime": round(ct, 6)
+        })
+    result.sort(key=lambda x: x["tottime"], reverse=True)
+    return result[:top]
+
+
+def prepare_dir(path):
+    if not os.path.isdir(path):
+        os.makedirs(path, 0700)
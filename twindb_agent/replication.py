@@ -0,0 +1,123 @@
+"""
+Replication lag sampler
+
+SHOW SLAVE STATUS once per report misses short lag spikes. The sampler polls it every lag_sample_interval
+seconds on its own connection and keeps the samples in fixed-size arrays. Every replication report
+takes a summary of the samples collected since the previous one.
+"""
+import math
+import threading
+import time
+import twindb_agent.config
+import twindb_agent.twindb_mysql
+import twindb_agent.utils
+
+# Percentiles of lag reported for a window
+PERCENTILES = [50, 90, 99]
+
+_sampler = None
+
+
+def percentile(sorted_values, p):
+    """
+    :return: nearest-rank percentile p of sorted values
+    """
+    rank = int(math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class LagSampler(twindb_agent.twindb_mysql.MySQLSampler):
+    """
+    Samples Seconds_Behind_Master and the replication position in a background thread
+    """
+    def __init__(self, interval=None, size=None, logger_name="twindb_local"):
+        """
+        :param interval: seconds between samples
+        :param size: number of samples kept for a window. If a window is longer, the oldest samples are dropped
+        """
+        agent_config = twindb_agent.config.AgentConfig.get_config()
+        super(LagSampler, self).__init__(interval or agent_config.lag_sample_interval, logger_name=logger_name)
+        size = size or agent_config.lag_sample_size
+        # Lag of samples when replication is stopped is NaN
+        self.lags = twindb_agent.utils.RingBuffer(size)
+        self.samples = 0
+        self.window_start = time.time()
+        # (Relay_Master_Log_File, Exec_Master_Log_Pos, Executed_Gtid_Set) of the first and the last sample
+        self.first_position = None
+        self.last_position = None
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """
+        Takes one sample. The connection is kept open between samples
+        :return: True if a sample is taken, False if MySQL isn't available or the server isn't a slave
+        """
+        rows = self.query("SHOW SLAVE STATUS")
+        if not rows:
+            return False
+        row = rows[0]
+        lag = row["Seconds_Behind_Master"]
+        position = (row["Relay_Master_Log_File"], row["Exec_Master_Log_Pos"], row.get("Executed_Gtid_Set"))
+        with self._lock:
+            self.lags.append(float("nan") if lag is None else float(lag))
+            self.samples += 1
+            if self.first_position is None:
+                self.first_position = position
+            self.last_position = position
+        return True
+
+    def summary(self, reset=True):
+        """
+        Summarizes samples of the current window
+        :param reset: if True a new window starts
+        :return: dictionary with number of samples, lag statistics in seconds and replication progress
+        """
+        with self._lock:
+            now = time.time()
+            lags = self.lags.values()
+            result = {
+                "window": round(now - self.window_start, 3),
+                "samples": self.samples,
+                "dropped_samples": self.samples - len(lags)
+            }
+            first, last = self.first_position, self.last_position
+            if reset:
+                self.lags.clear()
+                self.samples = 0
+                self.window_start = now
+                self.first_position = self.last_position
+        running = sorted(lag for lag in lags if not math.isnan(lag))
+        result["stopped_samples"] = len(lags) - len(running)
+        if running:
+            result["min"] = running[0]
+            result["max"] = running[-1]
+            result["avg"] = round(sum(running) / len(running), 3)
+            for p in PERCENTILES:
+                result["p%d" % p] = percentile(running, p)
+        if first and last:
+            result["start_position"] = "%s:%s" % first[:2]
+            result["end_position"] = "%s:%s" % last[:2]
+            if first[0] == last[0]:
+                result["applied_bytes"] = last[1] - first[1]
+            if last[2] is not None:
+                result["start_gtid"] = first[2]
+                result["end_gtid"] = last[2]
+        return result
+
+
+def start_sampler():
+    """
+    Starts sampling replication lag in this process
+    :return: LagSampler instance
+    """
+    global _sampler
+    _sampler = LagSampler()
+    _sampler.start()
+    return _sampler
+
+
+def get_sampler():
+    """
+    :return: the running LagSampler or None if lag isn't sampled
+    """
+    return _sampler
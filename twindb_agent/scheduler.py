@@ -0,0 +1,101 @@
+"""
+Local queue of job orders waiting for their start time
+"""
+import heapq
+import itertools
+import threading
+import time
+
+
+# Priority of job types if the agent config doesn't set it. Lower number is more urgent
+DEFAULT_PRIORITY = 5
+
+
+class JobScheduler(object):
+    """
+    Job orders ordered by start_scheduled.
+
+    The agent prefetches job orders from the dispatcher and keeps them here until they are due,
+    so a job scheduled an hour ahead doesn't hold a process or a worker thread while it waits.
+    Of the due jobs the one with the most urgent priority starts first.
+    Job orders are deduplicated by job_id, the dispatcher sends a job again until it's started.
+    """
+    def __init__(self, priorities=None):
+        """
+        :param priorities: dictionary job type -> priority. Lower number is more urgent
+        """
+        self.priorities = priorities or {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._job_ids = set()
+        self._lock = threading.Lock()
+
+    def add(self, job_order):
+        """
+        Queues a job order
+        :return: False if the job is already queued
+        """
+        job_id = str(job_order["job_id"])
+        start = int(job_order.get("start_scheduled") or 0)
+        with self._lock:
+            if job_id in self._job_ids:
+                return False
+            self._job_ids.add(job_id)
+            heapq.heappush(self._heap, (start, next(self._seq), job_order))
+        return True
+
+    def next_start(self):
+        """
+        :return: unix time when the first queued job is due or None if the queue is empty
+        """
+        with self._lock:
+            if not self._heap:
+                return None
+            return self._heap[0][0]
+
+    def priority(self, job_type):
+        return self.priorities.get(job_type, DEFAULT_PRIORITY)
+
+    def _most_urgent(self, now):
+        """
+        :return: heap index of the most urgent job due by now or None
+        """
+        best = None
+        for i, (start, seq, job_order) in enumerate(self._heap):
+            if start > now:
+                continue
+            key = (self.priority(job_order.get("type")), start, seq)
+            if best is None or key < best[0]:
+                best = (key, i)
+        return best[1] if best else None
+
+    def peek_due(self, now=None):
+        """
+        :return: the most urgent job order due by now without removing it from the queue or None
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if not self._heap or self._heap[0][0] > now:
+                return None
+            return self._heap[self._most_urgent(now)][2]
+
+    def pop_due(self, now=None):
+        """
+        :return: the most urgent job order due by now or None if no job is due
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if not self._heap or self._heap[0][0] > now:
+                return None
+            i = self._most_urgent(now)
+            job_order = self._heap[i][2]
+            self._heap[i] = self._heap[-1]
+            self._heap.pop()
+            heapq.heapify(self._heap)
+            self._job_ids.discard(str(job_order["job_id"]))
+            return job_order
+
+    def __len__(self):
+        return len(self._heap)
@@ -0,0 +1,216 @@
+"""
+Durable spool for API calls that must reach the dispatcher
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import random
+import time
+import twindb_agent.config
+
+# Requests that can be dropped first if the spool is full
+DISPOSABLE_TYPES = ["log"]
+
+
+class Spool(object):
+    """
+    Append-only journal of requests the agent failed to deliver.
+
+    Every request gets a sequence number and is stored as a JSON line in spool_dir/spool.log.
+    Jobs and the main loop run in different processes, so the journal is protected by flock().
+    The main loop replays the journal in batches when the dispatcher is back. Requests sent directly
+    meanwhile may overtake spooled ones, the dispatcher orders them by their time.
+    """
+    batch_size = 100
+    backoff_factor = 2.0
+
+    def __init__(self, spool_dir=None, max_size=None, logger_name="twindb_local"):
+        """
+        :param spool_dir: directory for the journal. Taken from the agent config if None
+        :param max_size: the journal is never bigger than max_size bytes
+        """
+        config = twindb_agent.config.AgentConfig.get_config()
+        self.spool_dir = spool_dir or config.spool_dir
+        self.max_size = max_size or config.spool_max_size
+        self.journal = os.path.join(self.spool_dir, "spool.log")
+        self.seq_file = os.path.join(self.spool_dir, "spool.seq")
+        self.logger = logging.getLogger(logger_name)
+        self.failures = 0
+        self.next_replay = 0
+        self.replay_interval = config.check_period
+        self.replay_interval_max = config.check_period_error_max
+
+    def _lock(self):
+        if not os.path.exists(self.spool_dir):
+            try:
+                os.makedirs(self.spool_dir, 0700)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise SpoolException("Failed to create spool directory %s: %s" % (self.spool_dir, err))
+        lock = open(os.path.join(self.spool_dir, "spool.lock"), "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _next_seq(self):
+        seq = 0
+        try:
+            with open(self.seq_file) as f:
+                seq = int(f.read() or 0)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        seq += 1
+        with open(self.seq_file, "w") as f:
+            f.write("%d" % seq)
+        return seq
+
+    def _read(self):
+        """
+        :return: list of journal entries. A partly written last line is skipped
+        """
+        entries = []
+        try:
+            with open(self.journal) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        self.logger.error("Skipping broken spool record %r" % line)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        return entries
+
+    def _write(self, entries):
+        """
+        Atomically replaces the journal with entries
+        """
+        tmp = self.journal + ".tmp"
+        with open(tmp, "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.journal)
+
+    def size(self):
+        try:
+            return os.path.getsize(self.journal)
+        except OSError:
+            return 0
+
+    def pending(self):
+        """
+        :return: True if there are requests waiting for delivery
+        """
+        return self.size() > 0
+
+    def append(self, request):
+        """
+        Saves a request in the journal
+        :param request: request as passed to TwinDBHTTPClient.get_response()
+        :return: sequence number or None if the spool is full
+        """
+        lock = self._lock()
+        try:
+            seq = self._next_seq()
+            line = json.dumps({"seq": seq, "time": time.time(), "request": request}) + "\n"
+            if self.size() + len(line) > self.max_size and not self._make_room(len(line)):
+                self.logger.error("Spool %s is full. Dropping %s request" % (self.journal, request["type"]))
+                return None
+            with open(self.journal, "a+") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != "\n":
+                        # The previous append was interrupted
+                        line = "\n" + line
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            return seq
+        finally:
+            lock.close()
+
+    def _make_room(self, length):
+        """
+        Drops the oldest disposable requests until length bytes fit in the journal
+        :return: True if there is enough room
+        """
+        entries = self._read()
+        size = sum(len(json.dumps(e)) + 1 for e in entries)
+        kept = []
+        dropped = 0
+        for entry in entries:
+            if size + length > self.max_size and entry["request"]["type"] in DISPOSABLE_TYPES:
+                size -= len(json.dumps(entry)) + 1
+                dropped += 1
+            else:
+                kept.append(entry)
+        if dropped:
+            self.logger.warning("Spool is full. Dropped %d log records" % dropped)
+            self._write(kept)
+        return size + length <= self.max_size
+
+    def replay_batch(self, send):
+        """
+        Sends up to batch_size spooled requests in order and removes delivered ones from the journal
+        :param send: function that takes a request and returns True if the dispatcher received it
+        :return: tuple (number of delivered requests, True if a request failed)
+        """
+        # Don't hold the lock while talking to the dispatcher, jobs keep appending meanwhile
+        lock = self._lock()
+        try:
+            entries = self._read()[:self.batch_size]
+        finally:
+            lock.close()
+        delivered = 0
+        for entry in entries:
+            if not send(dict(entry["request"], seq=entry["seq"])):
+                break
+            delivered += 1
+        if delivered:
+            last_seq = entries[delivered - 1]["seq"]
+            lock = self._lock()
+            try:
+                self._write([e for e in self._read() if e["seq"] > last_seq])
+            finally:
+                lock.close()
+        return delivered, delivered < len(entries)
+
+    def replay(self, send, now=None):
+        """
+        Sends spooled requests in order until the spool is empty. Stops at the first failure and backs off.
+        :param send: function that takes a request and returns True if the dispatcher received it
+        :return: number of delivered requests
+        """
+        if now is None:
+            now = time.time()
+        if now < self.next_replay or not self.pending():
+            return 0
+        delivered = 0
+        failed = False
+        while self.pending():
+            count, failed = self.replay_batch(send)
+            delivered += count
+            if failed or not count:
+                break
+        if failed:
+            self.failures += 1
+            interval = min(self.replay_interval_max,
+                           self.replay_interval * self.backoff_factor ** (self.failures - 1))
+            self.next_replay = now + interval * random.uniform(0.5, 1.0)
+            self.logger.warning("Failed to replay spooled requests. Next attempt in %d seconds"
+                                % (self.next_replay - now))
+        else:
+            self.failures = 0
+            self.next_replay = 0
+        if delivered:
+            self.logger.info("Replayed %d spooled requests" % delivered)
+        return delivered
+
+
+class SpoolException(Exception):
+    pass
@@ -0,0 +1,148 @@
+"""
+MySQL global status collector
+
+The collector samples SHOW GLOBAL STATUS every status_sample_interval seconds. Each sample is a vector
+of values in the order of status_variables. Counters are turned into per-second rates and gauges are
+kept as they are. The history is columnar: one fixed-size array per variable.
+Reports ship the history downsampled to status_report_resolution seconds with the "report_metrics" call.
+"""
+import array
+import math
+import threading
+import time
+import twindb_agent.config
+import twindb_agent.twindb_mysql
+import twindb_agent.utils
+
+# Status variables that are current values rather than counters
+GAUGES = frozenset(["Threads_running", "Threads_connected", "Innodb_buffer_pool_pages_dirty",
+                    "Innodb_buffer_pool_pages_free", "Innodb_row_lock_current_waits", "Open_tables"])
+
+_collector = None
+
+
+def rates(previous, current, elapsed, gauges):
+    """
+    Computes per-second rates of a whole sample vector
+    :param previous: values of the previous sample
+    :param current: values of the current sample
+    :param elapsed: seconds between the samples
+    :param gauges: vector of booleans, True if the variable is a gauge
+    :return: list of rates of counters and current values of gauges. Rate of a counter that went
+        backwards (the server restarted or the counter wrapped) is NaN
+    """
+    nan = float("nan")
+    return [cur if gauge else (cur - prev) / elapsed if cur >= prev else nan
+            for prev, cur, gauge in zip(previous, current, gauges)]
+
+
+class StatusCollector(twindb_agent.twindb_mysql.MySQLSampler):
+    def __init__(self, interval=None, variables=None, size=None, logger_name="twindb_local"):
+        """
+        :param interval: seconds between samples
+        :param variables: names of status variables to collect
+        :param size: number of samples kept between reports. If there are more, the oldest ones are dropped
+        """
+        agent_config = twindb_agent.config.AgentConfig.get_config()
+        super(StatusCollector, self).__init__(interval or agent_config.status_sample_interval,
+                                              logger_name=logger_name)
+        self.variables = list(variables or agent_config.status_variables)
+        self.gauges = [name in GAUGES for name in self.variables]
+        size = size or agent_config.status_history_size
+        self.times = twindb_agent.utils.RingBuffer(size)
+        self.columns = [twindb_agent.utils.RingBuffer(size) for _ in self.variables]
+        # (time, values) of the last sample
+        self.previous = None
+        self._lock = threading.Lock()
+
+    def read_status(self):
+        """
+        :return: array of values of the variables, NaN if the server doesn't have a variable.
+            None if MySQL isn't available
+        """
+        names = ",".join("'%s'" % name for name in self.variables)
+        rows = self.query("SHOW GLOBAL STATUS WHERE Variable_name IN (%s)" % names)
+        if rows is None:
+            return None
+        status = {}
+        for row in rows:
+            try:
+                status[row["Variable_name"]] = float(row["Value"])
+            except ValueError:
+                pass
+        return array.array("d", [status.get(name, float("nan")) for name in self.variables])
+
+    def sample(self, now=None):
+        """
+        Takes one sample and adds rates since the previous sample to the history
+        :return: True if the sample is taken
+        """
+        values = self.read_status()
+        if values is None:
+            return False
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if self.previous and now > self.previous[0]:
+                row = rates(self.previous[1], values, now - self.previous[0], self.gauges)
+                self.times.append(now)
+                for column, value in zip(self.columns, row):
+                    column.append(value)
+            self.previous = (now, values)
+        return True
+
+    def latest(self):
+        """
+        :return: dictionary variable -> the latest rate or gauge value, empty if there are no rates yet
+        """
+        with self._lock:
+            if not len(self.times):
+                return {}
+            return dict((name, column.values()[-1]) for name, column in zip(self.variables, self.columns))
+
+    def downsample(self, resolution, reset=True):
+        """
+        Averages the history over intervals of resolution seconds
+        :param resolution: length of an interval in seconds
+        :param reset: if True the history is cleared
+        :return: dictionary with "timestamps" - start times of the intervals and "metrics" -
+            variable -> list of averages. An average is None if there are no valid samples in the interval
+        """
+        with self._lock:
+            times = self.times.values()
+            columns = [column.values() for column in self.columns]
+            if reset:
+                self.times.clear()
+                for column in self.columns:
+                    column.clear()
+        buckets = [int(t // resolution) * resolution for t in times]
+        timestamps = sorted(set(buckets))
+        position = dict((bucket, i) for i, bucket in enumerate(timestamps))
+        metrics = {}
+        for name, column in zip(self.variables, columns):
+            sums = [0.0] * len(timestamps)
+            counts = [0] * len(timestamps)
+            for bucket, value in zip(buckets, column):
+                if not math.isnan(value):
+                    sums[position[bucket]] += value
+                    counts[position[bucket]] += 1
+            metrics[name] = [round(s / c, 3) if c else None for s, c in zip(sums, counts)]
+        return {"timestamps": timestamps, "metrics": metrics}
+
+
+def start_collector():
+    """
+    Starts collecting MySQL status in this process
+    :return: StatusCollector instance
+    """
+    global _collector
+    _collector = StatusCollector()
+    _collector.start()
+    return _collector
+
+
+def get_collector():
+    """
+    :return: the running StatusCollector or None if status isn't collected
+    """
+    return _collector
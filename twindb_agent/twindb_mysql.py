@@ -7,8 +7,11 @@ import logging
 import os
 import subprocess
 import pwd
+import threading
+import twindb_agent.cache
 import twindb_agent.config
 import twindb_agent.handlers
+import twindb_agent.metrics
 
 try:
     import mysql.connector
@@ -18,6 +21,10 @@ except ImportError:
     sys.path.insert(0, '/usr/lib/python2.6/site-packages')
     import mysql.connector
 
+# Status counters that change when privileges may have changed
+GRANT_SIGNALS = ["Com_grant", "Com_revoke", "Com_revoke_all", "Com_create_user", "Com_drop_user",
+                 "Com_rename_user", "Com_flush"]
+
 
 class MySQL(object):
     def __init__(self, mysql_user=None, mysql_password=None, logger_name="twindb_remote"):
@@ -74,7 +81,9 @@ class MySQL(object):
                         self.mysql_password = ""
                         log.debug("Connecting to MySQL as unix user %s" % self.mysql_user)
 
-            conn = mysql.connector.connect(user=self.mysql_user, passwd=self.mysql_password, unix_socket=unix_socket)
+            with twindb_agent.metrics.MYSQL_LATENCY.time("connect"):
+                conn = mysql.connector.connect(user=self.mysql_user, passwd=self.mysql_password,
+                                               unix_socket=unix_socket)
             log.debug("Connected to MySQL as %s@localhost " % conn.user)
         except mysql.connector.Error as err:
             log.error("Can not connect to local MySQL server")
@@ -90,8 +99,9 @@ class MySQL(object):
         log = self.logger
         cmd = ["lsof", "-U", "-c", "/^mysqld$/", "-a", "-F", "n"]
         try:
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            cout, cerr = p.communicate()
+            with twindb_agent.metrics.SUBPROCESS_LATENCY.time("lsof"):
+                p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                cout, cerr = p.communicate()
             # Outputs socket in format
             # # lsof -U -c mysqld -a -F n
             # p11029
@@ -130,8 +140,10 @@ class MySQL(object):
             "mysql_slave_sql_running": None
         }
         try:
-            cursor.execute("SHOW SLAVE STATUS")
-            for row in cursor:
+            with twindb_agent.metrics.MYSQL_LATENCY.time("show_slave_status"):
+                cursor.execute("SHOW SLAVE STATUS")
+                rows = cursor.fetchall()
+            for row in rows:
                 result["mysql_master_server_id"] = row["Master_Server_Id"]
                 result["mysql_master_host"] = row["Master_Host"]
                 result["mysql_seconds_behind_master"] = row["Seconds_Behind_Master"]
@@ -153,6 +165,86 @@ class MySQL(object):
             return None
         return result
 
+    def get_grant_signal(self, cursor):
+        """
+        Reads counters of statements that change privileges and uptime of the server
+        :return: dictionary with GRANT_SIGNALS counters and Uptime
+        """
+        names = ",".join("'%s'" % name for name in GRANT_SIGNALS + ["Uptime"])
+        with twindb_agent.metrics.MYSQL_LATENCY.time("grant_signal"):
+            cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN (%s)" % names)
+            rows = cursor.fetchall()
+        return dict((row["Variable_name"], int(row["Value"])) for row in rows)
+
+    def get_privileges(self, conn):
+        """
+        Reads global privileges of the connected user and its privileges on the mysql schema.
+        The snapshot is shared with other agent processes via privilege_cache_file. It's reused until
+        privilege_cache_ttl expires or the grant signal tells privileges may have changed.
+        :param conn: connection to MySQL
+        :return: dictionary with "user" - CURRENT_USER(), "privileges" - {privilege_type: is_grantable}
+        of global privileges and "mysql_privileges" - list of privilege types on mysql.*.
+        None if error happened
+        """
+        log = self.logger
+        cache = twindb_agent.cache.SharedCache(self.agent_config.privilege_cache_file,
+                                               self.agent_config.privilege_cache_ttl)
+        try:
+            cursor = conn.cursor(dictionary=True)
+            signal = self.get_grant_signal(cursor)
+            entry = cache.load()
+            snapshots = entry["value"] if entry else {}
+            # Keys of the JSON cache are strings. mysql_user is None if credentials come from an option file
+            key = str(self.mysql_user)
+            snapshot = snapshots.get(key)
+            if cache.is_fresh(entry) and snapshot and self.is_same_grants(snapshot["signal"], signal):
+                cursor.close()
+                return snapshot
+
+            # Fetch the current user and matching host part as it could either be
+            # connecting using localhost or using '%'
+            cursor.execute("SELECT CURRENT_USER() as curr_user")
+            current_user = cursor.fetchone()['curr_user']
+            username, hostname = current_user.split('@')
+
+            sql = ("SELECT privilege_type, is_grantable FROM information_schema.user_privileges "
+                   "WHERE grantee=\"'%s'@'%s'\"" % (username, hostname))
+            with twindb_agent.metrics.MYSQL_LATENCY.time("user_privileges"):
+                cursor.execute(sql)
+                rows = cursor.fetchall()
+            privileges = dict((row[u'privilege_type'], row[u'is_grantable']) for row in rows)
+
+            sql = ("SELECT privilege_type FROM information_schema.schema_privileges "
+                   "WHERE grantee=\"'%s'@'%s'\" AND table_schema = 'mysql'" % (username, hostname))
+            with twindb_agent.metrics.MYSQL_LATENCY.time("schema_privileges"):
+                cursor.execute(sql)
+                rows = cursor.fetchall()
+            mysql_privileges = [row[u'privilege_type'] for row in rows]
+            cursor.close()
+        except mysql.connector.Error as err:
+            log.error("Could not read the grants information from MySQL")
+            log.error("MySQL Error: %s" % err)
+            return None
+        snapshot = {
+            "user": current_user,
+            "privileges": privileges,
+            "mysql_privileges": mysql_privileges,
+            "signal": signal
+        }
+        snapshots[key] = snapshot
+        cache.store(snapshots)
+        return snapshot
+
+    @staticmethod
+    def is_same_grants(old_signal, new_signal):
+        """
+        :return: True if privileges can't have changed between two grant signals
+        """
+        if new_signal.get("Uptime", 0) < old_signal.get("Uptime", 0):
+            # The server restarted
+            return False
+        return all(old_signal.get(name) == new_signal.get(name) for name in GRANT_SIGNALS)
+
     def has_mysql_access(self, grant_capability=True):
         """
         Reports if a user has all required MySQL privileges
@@ -160,81 +252,44 @@ class MySQL(object):
         :return: a pair of a boolean that tells whether MySQL user has all required privileges
         and a list of missing privileges
         """
-        log = self.logger
         has_required_grants = False
 
         # list of missing privileges
         missing_privileges = []
         required_privileges = ["RELOAD", "SUPER", "LOCK TABLES", "REPLICATION CLIENT", "CREATE TABLESPACE"]
 
-        try:
-            conn = self.get_mysql_connection()
-
-            if isinstance(conn, mysql.connector.MySQLConnection):
-                cursor = conn.cursor(dictionary=True)
-            else:
-                missing_privileges = required_privileges
-                return has_required_grants, missing_privileges
-
-            # Fetch the current user and matching host part as it could either be
-            # connecting using localhost or using '%'
-            cursor.execute("SELECT CURRENT_USER() as curr_user")
-            row = cursor.fetchone()
-            username, hostname = row['curr_user'].split('@')
-
-            quoted_privileges = ','.join("'%s'" % item for item in required_privileges)
+        conn = self.get_mysql_connection()
+        if isinstance(conn, mysql.connector.MySQLConnection):
+            snapshot = self.get_privileges(conn)
+            conn.close()
+        else:
+            snapshot = None
+        if not snapshot:
+            missing_privileges = required_privileges
+            return has_required_grants, missing_privileges
 
-            sql = ("SELECT privilege_type, is_grantable FROM information_schema.user_privileges "
-                   "WHERE grantee=\"'%s'@'%s'\" AND privilege_type IN (%s)" % (username, hostname, quoted_privileges))
-            cursor.execute(sql)
+        user_privileges = snapshot["privileges"]
 
-            user_privileges = []
-            grantable_privileges = []
-            for row in cursor:
-                user_privileges.append(row[u'privilege_type'])
-                if row[u'is_grantable'] == 'YES':
-                    grantable_privileges.append(row[u'privilege_type'])
-
-            # Check that the user has all the required grants
-            has_required_grants = True
-            for privilege in required_privileges:
-                if privilege in user_privileges:
-                    # If the user should also be able to grant the privilege then we check for the grant capability too
-                    # We consider the privilege not available if its not grantable in such a case
-                    if grant_capability and privilege not in grantable_privileges:
-                        has_required_grants = False
-                else:
+        # Check that the user has all the required grants
+        has_required_grants = True
+        for privilege in required_privileges:
+            if privilege in user_privileges:
+                # If the user should also be able to grant the privilege then we check for the grant capability too
+                # We consider the privilege not available if its not grantable in such a case
+                if grant_capability and user_privileges[privilege] != 'YES':
                     has_required_grants = False
-                    missing_privileges.append(privilege)
-
-            if len(missing_privileges) < 1 and grant_capability:
-                required_privileges = ['INSERT', 'UPDATE']
-                quoted_privileges = ','.join("'%s'" % item for item in required_privileges)
-
-                # If the user should be able to grant privileges too, such as the user that is used to create the
-                # twindb_agent user then, insert and update privileges are needed on mysql.*
-                sql = ("SELECT privilege_type FROM information_schema.schema_privileges "
-                       "WHERE grantee=\"'%s'@'%s'\" AND table_schema = 'mysql' AND privilege_type IN (%s)"
-                       "UNION "
-                       "SELECT privilege_type FROM information_schema.user_privileges "
-                       "WHERE grantee=\"'%s'@'%s'\" AND privilege_type IN (%s)"
-                       % (username, hostname, quoted_privileges, username, hostname, quoted_privileges))
-                cursor.execute(sql)
-
-                user_privileges = []
-                for row in cursor:
-                    user_privileges.append(row[u'privilege_type'])
+            else:
+                has_required_grants = False
+                missing_privileges.append(privilege)
 
-                for privilege in required_privileges:
-                    if privilege not in user_privileges:
-                        has_required_grants = False
-                        break
+        if len(missing_privileges) < 1 and grant_capability:
+            # If the user should be able to grant privileges too, such as the user that is used to create the
+            # twindb_agent user then, insert and update privileges are needed on mysql.*
+            for privilege in ['INSERT', 'UPDATE']:
+                if privilege not in user_privileges and privilege not in snapshot["mysql_privileges"]:
+                    has_required_grants = False
+                    break
 
-            cursor.close()
-            conn.close()
-        except mysql.connector.Error as err:
-            log.error("Could not read the grants information from MySQL")
-            log.error("MySQL Error: %s" % err)
         return has_required_grants, missing_privileges
 
     def create_agent_user(self):
@@ -245,7 +300,8 @@ class MySQL(object):
         server_config = twindb_agent.handlers.get_config()
         try:
             conn = self.get_mysql_connection()
-            q = "GRANT RELOAD, LOCK TABLES, REPLICATION CLIENT, SUPER, CREATE TABLESPACE"
+            # REPLICATION SLAVE is needed to stream binary logs
+            q = "GRANT RELOAD, LOCK TABLES, REPLICATION CLIENT, REPLICATION SLAVE, SUPER, CREATE TABLESPACE"
             q += " ON *.* TO %s@'localhost' IDENTIFIED BY %s"
             cursor = conn.cursor()
             cursor.execute(q, (server_config["mysql_user"], server_config["mysql_password"]))
@@ -255,3 +311,78 @@ class MySQL(object):
             return False
         log.info("Created MySQL user %s@localhost for TwinDB agent" % server_config["mysql_user"])
         return True
+
+
+class MySQLSampler(object):
+    """
+    Base class of samplers that query MySQL every interval seconds in a background thread.
+    The connection is kept open between samples and reopened after an error
+    """
+    def __init__(self, interval, logger_name="twindb_local"):
+        agent_config = twindb_agent.config.AgentConfig.get_config()
+        self.interval = interval
+        self.retry_delay = agent_config.check_period
+        self.logger = logging.getLogger(logger_name)
+        self.conn = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def connect(self):
+        """
+        :return: connection as the agent's MySQL user or None if error happened
+        """
+        server_config = twindb_agent.handlers.get_config()
+        if not server_config:
+            return None
+        mysql = MySQL(mysql_user=server_config["mysql_user"], mysql_password=server_config["mysql_password"],
+                      logger_name=self.logger.name)
+        return mysql.get_mysql_connection()
+
+    def query(self, sql):
+        """
+        Runs a query on the sampler's connection
+        :return: list of rows as dictionaries or None if MySQL isn't available
+        """
+        try:
+            if not self.conn:
+                self.conn = self.connect()
+                if not self.conn:
+                    return None
+            cursor = self.conn.cursor(dictionary=True)
+            cursor.execute(sql)
+            rows = cursor.fetchall()
+            cursor.close()
+        except mysql.connector.Error as err:
+            self.logger.error("Failed to sample %r: %s" % (sql, err))
+            self.close()
+            return None
+        return rows
+
+    def sample(self):
+        raise NotImplementedError()
+
+    def run(self):
+        delay = self.interval
+        while not self._stopped.wait(delay):
+            self.sample()
+            # Don't ask the dispatcher for MySQL credentials every interval while MySQL is unavailable
+            delay = self.interval if self.conn else max(self.interval, self.retry_delay)
+        self.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=self.__class__.__name__)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def close(self):
+        if self.conn:
+            try:
+                self.conn.close()
+            except mysql.connector.Error:
+                pass
+            self.conn = None
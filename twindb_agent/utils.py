@@ -1,6 +1,8 @@
 """
 Auxilary functions
 """
+import array
+import json
 import logging
 import os
 import sys
@@ -63,3 +65,55 @@ def is_dir_empty(directory):
     :return: True if the directory is empty of False otherwise
     """
     return len(os.listdir(directory)) == 0
+
+
+class LazyJSON(object):
+    """
+    Pretty prints a python structure or a JSON string when a log record is formatted.
+    Pass it as a logging argument, so nothing is serialized if the record isn't emitted:
+        log.debug("Response: %s", LazyJSON(response))
+    """
+    __slots__ = ["obj"]
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        obj = self.obj
+        if isinstance(obj, basestring):
+            try:
+                obj = json.loads(obj)
+            except ValueError:
+                return obj
+        return json.dumps(obj, indent=4, sort_keys=True)
+
+
+class RingBuffer(object):
+    """
+    Fixed-size buffer of numbers. When it's full a new value overwrites the oldest one
+    """
+    def __init__(self, size, typecode="d"):
+        self.size = size
+        self._data = array.array(typecode, [0]) * size
+        self._next = 0
+        self._count = 0
+
+    def append(self, value):
+        self._data[self._next] = value
+        self._next = (self._next + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+
+    def values(self):
+        """
+        :return: array of the values from the oldest to the newest
+        """
+        if self._count < self.size:
+            return self._data[:self._count]
+        return self._data[self._next:] + self._data[:self._next]
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
@@ -0,0 +1,97 @@
+"""
+Compact wire format of agent-dispatcher messages
+
+Legacy format: JSON -> gpg --armor -> base64 -> form field "data", response is JSON
+with base64 encoded armored ciphertext.
+
+Compact format: serialized message (msgpack if available, JSON otherwise), optionally
+compressed with zlib -> binary gpg ciphertext sent as raw application/octet-stream body.
+The encoding is named in X-TwinDB-Encoding header, e.g. "msgpack+zlib".
+A compact response is binary ciphertext of the serialized {"success", "data", "error", "debug"} envelope.
+
+The agent negotiates the format: in "auto" mode it sends legacy requests with
+X-TwinDB-Wire header until the dispatcher answers with a compact response.
+"""
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    # msgpack is optional, JSON is used without it
+    msgpack = None
+
+CONTENT_TYPE = "application/octet-stream"
+WIRE_HEADER = "X-TwinDB-Wire"
+ENCODING_HEADER = "X-TwinDB-Encoding"
+ACCEPT_ENCODING_HEADER = "X-TwinDB-Accept-Encoding"
+WIRE_VERSION = "1"
+
+# Messages shorter than this aren't worth compressing
+COMPRESS_MIN_SIZE = 512
+
+
+def default_encoding(compress=True):
+    """
+    :return: the best encoding supported by this agent
+    """
+    encoding = "msgpack" if msgpack else "json"
+    if compress:
+        encoding += "+zlib"
+    return encoding
+
+
+def supported_encodings():
+    encodings = ["json", "json+zlib"]
+    if msgpack:
+        encodings += ["msgpack", "msgpack+zlib"]
+    return encodings
+
+
+def encode(msg, encoding):
+    """
+    Serializes a message
+    :param msg: python data structure
+    :param encoding: "json" or "msgpack" with optional "+zlib"
+    :return: tuple (bytes, actual encoding). Short messages aren't compressed
+    """
+    serialization, _, compression = encoding.partition("+")
+    if serialization == "msgpack":
+        if not msgpack:
+            raise WireFormatException("msgpack isn't installed")
+        data = msgpack.packb(msg, use_bin_type=True)
+    elif serialization == "json":
+        data = json.dumps(msg, separators=(",", ":"))
+    else:
+        raise WireFormatException("Unsupported encoding %s" % encoding)
+    if compression == "zlib" and len(data) >= COMPRESS_MIN_SIZE:
+        return zlib.compress(data), encoding
+    return data, serialization
+
+
+def decode(data, encoding):
+    """
+    Deserializes a message encoded by encode()
+    """
+    serialization, _, compression = encoding.partition("+")
+    if compression == "zlib":
+        try:
+            data = zlib.decompress(data)
+        except zlib.error as err:
+            raise WireFormatException("Failed to decompress message: %s" % err)
+    elif compression:
+        raise WireFormatException("Unsupported compression %s" % compression)
+    try:
+        if serialization == "msgpack":
+            if not msgpack:
+                raise WireFormatException("msgpack isn't installed")
+            return msgpack.unpackb(data, raw=False)
+        elif serialization == "json":
+            return json.loads(data)
+    except ValueError as err:
+        raise WireFormatException("Failed to decode %s message: %s" % (encoding, err))
+    raise WireFormatException("Unsupported encoding %s" % encoding)
+
+
+class WireFormatException(Exception):
+    pass
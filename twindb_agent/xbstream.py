@@ -0,0 +1,107 @@
+"""
+Reader of the xbstream format
+
+An xbstream is a sequence of chunks. A chunk starts with a header:
+    magic "XBSTCK01", flags (1 byte), type (1 byte), path length (uint32), path
+and, unless it's the end-of-file chunk, continues with
+    [sparse map size (uint32) for sparse chunks], payload length (uint64), payload offset (uint64),
+    checksum (uint32), [sparse map], payload.
+All integers are little-endian. Every chunk names its file, so chunks of unneeded files
+can be dropped from a stream without unpacking it.
+"""
+import fnmatch
+import struct
+
+MAGIC = "XBSTCK01"
+CHUNK_PAYLOAD = "P"
+CHUNK_SPARSE = "S"
+CHUNK_EOF = "E"
+# Size of an entry of the sparse map: skip and length, both uint32
+SPARSE_ENTRY = 8
+
+# Files every prepare needs: the system and undo tablespaces, the redo log copy and backup metadata
+SYSTEM_FILES = ["ibdata*", "undo[0-9]*", "mysql.ibd", "xtrabackup_*", "backup-my.cnf"]
+# Files of a table in a full or an incremental copy. Partitions are separate tablespaces.
+# MyISAM, CSV and ARCHIVE tables keep their data next to the .frm
+TABLE_FILES = ["%s.frm", "%s.ibd", "%s.ibd.delta", "%s.ibd.meta", "%s#[Pp]#*", "%s.par",
+               "%s.MYD", "%s.MYI", "%s.CSV", "%s.CSM", "%s.ARZ"]
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise XBStreamException("Unexpected end of stream: expected %d bytes, got %d" % (size, len(data)))
+    return data
+
+
+def read_chunks(stream):
+    """
+    Reads chunks of an xbstream
+    :param stream: file object
+    :return: iterator of tuples (path, raw chunk). Raw chunk is the chunk as it is in the stream
+    """
+    while True:
+        magic = stream.read(len(MAGIC))
+        if not magic:
+            return
+        if magic != MAGIC:
+            raise XBStreamException("Wrong chunk magic %r" % magic)
+        header = _read_exactly(stream, 6)
+        chunk_type = header[1]
+        path_len = struct.unpack("<I", header[2:])[0]
+        path = _read_exactly(stream, path_len)
+        parts = [magic, header, path]
+        if chunk_type != CHUNK_EOF:
+            sparse_size = 0
+            if chunk_type == CHUNK_SPARSE:
+                data = _read_exactly(stream, 4)
+                sparse_size = struct.unpack("<I", data)[0]
+                parts.append(data)
+            data = _read_exactly(stream, 20)
+            payload_len = struct.unpack("<Q", data[:8])[0]
+            parts.append(data)
+            parts.append(_read_exactly(stream, sparse_size * SPARSE_ENTRY + payload_len))
+        yield path, "".join(parts)
+
+
+def table_filter(tables):
+    """
+    :param tables: list of tables as "database.table"
+    :return: function that takes a path in the stream and returns True if it's needed to restore the tables
+    """
+    patterns = list(SYSTEM_FILES)
+    for table in tables:
+        database, _, name = table.partition(".")
+        if not database or not name:
+            raise XBStreamException("Table %r must be given as database.table" % table)
+        patterns += ["%s/%s" % (database, pattern % name) for pattern in TABLE_FILES]
+
+    def keep(path):
+        return any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns)
+    return keep
+
+
+def filter_stream(src, dst, keep):
+    """
+    Copies chunks of files that keep() accepts from src to dst
+    :param src: file object with xbstream
+    :param dst: file object to write the filtered xbstream to
+    :param keep: function that takes a path and returns True if the file is needed
+    :return: dictionary with "copied" and "skipped" bytes and the set of copied "paths"
+    """
+    stats = {"copied": 0, "skipped": 0, "paths": set()}
+    decisions = {}
+    for path, chunk in read_chunks(src):
+        if path not in decisions:
+            decisions[path] = keep(path)
+        if decisions[path]:
+            dst.write(chunk)
+            stats["copied"] += len(chunk)
+            stats["paths"].add(path)
+        else:
+            stats["skipped"] += len(chunk)
+    return stats
+
+
+class XBStreamException(Exception):
+    pass